@@ -0,0 +1,440 @@
+"""
+Benchmarks for the Python stages of the DEMISTIFI pipeline
+
+Generates a synthetic cohort of UKB-shaped NIfTI phantoms and stats files,
+times each stage and writes the results as JSON so runs can be compared.
+External tools (r-coh, renal-preproc, segmentation, Quantiphyse) are replaced
+by stub executables so the whole pipeline can be run offline to measure the
+orchestration overhead.
+
+Each stage is run in a forked child process so its CPU time and peak memory
+can be measured with wait4. Peak memory includes the memory inherited from the
+benchmark process, which is reported as baseline_rss_mb.
+
+Usage: run_benchmarks.py [--subjects 20] [--scale 0.5] [--compare results/previous.json]
+"""
+import argparse
+import csv
+import datetime
+import json
+import logging
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+import numpy as np
+import nibabel as nib
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+import demistifi_pipeline
+import generate_subject_idps
+import clean_cortex_medulla_masks
+import roi_stats
+
+# generate_subject_idps configures debug logging on import
+logging.getLogger().setLevel(logging.WARNING)
+
+# Phantom grids: (in-plane shape at scale 1, number of slices, voxel sizes)
+GRIDS = {
+    "dixon" : ((224, 174), 72, (2.23, 2.23, 3.0)),
+    "t1w" : ((288, 288), 28, (1.15, 1.15, 1.6)),
+    "molli" : ((192, 192), 1, (1.9, 1.9, 8.0)),
+    "gre" : ((160, 160), 1, (2.5, 2.5, 6.0)),
+    "ideal" : ((232, 256), 1, (1.7, 1.7, 10.0)),
+}
+
+# Preprocessing subject ID created by the r-coh stub
+PREPROC_SUBJID = "PHANTOM_20200101"
+
+STAGES = ["r2star_to_t2star", "correct_r2star_units", "link", "generate_subject_idps", "clean_cortex_medulla_masks", "pipeline"]
+
+# Stub executables standing in for external tools. The r-coh stub copies the
+# phantom preprocessing and segmentation output into place
+STUBS = {
+    "r-coh.py" : """#!/bin/sh
+cp -r "{template}/preproc/." "$3/"
+cp -r "{template}/seg" "{template}/vat" "$3/.."
+""",
+    "renal-preproc" : "#!/bin/sh\nexit 0\n",
+    "kidney_t1_seg" : "#!/bin/sh\nexit 0\n",
+    "infer_knee_to_neck_dixon" : "#!/bin/sh\nexit 0\n",
+    "infer_pancreas_t1w" : "#!/bin/sh\nexit 0\n",
+    "infer_liver_ideal_multiecho" : "#!/bin/sh\nexit 0\n",
+    "quantiphyse" : "#!/bin/sh\nexit 0\n",
+}
+
+class ArgumentParser(argparse.ArgumentParser):
+    def __init__(self, **kwargs):
+        argparse.ArgumentParser.__init__(self, prog="run_benchmarks", add_help=True, **kwargs)
+        self.add_argument("--subjects", type=int, default=20, help="Number of subjects in the synthetic cohort")
+        self.add_argument("--pipeline-subjects", type=int, default=4, help="Number of subjects run through the full pipeline with stub tools")
+        self.add_argument("--scale", type=float, default=0.5, help="Scale factor for the in-plane size of phantom images")
+        self.add_argument("--repeat", type=int, default=3, help="Number of times each stage is run")
+        self.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES, help="Stages to benchmark")
+        self.add_argument("--jobs", type=int, default=1, help="Number of processes used by stages which support it")
+        self.add_argument("--workdir", help="Directory for synthetic data. Defaults to a temporary directory which is removed afterwards")
+        self.add_argument("--output", help="Output JSON file. Defaults to benchmarks/results/<timestamp>.json")
+        self.add_argument("--compare", help="Previous results JSON file to compare with")
+
+def grid(name, scale):
+    """
+    :return: Tuple of (shape, affine) for a phantom grid, centred on the origin
+    """
+    in_plane, nslices, voxel_sizes = GRIDS[name]
+    shape = tuple(max(8, int(round(n * scale))) for n in in_plane) + (nslices,)
+    voxel_sizes = [voxel_sizes[0] / scale, voxel_sizes[1] / scale, voxel_sizes[2]]
+    affine = np.diag(voxel_sizes + [1.0])
+    affine[:3, 3] = -0.5 * np.array(shape) * np.array(voxel_sizes)
+    return shape, affine
+
+def grid_for(name):
+    """
+    :return: Name of the phantom grid for a qpdata data set
+    """
+    if "t1w" in name:
+        return "t1w"
+    elif "molli" in name or "_t1" in name:
+        return "molli"
+    elif "ideal" in name:
+        return "ideal"
+    elif "gre" in name:
+        return "gre"
+    return "dixon"
+
+def save_phantom(fname, name, scale, rng):
+    """
+    Save a phantom image - an ellipsoid mask for segmentations, otherwise a noisy parameter map
+    """
+    shape, affine = grid(grid_for(name), scale)
+    if name.startswith("seg") or name in ("vat", "asat"):
+        coords = np.meshgrid(*[np.linspace(-1, 1, n) if n > 1 else np.zeros(1) for n in shape], indexing="ij")
+        centre = rng.uniform(-0.2, 0.2, 3)
+        data = (sum(((c - c0) / 0.4)**2 for c, c0 in zip(coords, centre)) < 1).astype(np.uint8)
+    else:
+        data = rng.normal(50, 10, shape).astype(np.float32)
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    nib.Nifti1Image(data, affine).to_filename(fname)
+    return data.nbytes
+
+def make_template(template_dir, scale, rng):
+    """
+    Create phantom pipeline output for one subject: r-coh output, segmentations and VAT/ASAT masks
+
+    Files are created for every entry in the pipeline LINKS table, with wildcards filled in
+    """
+    dirs = {
+        "seg_outdir" : os.path.join(template_dir, "seg"),
+        "vat_asat_outdir" : os.path.join(template_dir, "vat"),
+        "analysis_dir" : os.path.join(template_dir, "preproc", PREPROC_SUBJID, "analysis"),
+        "tmp_nifti_dir" : os.path.join(template_dir, "preproc", PREPROC_SUBJID, "tmp", "nifti_series"),
+        "renal_outdir" : os.path.join(template_dir, "preproc", PREPROC_SUBJID, "renal"),
+        "nifti_dir" : os.path.join(template_dir, "preproc", PREPROC_SUBJID, "nifti"),
+    }
+    for srcdir, srcfile, destfile in demistifi_pipeline.LINKS:
+        fname = srcfile.format(preproc_subjid=PREPROC_SUBJID).replace("*", "X")
+        save_phantom(os.path.join(dirs[srcdir], f"{fname}.nii.gz"), destfile, scale, rng)
+    for seg, _mask, _output in demistifi_pipeline.KIDNEY_T1_CLEAN:
+        save_phantom(os.path.join(dirs["seg_outdir"], "kidney_t1_seg", f"{seg}.nii.gz"), seg, scale, rng)
+    os.makedirs(os.path.join(template_dir, "preproc", PREPROC_SUBJID, "tmp", "dicom_series"), exist_ok=True)
+    return dirs
+
+def make_cohort(workdir, nsubjects):
+    """
+    Create a cohort of subject output dirs by copying the template subject
+    """
+    cohort_dir = os.path.join(workdir, "cohort")
+    if os.path.exists(cohort_dir):
+        shutil.rmtree(cohort_dir)
+    subjids = [f"{1000001 + idx}" for idx in range(nsubjects)]
+    for subjid in subjids:
+        shutil.copytree(os.path.join(workdir, "template"), os.path.join(cohort_dir, subjid), symlinks=True)
+    return cohort_dir, subjids
+
+def make_stats(statsdir, plan, rng):
+    """
+    Create synthetic stats files with all the columns used by an IDP plan
+    """
+    os.makedirs(statsdir, exist_ok=True)
+    vols = {col : [int(rng.integers(100, 10000)), float(rng.uniform(10, 1000))] for col in plan.vol_cols}
+    with open(os.path.join(statsdir, "seg_volumes.tsv"), "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t")
+        writer.writerow([""] + list(vols))
+        writer.writerow(["N"] + [v[0] for v in vols.values()])
+        writer.writerow(["Volume (ml)"] + [v[1] for v in vols.values()])
+    for stats_file, entries in plan.stats.items():
+        cols = sorted(set(col for col, _alt, _rows, _indices, _vol_idx in entries))
+        with open(os.path.join(statsdir, stats_file), "w", newline="") as f:
+            writer = csv.writer(f, delimiter="\t")
+            writer.writerow([""] + cols)
+            for stat in roi_stats.STATS:
+                writer.writerow([stat] + list(rng.uniform(0, 100, len(cols))))
+
+def make_masks(maskdir, scale, rng):
+    """
+    Create phantom cortex and medulla masks with kidney blobs and some spurious blobs
+    """
+    shape, affine = grid("molli", scale)
+    cortex = np.zeros(shape, dtype=np.uint8)
+    medulla = np.zeros(shape, dtype=np.uint8)
+    rows, cols = np.indices(shape[:2])
+    for centre_row, centre_col, radius in [(0.3, 0.5, 0.12), (0.7, 0.5, 0.12), (0.5, 0.5, 0.05), (0.1, 0.1, 0.02)]:
+        dist = np.hypot(rows / shape[0] - centre_row, cols / shape[1] - centre_col)
+        cortex[dist < radius] = 1
+        medulla[dist < radius * 0.5] = 1
+    cortex[medulla > 0] = 0
+    cortex[rng.random(shape) > 0.999] = 1
+    os.makedirs(maskdir, exist_ok=True)
+    nib.Nifti1Image(cortex, affine).to_filename(os.path.join(maskdir, "cortex_rot.nii.gz"))
+    nib.Nifti1Image(medulla, affine).to_filename(os.path.join(maskdir, "medulla_rot.nii.gz"))
+
+def nifti_voxels(fnames):
+    return int(sum(np.prod(nib.load(fname).shape) for fname in fnames))
+
+def rss_mb():
+    """
+    :return: Current resident set size of this process in Mb
+    """
+    with open("/proc/self/statm", "r") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+def measure(func):
+    """
+    Run a function in a forked child process
+
+    :return: Dict of wall time, CPU time and peak memory, updated with the dict returned by the function
+    """
+    read_fd, write_fd = os.pipe()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 0
+        try:
+            with open(os.devnull, "w") as devnull:
+                os.dup2(devnull.fileno(), 1)
+            baseline = rss_mb()
+            start = time.monotonic()
+            result = func() or {}
+            result["wall_s"] = time.monotonic() - start
+            result["baseline_rss_mb"] = baseline
+            payload = json.dumps(result)
+        except BaseException as exc:
+            payload = json.dumps({"error" : repr(exc)})
+            status = 1
+        with os.fdopen(write_fd, "w") as f:
+            f.write(payload)
+        os._exit(status)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd, "r") as f:
+        result = json.loads(f.read() or '{"error" : "no result"}')
+    _pid, _status, rusage = os.wait4(pid, 0)
+    result.update({
+        "cpu_s" : rusage.ru_utime + rusage.ru_stime,
+        "max_rss_mb" : rusage.ru_maxrss / 1024,
+    })
+    return result
+
+def stage_r2star_to_t2star(options, workdir):
+    cohort_dir, subjids = make_cohort(workdir, options.subjects)
+    analysis_dirs = [os.path.join(cohort_dir, subjid, "preproc", PREPROC_SUBJID, "analysis") for subjid in subjids]
+    fnames = [os.path.join(d, f) for d in analysis_dirs for f in os.listdir(d) if "r2star" in f]
+
+    def _run():
+        for analysis_dir in analysis_dirs:
+            demistifi_pipeline.r2star_to_t2star(analysis_dir)
+    return _run, {"files" : len(fnames), "voxels" : nifti_voxels(fnames)}
+
+def stage_correct_r2star_units(options, workdir):
+    cohort_dir, subjids = make_cohort(workdir, options.subjects)
+    renal_dirs = [os.path.join(cohort_dir, subjid, "preproc", PREPROC_SUBJID, "renal") for subjid in subjids]
+    fnames = [os.path.join(root, f) for d in renal_dirs for root, _dirs, files in os.walk(d) for f in files if "r2star" in f]
+
+    def _run():
+        for renal_dir in renal_dirs:
+            demistifi_pipeline.correct_r2star_units(renal_dir)
+    return _run, {"files" : len(fnames), "voxels" : nifti_voxels(fnames)}
+
+def stage_link(options, workdir):
+    cohort_dir, subjids = make_cohort(workdir, options.subjects)
+    fake_options = types.SimpleNamespace(input=cohort_dir, output=cohort_dir)
+    subjs = []
+    for subjid in subjids:
+        subj = demistifi_pipeline.Subject(fake_options, subjid)
+        subj.set_preproc()
+        os.makedirs(subj.qp_data_dir, exist_ok=True)
+        subjs.append(subj)
+
+    def _run():
+        for subj in subjs:
+            demistifi_pipeline.link_data(subj, subj.qp_data_dir)
+    return _run, {"files" : len(subjs) * len(demistifi_pipeline.LINKS)}
+
+def stage_generate_subject_idps(options, workdir, rng):
+    plan = generate_subject_idps.IdpPlan(generate_subject_idps.IDPDEF)
+    stats_root = os.path.join(workdir, "idps")
+    if os.path.exists(stats_root):
+        shutil.rmtree(stats_root)
+    subjids = [f"{1000001 + idx}" for idx in range(options.subjects)]
+    for subjid in subjids:
+        make_stats(os.path.join(stats_root, subjid, "stats"), plan, rng)
+    idp_options = types.SimpleNamespace(input=stats_root, statspath="stats", jobs=options.jobs)
+
+    def _run():
+        with open(os.path.join(workdir, "idps.csv"), "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerows(plan.header_rows())
+            for _digests, row in generate_subject_idps.iter_subject_idps(idp_options, subjids, plan):
+                writer.writerow(row)
+    return _run, {"files" : len(subjids) * len(plan.stats_files())}
+
+def stage_clean_cortex_medulla_masks(options, workdir, rng):
+    mask_root = os.path.join(workdir, "masks")
+    if os.path.exists(mask_root):
+        shutil.rmtree(mask_root)
+    maskdirs = [os.path.join(mask_root, f"{1000001 + idx}") for idx in range(options.subjects)]
+    for maskdir in maskdirs:
+        make_masks(maskdir, options.scale, rng)
+
+    def _run():
+        for maskdir in maskdirs:
+            clean_cortex_medulla_masks.clean_masks(
+                os.path.join(maskdir, "cortex_rot.nii.gz"), os.path.join(maskdir, "medulla_rot.nii.gz"),
+                os.path.join(maskdir, "cortex_new_py.nii.gz"), os.path.join(maskdir, "medulla_new_py.nii.gz"),
+            )
+    return _run, {"files" : len(maskdirs) * 2}
+
+def stage_pipeline(options, workdir):
+    bindir = os.path.join(workdir, "bin")
+    os.makedirs(bindir, exist_ok=True)
+    for name, script in STUBS.items():
+        fname = os.path.join(bindir, name)
+        with open(fname, "w") as f:
+            f.write(script.format(template=os.path.join(workdir, "template")))
+        os.chmod(fname, 0o755)
+
+    indir, outdir = os.path.join(workdir, "pipeline_in"), os.path.join(workdir, "pipeline_out")
+    for d in (indir, outdir):
+        if os.path.exists(d):
+            shutil.rmtree(d)
+    subjids = [f"{1000001 + idx}" for idx in range(options.pipeline_subjects)]
+    for subjid in subjids:
+        os.makedirs(os.path.join(indir, subjid, "Abdominal_MRI"))
+    subjids_file = os.path.join(workdir, "pipeline_subjids.txt")
+    with open(subjids_file, "w") as f:
+        f.write("\n".join(subjids) + "\n")
+    pipeline_options = demistifi_pipeline.ArgumentParser().parse_args([
+        "--input", indir, "--output", outdir, "--subjids", subjids_file,
+        "--seg-models-dir", os.path.join(workdir, "models"), "--jobs", str(options.jobs), "--no-cache",
+        "--stats-engine", "native",
+    ])
+
+    def _run():
+        os.environ["PATH"] = bindir + os.pathsep + os.environ["PATH"]
+        failed = demistifi_pipeline.process_subjects(pipeline_options, subjids)
+        return {"failed" : len(failed)}
+    return _run, {"subjects" : len(subjids)}
+
+def run_stage(options, workdir, stage, rng):
+    """
+    Set up and time a benchmark stage
+
+    :return: Dict of results for the stage
+    """
+    setup = {
+        "r2star_to_t2star" : lambda: stage_r2star_to_t2star(options, workdir),
+        "correct_r2star_units" : lambda: stage_correct_r2star_units(options, workdir),
+        "link" : lambda: stage_link(options, workdir),
+        "generate_subject_idps" : lambda: stage_generate_subject_idps(options, workdir, rng),
+        "clean_cortex_medulla_masks" : lambda: stage_clean_cortex_medulla_masks(options, workdir, rng),
+        "pipeline" : lambda: stage_pipeline(options, workdir),
+    }[stage]
+
+    runs = []
+    for _repeat in range(options.repeat):
+        func, items = setup()
+        result = measure(func)
+        result.update(items)
+        runs.append(result)
+        if "error" in result:
+            print(f"WARNING: Stage {stage} failed: {result['error']}")
+            break
+
+    summary = dict(runs[len(runs) // 2] if len(runs) > 1 else runs[0])
+    walls = sorted(run["wall_s"] for run in runs if "wall_s" in run)
+    if walls:
+        summary["wall_s"] = walls[len(walls) // 2]
+        summary["wall_s_all"] = walls
+        for key in ("files", "voxels", "subjects"):
+            if key in summary:
+                summary[f"{key}_per_s"] = summary[key] / summary["wall_s"]
+    summary["max_rss_mb"] = max(run["max_rss_mb"] for run in runs)
+    return summary
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, previous_fname):
+    """
+    Print a comparison of wall time and peak memory with previous results
+    """
+    with open(previous_fname, "r") as f:
+        previous = json.load(f)
+    print(f"\nComparison with {previous_fname} (commit {previous.get('commit')})")
+    print(f"{'stage':30} {'wall_s':>10} {'previous':>10} {'ratio':>8} {'rss_mb':>10} {'previous':>10}")
+    for stage, result in results["stages"].items():
+        prev = previous.get("stages", {}).get(stage)
+        if not prev or "wall_s" not in result or "wall_s" not in prev:
+            continue
+        print(f"{stage:30} {result['wall_s']:10.3f} {prev['wall_s']:10.3f} {result['wall_s'] / prev['wall_s']:8.2f} "
+              f"{result['max_rss_mb']:10.1f} {prev['max_rss_mb']:10.1f}")
+
+def main():
+    options = ArgumentParser().parse_args()
+    workdir = options.workdir or tempfile.mkdtemp(prefix="demistifi_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    rng = np.random.default_rng(0)
+    try:
+        print(f"Creating phantom data in {workdir}")
+        make_template(os.path.join(workdir, "template"), options.scale, rng)
+
+        results = {
+            "timestamp" : datetime.datetime.now().isoformat(timespec="seconds"),
+            "commit" : git_commit(),
+            "python" : platform.python_version(),
+            "platform" : platform.platform(),
+            "cpu_count" : os.cpu_count(),
+            "config" : {key : getattr(options, key) for key in ("subjects", "pipeline_subjects", "scale", "repeat", "jobs")},
+            "stages" : {},
+        }
+        for stage in options.stages:
+            print(f"Running benchmark: {stage}")
+            results["stages"][stage] = run_stage(options, workdir, stage, rng)
+            result = results["stages"][stage]
+            print(f" - wall {result.get('wall_s', float('nan')):.3f}s, cpu {result['cpu_s']:.3f}s, peak RSS {result['max_rss_mb']:.1f}Mb")
+    finally:
+        if not options.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = options.output or os.path.join(ROOT, "benchmarks", "results", f"{re.sub('[^0-9T]', '', results['timestamp'])}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=1)
+    print(f"Results written to {output}")
+    if options.compare:
+        compare(results, options.compare)
+
+if __name__ == "__main__":
+    main()
@@ -1,52 +1,120 @@
 """
 Generate a report on data availability in processed data
+
+Reports which of the data sets the pipeline puts in each subject's qpdata
+folder are present. Each qpdata folder is listed once and the listing is
+cached in an index file with the folder's modification time, so subsequent
+runs only re-list folders which have changed. Links only count if their
+target exists, which is checked against one listing of each target folder
+rather than a stat of each link. Note that a symlink whose target is removed
+does not change the folder's modification time - use --rebuild to re-check
+all subjects
+
+The report has one column per qpdata data set, named as in qpdata
 """
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import fnmatch
+import json
 import os
-import glob
 
 import pandas as pd
 
+from data_sets import qpdata_names
+
 BODY_SEG_DIR = "/share/ukbiobank/body_seg"
 
-data_ids = {
-    "pancreas_t1" : "t1_pancreas",
-    "kidney_t1" : "t1_liver",
-    "liver_t1" : "t1_liver",
-    "pancreas_t2star" : "t2star_pancreas",
-    "kidney_t2star" :  "t2star_kidney",
-    "liver_t2star" : "t2star_liver", 
-    "seg_pancreas" : "seg_pancreas_t1w", 
-    "seg_liver" : "seg_liver_dixon",
-    "seg_kidney" : "seg_kidney_left_dixon",
-    "seg_spleen" : "seg_spleen_dixon",
-    "liver_ge" : "gradecho_liver",
-    "pancreas_ge" : "gradecho_pancreas",
-}
-
-subjrows = []
-totals = {d : 0 for d in data_ids.keys()}
-
-for subjdir in glob.glob(os.path.join(BODY_SEG_DIR, "1*")):
-    subjid = os.path.basename(subjdir)
-    qpdir = os.path.join(subjdir, "qpdata")
-    subjrow = {"subjid" : subjid}
-    num_found = 0
-    for data_id, qpfile in data_ids.items():
+# Data sets in qpdata: linked data, derived masks and cleaned T1 kidney segmentations
+data_ids = qpdata_names()
+
+class ArgumentParser(argparse.ArgumentParser):
+    def __init__(self, **kwargs):
+        argparse.ArgumentParser.__init__(self, prog="body_seg_data_report", add_help=True, **kwargs)
+        self.add_argument("--input", help="Pipeline output directory containing subject dirs", default=BODY_SEG_DIR)
+        self.add_argument("--subjid-pattern", help="Pattern matching subject dirs", default="1*")
+        self.add_argument("--output", help="Output report filename", default="ukb_body_seg_report.csv")
+        self.add_argument("--index", help="Index file caching qpdata listings. Defaults to <output>.index.json")
+        self.add_argument("--rebuild", action="store_true", default=False, help="Ignore cached listings and re-list all subjects")
+        self.add_argument("--jobs", help="Number of folders to list at the same time", type=int, default=16)
+
+def list_qpdata(qpdir, cached=None):
+    """
+    List the data sets in a qpdata folder
+
+    :param cached: Cached listing from the index, used if the folder is unchanged
+    :return: Listing containing folder modification time and names of data sets present,
+             or None if there is no qpdata folder
+    """
+    try:
+        mtime_ns = os.stat(qpdir).st_mtime_ns
+        if cached and cached["mtime_ns"] == mtime_ns:
+            return cached
+        found, target_dirs = [], {}
+        with os.scandir(qpdir) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".nii.gz"):
+                    continue
+                # Links created by the pipeline only count if their target exists
+                if entry.is_symlink():
+                    target = os.path.join(qpdir, os.readlink(entry.path))
+                    target_dir = os.path.dirname(target)
+                    if target_dir not in target_dirs:
+                        try:
+                            target_dirs[target_dir] = set(os.listdir(target_dir))
+                        except OSError:
+                            target_dirs[target_dir] = set()
+                    if os.path.basename(target) not in target_dirs[target_dir]:
+                        continue
+                found.append(entry.name[:-len(".nii.gz")])
+        return {"mtime_ns" : mtime_ns, "found" : sorted(found)}
+    except OSError:
+        return None
+
+def main():
+    options = ArgumentParser().parse_args()
+    index_fname = options.index or f"{options.output}.index.json"
+    index = {}
+    if os.path.exists(index_fname) and not options.rebuild:
         try:
-            fname = os.path.join(qpdir, f"{qpfile}.nii.gz")
-            os.stat(fname)
-            subjrow[data_id] = 1
-            totals[data_id] += 1
-            num_found += 1
-        except OSError:
-            subjrow[data_id] = 0
-            #print(f"{subjid} missing {data_id}")
-    subjrow["num_found"] = num_found
-    subjrow["%"] = 100 * float(num_found) / len(data_ids)
-    subjrows.append(subjrow)
-
-subjrows.append(totals)
-df = pd.DataFrame(subjrows)
-df.to_csv("ukb_body_seg_report.csv")
+            with open(index_fname, "r") as f:
+                index = json.load(f)
+        except ValueError:
+            print(f"WARNING: Ignoring invalid index file {index_fname}")
+
+    with os.scandir(options.input) as entries:
+        subjids = sorted(entry.name for entry in entries if fnmatch.fnmatch(entry.name, options.subjid_pattern) and entry.is_dir())
+
+    def _list(subjid):
+        return list_qpdata(os.path.join(options.input, subjid, "qpdata"), index.get(subjid))
+
+    with ThreadPoolExecutor(max_workers=options.jobs) as executor:
+        listings = dict(zip(subjids, executor.map(_list, subjids)))
+    num_missing = sum(1 for listing in listings.values() if listing is None)
+    num_relisted = sum(1 for subjid, listing in listings.items() if listing is not None and listing is not index.get(subjid))
+    print(f"Found {len(subjids)} subjects: {num_relisted} listed, {len(subjids) - num_relisted - num_missing} unchanged, {num_missing} without qpdata")
+
+    subjrows = []
+    totals = {d : 0 for d in data_ids}
+    for subjid, listing in listings.items():
+        found = set(listing["found"]) if listing else set()
+        subjrow = {"subjid" : subjid}
+        num_found = 0
+        for data_id in data_ids:
+            subjrow[data_id] = int(data_id in found)
+            totals[data_id] += subjrow[data_id]
+            num_found += subjrow[data_id]
+        subjrow["num_found"] = num_found
+        subjrow["%"] = 100 * float(num_found) / len(data_ids)
+        subjrows.append(subjrow)
+
+    subjrows.append(totals)
+    df = pd.DataFrame(subjrows)
+    df.to_csv(options.output)
 
+    index = {subjid : listing for subjid, listing in listings.items() if listing}
+    with open(index_fname + ".tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(index_fname + ".tmp", index_fname)
 
+if __name__ == "__main__":
+    main()
@@ -1,72 +1,139 @@
 """
 Clean cortex and medulla masks generated from Zhendi DL methods
 
+Blobs in the combined kidney mask which are small, central or near the edge
+of the image are removed from both masks. Masks can be cleaned for a single
+directory or for many subject directories in parallel
+
+Usage: clean_cortex_medulla_masks.py --input <dir> [--subjids <subjids file>]
+
 EFC December 2022
 """
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import os
+import traceback
+
 import skimage
 import numpy as np
 import nibabel as nib
 
-t1 = '900041794_KIDNEY_T1Map_LongT1_MoCo_20211110150850_31.nii'
-#cortex_new = 'corN_900041794_KIDNEY_T1Map_LongT1_MoCo_20211110150850_31.nii.gz'
-#cortex = 'cortex_900041794_KIDNEY_T1Map_LongT1_MoCo_20211110150850_31.nii.gz'
-#medulla_new = 'medN_900041794_KIDNEY_T1Map_LongT1_MoCo_20211110150850_31.nii.gz'
-#medulla = 'medulla_900041794_KIDNEY_T1Map_LongT1_MoCo_20211110150850_31.nii.gz'
-cortex = "cortex_rot.nii.gz"
-medulla = "medulla_rot.nii.gz"
-
-# get maps
-nii_t1 = nib.load(t1)
-img_data = nii_t1.get_fdata()
-
-# get masks
-nii_cortex = nib.load(cortex)
-mask_img_cor = nii_cortex.get_fdata().astype(int)
-mask_img_cor[mask_img_cor<0] = 0
-mask_img_cor[mask_img_cor>0] = 1
-
-nii_medulla = nib.load(medulla)
-mask_img_med = nii_medulla.get_fdata().astype(int)
-mask_img_med[mask_img_med<0] = 0
-mask_img_med[mask_img_med>0] = 1
-
-if mask_img_cor.ndim < 3:
-    mask_img_cor = mask_img_cor[..., np.newaxis]
-if mask_img_med.ndim < 3:
-    mask_img_med = mask_img_med[..., np.newaxis]
-kid_mask = np.logical_or(mask_img_cor, mask_img_med)
-kid_mask_all = np.sum(kid_mask, axis=2)
-
-labelled = skimage.measure.label(kid_mask_all)
-props = skimage.measure.regionprops(labelled)
-
-# remove any small blobs
-smallblob_thresh = round((kid_mask_all.shape[0]/20)**2)
-for region in props:
-    if np.sum(kid_mask_all[labelled == region.label]) < smallblob_thresh:
-        kid_mask_all[labelled == region.label] = 0
-
-# remove any central blobs
-for region in props:
-    if region.centroid[0] < kid_mask_all.shape[0]*7/12 and region.centroid[0] > kid_mask_all.shape[0]*5/12:
-        kid_mask_all[labelled == region.label] = 0
-
-# remove any blobs around the edge
-for region in props:
-    if (region.centroid[1] < kid_mask_all.shape[0]/4 or
-        region.centroid[1] > kid_mask_all.shape[0]*3/4 or
-        region.centroid[0] < kid_mask_all.shape[1]/6 or
-        region.centroid[0] > kid_mask_all.shape[1]*5/6):
-        kid_mask_all[labelled == region.label] = 0
-
-# apply new mask to oroginal mask to exclude extra blobs    
-kid_mask_all = kid_mask_all[..., np.newaxis]
-mask_img_cor_new = mask_img_cor * kid_mask_all
-mask_img_med_new = mask_img_med * kid_mask_all
-
-# save cleaned masks
-nii_cortex_new = nib.Nifti1Image(mask_img_cor_new, None, nii_cortex.header)
-nii_cortex_new.to_filename("cortex_new_py.nii.gz")
-
-nii_med_new = nib.Nifti1Image(mask_img_med_new, None, nii_medulla.header)
-nii_med_new.to_filename("medulla_new_py.nii.gz")
+class ArgumentParser(argparse.ArgumentParser):
+    def __init__(self, **kwargs):
+        argparse.ArgumentParser.__init__(self, prog="clean_cortex_medulla_masks", add_help=True, **kwargs)
+        self.add_argument("--input", help="Directory containing masks, or subject dirs if --subjids is given", default=".")
+        self.add_argument("--subjids", help="File containing IDs of subject dirs to process")
+        self.add_argument("--cortex", help="Cortex mask file name", default="cortex_rot.nii.gz")
+        self.add_argument("--medulla", help="Medulla mask file name", default="medulla_rot.nii.gz")
+        self.add_argument("--cortex-output", help="Cleaned cortex mask file name", default="cortex_new_py.nii.gz")
+        self.add_argument("--medulla-output", help="Cleaned medulla mask file name", default="medulla_new_py.nii.gz")
+        self.add_argument("--jobs", help="Number of subjects to process in parallel", type=int, default=len(os.sched_getaffinity(0)))
+
+def load_mask(fname):
+    """
+    :return: Tuple of (NIfTI image, binary mask data as integers with at least 3 dimensions)
+    """
+    nii = nib.load(fname)
+    mask_img = nii.get_fdata().astype(int)
+    mask_img[mask_img<0] = 0
+    mask_img[mask_img>0] = 1
+    if mask_img.ndim < 3:
+        mask_img = mask_img[..., np.newaxis]
+    return nii, mask_img
+
+def clean_kidney_mask(kid_mask_all):
+    """
+    Remove small, central and edge blobs from a 2D kidney mask
+
+    Each blob is tested using its area and centroid and all blobs to be removed
+    are then cleared in a single pass over the image
+
+    :param kid_mask_all: 2D mask giving number of slices in the kidney mask at each position
+    :return: Copy of mask with blobs removed
+    """
+    labelled = skimage.measure.label(kid_mask_all)
+    labels = labelled.ravel()
+    num_labels = labelled.max() + 1
+
+    # Blob sizes are the sum of the mask values, centroids are unweighted
+    sizes = np.bincount(labels, weights=kid_mask_all.ravel(), minlength=num_labels)
+    areas = np.bincount(labels, minlength=num_labels)
+    rows, cols = np.indices(kid_mask_all.shape)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        centroid_row = np.bincount(labels, weights=rows.ravel(), minlength=num_labels) / areas
+        centroid_col = np.bincount(labels, weights=cols.ravel(), minlength=num_labels) / areas
+
+    # remove any small blobs
+    smallblob_thresh = round((kid_mask_all.shape[0]/20)**2)
+    drop = sizes < smallblob_thresh
+
+    # remove any central blobs
+    drop |= (centroid_row < kid_mask_all.shape[0]*7/12) & (centroid_row > kid_mask_all.shape[0]*5/12)
+
+    # remove any blobs around the edge
+    drop |= ((centroid_col < kid_mask_all.shape[0]/4) |
+             (centroid_col > kid_mask_all.shape[0]*3/4) |
+             (centroid_row < kid_mask_all.shape[1]/6) |
+             (centroid_row > kid_mask_all.shape[1]*5/6))
+
+    drop[0] = False
+    return np.where(drop[labelled], 0, kid_mask_all)
+
+def clean_masks(cortex, medulla, cortex_output, medulla_output):
+    """
+    Clean cortex and medulla masks and save the cleaned masks
+    """
+    nii_cortex, mask_img_cor = load_mask(cortex)
+    nii_medulla, mask_img_med = load_mask(medulla)
+
+    kid_mask = np.logical_or(mask_img_cor, mask_img_med)
+    kid_mask_all = clean_kidney_mask(np.sum(kid_mask, axis=2))
+
+    # apply new mask to original mask to exclude extra blobs
+    kid_mask_all = kid_mask_all[..., np.newaxis]
+    mask_img_cor_new = mask_img_cor * kid_mask_all
+    mask_img_med_new = mask_img_med * kid_mask_all
+
+    # save cleaned masks
+    nii_cortex_new = nib.Nifti1Image(mask_img_cor_new, None, nii_cortex.header)
+    nii_cortex_new.to_filename(cortex_output)
+
+    nii_med_new = nib.Nifti1Image(mask_img_med_new, None, nii_medulla.header)
+    nii_med_new.to_filename(medulla_output)
+
+def clean_dir(options, dirname):
+    """
+    Clean the masks in a directory
+
+    :return: None if successful, otherwise an error message
+    """
+    try:
+        clean_masks(
+            os.path.join(dirname, options.cortex), os.path.join(dirname, options.medulla),
+            os.path.join(dirname, options.cortex_output), os.path.join(dirname, options.medulla_output),
+        )
+        return None
+    except Exception as exc:
+        traceback.print_exc()
+        return str(exc)
+
+def main():
+    options = ArgumentParser().parse_args()
+    if not options.subjids:
+        error = clean_dir(options, options.input)
+        if error:
+            raise RuntimeError(error)
+        return
+
+    with open(options.subjids, "r") as f:
+        subjids = [l.strip() for l in f.readlines() if l.strip()]
+    dirnames = [os.path.join(options.input, subjid) for subjid in subjids]
+    with ProcessPoolExecutor(max_workers=max(1, options.jobs)) as executor:
+        errors = list(executor.map(clean_dir, [options] * len(dirnames), dirnames))
+    failed = [(subjid, error) for subjid, error in zip(subjids, errors) if error]
+    for subjid, error in failed:
+        print(f"WARNING: Failed to clean masks for subject {subjid}: {error}")
+    print(f"Cleaned masks for {len(subjids) - len(failed)} of {len(subjids)} subjects")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Data sets the DEMISTIFI pipeline puts in each subject's qpdata folder
+
+Kept free of dependencies so reporting scripts can use the tables without
+importing the pipeline
+"""
+
+# Links from pipeline outputs into the Quantiphyse data directory. Each entry is
+# (source directory, source file, qpdata name) where the source directory is an
+# attribute of demistifi_pipeline.Subject and the source file may contain
+# wildcards and the placeholder {preproc_subjid}
+LINKS = [
+    # Segmentations
+    ("seg_outdir", "pancreas_t1w_sseg/{preproc_subjid}", "seg_pancreas_t1w"),
+    ("seg_outdir", "ideal_liver_seg/{preproc_subjid}", "seg_liver_ideal"),
+    ("seg_outdir", "kidney_t1_seg/seg_kidney_medulla_l_t1", "seg_kidney_medulla_l_t1"),
+    ("seg_outdir", "kidney_t1_seg/seg_kidney_cortex_l_t1", "seg_kidney_cortex_l_t1"),
+    ("seg_outdir", "kidney_t1_seg/seg_kidney_medulla_r_t1", "seg_kidney_medulla_r_t1"),
+    ("seg_outdir", "kidney_t1_seg/seg_kidney_cortex_r_t1", "seg_kidney_cortex_r_t1"),
+    ("seg_outdir", "kidney_t1_seg/seg_kidney_all_t1", "seg_kidney_all_t1"),
+    ("seg_outdir", "knee_to_neck_dixon_seg/otsu_prob_argmax_liver", "seg_liver_dixon"),
+    ("seg_outdir", "knee_to_neck_dixon_seg/otsu_prob_argmax_kidney_right", "seg_kidney_right_dixon"),
+    ("seg_outdir", "knee_to_neck_dixon_seg/otsu_prob_argmax_kidney_left", "seg_kidney_left_dixon"),
+    ("seg_outdir", "knee_to_neck_dixon_seg/otsu_prob_argmax_spleen", "seg_spleen_dixon"),
+    ("seg_outdir", "knee_to_neck_dixon_seg/otsu_prob_argmax_lungs", "seg_lungs_dixon"),
+    ("seg_outdir", "knee_to_neck_dixon_seg/otsu_prob_argmax_body_cavity", "seg_body_cavity_dixon"),
+    ("seg_outdir", "knee_to_neck_dixon_seg/otsu_prob_argmax_abdominal_cavity", "seg_abdominal_cavity_dixon"),
+
+    # Preproc outputs
+    ("analysis_dir", "multiecho.pancreas_presco_t2star", "t2star_pancreas_gre_presco"),
+    ("analysis_dir", "multiecho.pancreas_presco_b0", "b0_pancreas_gre_presco"),
+    ("analysis_dir", "multiecho.kidney_presco_t2star", "t2star_kidney_gre_presco"),
+    ("analysis_dir", "ideal.liver_presco_t2star", "t2star_liver_ideal_presco"),
+    ("analysis_dir", "ideal.liver_presco_b0", "b0_liver_ideal_presco"),
+    ("analysis_dir", "multiecho.pancreas_presco_r2star", "r2star_pancreas_gre_presco"),
+    ("analysis_dir", "multiecho.kidney_presco_r2star", "r2star_kidney_gre_presco"),
+    ("analysis_dir", "ideal.liver_presco_r2star", "r2star_liver_ideal_presco"),
+    ("analysis_dir", "multiecho.pancreas_presco_iron", "iron_pancreas_gre_presco"),
+    ("analysis_dir", "multiecho.kidney_presco_iron", "iron_kidney_gre_presco"),
+    ("analysis_dir", "ideal.liver_presco_iron", "iron_liver_ideal_presco"),
+    ("analysis_dir", "multiecho.pancreas_presco_pdff", "pdff_pancreas_gre_presco"),
+    ("analysis_dir", "multiecho.kidney_presco_pdff", "pdff_kidney_gre_presco"),
+    ("analysis_dir", "ideal.liver_presco_pdff", "pdff_liver_ideal_presco"),
+    ("analysis_dir", "fat.percent", "fat_fraction"),
+    ("tmp_nifti_dir", "*_ShMOLLI_*LIVER_T1MAP", "t1_liver_molli"),
+    ("tmp_nifti_dir", "*_ShMOLLI_*pancreas_T1MAP", "t1_pancreas_molli"),
+    ("tmp_nifti_dir", "*_ShMOLLI_*kidney_T1MAP", "t1_kidney_molli"),
+
+    # Parameter maps
+    #("nifti_dir", "multiecho_pancreas_magnitude", "multiecho_pancreas"),
+    #("nifti_dir", "ideal_liver_magnitude", "multiecho_liver"),
+
+    # Renal preproc outputs
+    ("renal_outdir", "*_gre_*_pancreas*/t2star_out/map_t2star_*_loglin", "t2star_pancreas_gre_loglin"),
+    ("renal_outdir", "*_gre_*_pancreas*/t2star_out/map_r2star_*_loglin", "r2star_pancreas_gre_loglin"),
+    ("renal_outdir", "*_gre_*_pancreas*/t2star_out/map_t2star_*_exp", "t2star_pancreas_gre_exp"),
+    ("renal_outdir", "*_gre_*_pancreas*/t2star_out/map_r2star_*_exp", "r2star_pancreas_gre_exp"),
+    ("renal_outdir", "*_gre_*_kidney*/t2star_out/map_t2star_*_loglin", "t2star_kidney_gre_loglin"),
+    ("renal_outdir", "*_gre_*_kidney*/t2star_out/map_r2star_*_loglin", "r2star_kidney_gre_loglin"),
+    ("renal_outdir", "*_gre_*_kidney*/t2star_out/map_t2star_*_exp", "t2star_kidney_gre_exp"),
+    ("renal_outdir", "*_gre_*_kidney*/t2star_out/map_r2star_*_exp", "r2star_kidney_gre_exp"),
+    ("renal_outdir", "*_gre_*_liver*/t2star_out/map_t2star_*_loglin", "t2star_liver_gre_loglin"),
+    ("renal_outdir", "*_gre_*_liver*/t2star_out/map_r2star_*_loglin", "r2star_liver_gre_loglin"),
+    ("renal_outdir", "*_gre_*_liver*/t2star_out/map_t2star_*_exp", "t2star_liver_gre_exp"),
+    ("renal_outdir", "*_gre_*_liver*/t2star_out/map_r2star_*_exp", "r2star_liver_gre_exp"),
+
+    # VAT/ASAT outputs
+    ("vat_asat_outdir", "vat/vat", "vat"),
+    ("vat_asat_outdir", "asat/asat", "asat"),
+]
+
+# Cleaning of T1 kidney segmentations using DIXON kidney masks: (T1 segmentation, DIXON mask, output)
+# T1 segmentations are in the kidney_t1_seg output dir, masks and outputs are qpdata names
+KIDNEY_T1_CLEAN = [
+    ("seg_kidney_medulla_l_orig_t1", "seg_kidney_left_dixon", "seg_kidney_medulla_l_t1_clean"),
+    ("seg_kidney_medulla_r_orig_t1", "seg_kidney_right_dixon", "seg_kidney_medulla_r_t1_clean"),
+    ("seg_kidney_cortex_l_orig_t1", "seg_kidney_left_dixon", "seg_kidney_cortex_l_t1_clean"),
+    ("seg_kidney_cortex_r_orig_t1", "seg_kidney_right_dixon", "seg_kidney_cortex_r_t1_clean"),
+    ("seg_kidney_all_t1", "seg_kidney_all_dixon", "seg_kidney_all_t1_clean"),
+]
+
+# Masks derived from other masks in qpdata: (qpdata name, expression). An expression
+# is a qpdata name or a tuple of (operation, operands...) where operands are
+# expressions or numbers. Operations are listed in MASK_OPS in demistifi_pipeline.py
+DERIVED_MASKS = [
+    ("seg_kidney_all_dixon", ("add", "seg_kidney_right_dixon", "seg_kidney_left_dixon")),
+    ("seg_kidney_dixon", ("union", "seg_kidney_right_dixon", "seg_kidney_left_dixon")),
+    ("seg_subcutaneous_fat_dixon", ("clip", ("sub", "seg_body_cavity_dixon", "seg_abdominal_cavity_dixon"), 0, 1)),
+]
+
+def qpdata_names():
+    """
+    :return: Names of the data sets the pipeline puts in qpdata: linked data, derived masks and cleaned T1 segmentations
+    """
+    return (
+        [destfile for _srcdir, _srcfile, destfile in LINKS] +
+        [name for name, _expr in DERIVED_MASKS] +
+        [output for _seg, _mask, output in KIDNEY_T1_CLEAN]
+    )
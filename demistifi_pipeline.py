@@ -2,13 +2,36 @@
 Processing pipeline for DEMISTIFI using UKB data
 """
 import argparse
+import collections
+import contextlib
+import fnmatch
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 import glob
+import hashlib
+import json
+from multiprocessing.managers import BaseManager
 import os
+import re
 import shutil
+import signal
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import traceback
 
 import nibabel as nib
+from nibabel.openers import Opener
+from nibabel.volumeutils import seek_tell
+import numpy as np
+import scipy.ndimage
+
+import data_sets
+from data_sets import DERIVED_MASKS, KIDNEY_T1_CLEAN, LINKS, qpdata_names
+import overlays
+import preflight
+import roi_stats
 
 class ArgumentParser(argparse.ArgumentParser):
     def __init__(self, **kwargs):
@@ -16,25 +39,335 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument("--input", required=True, help="Input directory containing subject dirs")
         self.add_argument("--output", required=True, help="Output directory")
         self.add_argument("--subjids", required=True, help="File containing subject IDs to process")
-        self.add_argument("--subjid-idx", type=int, help="Index of individual subject ID to process (starting at 1). If not specified, process all")        
-        self.add_argument("--skip-rcoh", action='store_true', default=False, help="Skip r_coh preprocessing step")    
+        self.add_argument("--subjid-idx", type=int, help="Index of individual subject ID to process (starting at 1). If not specified, process all")
+        self.add_argument("--subjid-range", help="Range of subject IDs to process, e.g. 21-40 (starting at 1, inclusive)")
+        self.add_argument("--jobs", type=int, default=1, help="Number of subjects to process at the same time. With more than one job, output for each subject goes to pipeline_logfile.txt in the subject output dir")
+        self.add_argument("--skip-rcoh", action='store_true', default=False, help="Skip r_coh preprocessing step")
         self.add_argument("--skip-renal-preproc", action='store_true', default=False, help="Skip renal_preproc step")
         self.add_argument("--skip-seg", action='store_true', default=False, help="Skip segmentation steps")
         self.add_argument("--skip-stats", action='store_true', default=False, help="Skip statistics generation")
+        self.add_argument("--stats-engine", choices=["native", "quantiphyse"], default="quantiphyse", help="Use Quantiphyse batch processing or native ROI statistics to run resample_and_stats.qp. The native engine has not yet been validated against Quantiphyse output")
+        self.add_argument("--regrid-cache", help="File used to share resampling index maps between subjects for native ROI statistics")
         self.add_argument("--seg-models-dir", default="/spmstore/project/RenalMRI/trained_models", help="Directory contained trained segmentation models")
+        self.add_argument("--batch-seg", action='store_true', default=False, help="Run segmentation tools which accept a list of subject IDs once for all subjects rather than once per subject")
+        self.add_argument("--max-parallel", type=int, default=1, help="Maximum number of independent steps to run at the same time for a subject")
+        self.add_argument("--no-cache", action='store_true', default=False, help="Run all steps even if the subject step manifest shows their inputs are unchanged")
+        self.add_argument("--mem-budget", type=float, help="Memory in Gb available to steps running at the same time across all subjects. Defaults to the Slurm allocation or the node's physical memory")
+        self.add_argument("--cpu-budget", type=int, help="CPUs available to steps running at the same time across all subjects. Defaults to the Slurm allocation or the CPUs available to this process")
+        self.add_argument("--scratch", help="Node-local directory to copy each subject's data to and run the steps in. Outputs of the stages run are copied back when the subject finishes")
+        self.add_argument("--no-nifti-cache", action='store_true', default=False, help="Don't keep uncompressed copies of NIfTI files read by more than one step while a subject is processed")
+        self.add_argument("--preflight", action='store_true', default=False, help="Check the input DICOM headers of each subject first, failing subjects with no input data and skipping steps whose acquisitions are missing")
+        self.add_argument("--preflight-only", action='store_true', default=False, help="Check the input of all selected subjects, write a feasibility table and exit without processing")
+        self.add_argument("--preflight-output", help="Feasibility table written by --preflight-only. Defaults to preflight.csv in the output directory")
+        self.add_argument("--profiles", help="JSON file of step resource profiles overriding the defaults, e.g. learned from previous runs with summarise_timings.py --profiles-output. Steps only have a timeout if one is given here")
+
+# Lightbox overlays of segmentations on MOLLI data: (background, segmentation, output)
+# Backgrounds and segmentations are qpdata names, outputs are relative to the seg dir.
+# Where more than one overlay has the same output only the last is rendered
+OVERLAYS = [
+    ("t1_liver_molli", "seg_liver_dixon", "seg_liver_dixon_lightbox"),
+    ("t1_liver_molli", "seg_spleen_dixon", "seg_spleen_dixon_lightbox"),
+    ("t1_pancreas_molli", "seg_pancreas_t1w", "seg_pancreas_t1w_lightbox"),
+    ("t1_kidney_molli", "seg_spleen_dixon", "seg_spleen_dixon_lightbox"),
+]
+
+# Number of voxels masks are dilated by when cleaning segmentations
+CLEAN_DILATION = 2
+
+# Operations which can be used in DERIVED_MASKS expressions
+MASK_OPS = {
+    "add" : lambda *masks: np.sum(masks, axis=0),
+    "sub" : lambda mask1, mask2: mask1 - mask2,
+    "union" : lambda *masks: np.logical_or.reduce([mask > 0 for mask in masks]).astype(np.int16),
+    "clip" : lambda mask, vmin, vmax: np.clip(mask, vmin, vmax),
+}
+
+# Segmentation tools which take a file of subject IDs and can process multiple subjects
+# in one run: step name -> (command, model, output subdir, log file)
+IDS_FILE_SEGS = {
+    "seg_pancreas_t1w" : ("infer_pancreas_t1w --action=infer", "pancreas_t1w/20200104_shape-rep-a-dice2-ep50.h5", "pancreas_t1w_sseg", "pancreas_t1_logfile.txt"),
+    "seg_liver_ideal" : ("infer_liver_ideal_multiecho --action=infer --data_modality=ideal_liver", "liver_ideal/20191002_withphase_low_liver_2d_ideal.h5", "ideal_liver_seg", "liver_ideal_logfile.txt"),
+}
+
+# Written to the NIfTI description field of R2* maps which have been converted to s^-1
+R2STAR_UNITS_MARKER = "R2* units: s^-1"
+
+# Approximate number of voxels processed at a time when converting R2*/T2* maps
+SLAB_VOXELS = 4 * 1024 * 1024
+
+# Number of R2*/T2* maps converted at the same time
+CONVERT_WORKERS = 4
+
+# Number of lightbox overlays rendered at the same time
+OVERLAY_WORKERS = 4
+
+# Characters which make a path component a wildcard pattern
+WILDCARD_CHARS = re.compile("[*?[]")
+
+# Resource profiles of steps: step name -> (memory in Gb, CPUs, timeout in seconds).
+# These are conservative starting points - profiles learned from previous runs
+# can be given with --profiles. Steps have no timeout unless one is given there.
+# Timeouts apply to the commands a step runs, not to steps implemented in Python
+RESOURCE_PROFILES = {
+    "rcoh" : (4, 1, None),
+    "renal_preproc" : (8, 1, None),
+    "seg_kidney_t1" : (4, 2, None),
+    "seg_dixon" : (16, 4, None),
+    "seg_pancreas_t1w" : (8, 2, None),
+    "seg_liver_ideal" : (8, 2, None),
+    "clean_kidney_t1" : (2, 1, None),
+    "stats" : (4, 1, None),
+}
+
+# Resource profile of steps not in RESOURCE_PROFILES
+DEFAULT_PROFILE = (2, 1, None)
+
+# Time allowed for a timed out command to exit after SIGTERM before it is sent SIGKILL
+KILL_GRACE_S = 30
+
+# Interval at which a terminated process group is checked to see if it has exited
+KILL_POLL_S = 0.1
+
+# Number of subjects whose input is checked at the same time with --preflight-only
+PREFLIGHT_WORKERS = 8
+
+# Subject output subdirectories copied back from scratch for each stage - see --scratch
+SCRATCH_OUTPUTS = {
+    "rcoh" : ["preproc", "vat"],
+    "renal_preproc" : ["preproc"],
+    "seg" : ["seg"],
+    "stats" : ["seg", "qpdata", "stats"],
+}
+
+# Files in the subject output directory copied back from scratch
+SCRATCH_FILES = ["step_manifest.json", "step_timings.json", "subjid.txt"]
+
+# Source files containing the code and tables used by steps implemented in Python.
+# They are inputs of those steps, so the steps are rerun when the code or tables change
+PYTHON_STEP_SOURCES = [os.path.abspath(f) for f in (__file__, data_sets.__file__, roi_stats.__file__)]
+
+class DirIndex:
+    """
+    Cached listings of a directory tree for resolving wildcard patterns
 
-def link(srcdir, srcfile, destdir, destfile):
+    Each directory is listed at most once, when a pattern first needs it, so
+    resolving many patterns against the same tree does not list the same
+    directories again. Patterns are matched a path component at a time with
+    the same rules as glob, including that wildcards do not match hidden names
     """
-    Link supporting wildcards
+    def __init__(self, root):
+        self.root = root
+        self._listings = {}
+
+    def _list(self, reldir):
+        """
+        :return: Mapping from entry name to True if it is a directory, empty if reldir is not a directory
+        """
+        if reldir not in self._listings:
+            try:
+                with os.scandir(os.path.join(self.root, *reldir) or os.curdir) as entries:
+                    self._listings[reldir] = {entry.name : entry.is_dir() for entry in entries}
+            except OSError:
+                self._listings[reldir] = {}
+        return self._listings[reldir]
+
+    def match(self, pattern):
+        """
+        :param pattern: Wildcard pattern relative to the root, using / to separate components
+        :return: Sorted list of matching paths
+        """
+        parts = pattern.split("/")
+        matches = [()]
+        for idx, part in enumerate(parts):
+            is_last = idx == len(parts) - 1
+            next_matches = []
+            for reldir in matches:
+                listing = self._list(reldir)
+                if WILDCARD_CHARS.search(part):
+                    names = [name for name in fnmatch.filter(listing, part) if part.startswith(".") or not name.startswith(".")]
+                else:
+                    names = [part] if part in listing else []
+                next_matches.extend(reldir + (name,) for name in names if is_last or listing[name])
+            matches = next_matches
+        return sorted(os.path.join(self.root, *path) for path in matches)
+
+def expand_patterns(patterns):
     """
-    srcfiles = list(glob.glob(os.path.join(srcdir, f"{srcfile}.nii.gz")))
-    if not srcfiles:
-        print(f"WARNING: Could not create link for output file {destfile} - source file {srcfile} not found")
-        return
-    elif len(srcfiles) > 1:
-        print(f"WARNING: Creating link for output file {destfile} - multiple source files {srcfile} found, using first")
+    Expand wildcard paths like glob, listing each directory at most once
+
+    :return: Sorted list of matching paths for each pattern
+    """
+    indexes, expanded = {}, []
+    for pattern in patterns:
+        parts = pattern.split(os.sep)
+        num_fixed = next((idx for idx, part in enumerate(parts) if WILDCARD_CHARS.search(part)), len(parts))
+        if num_fixed == len(parts):
+            expanded.append([pattern] if os.path.lexists(pattern) else [])
+            continue
+        root = os.sep.join(parts[:num_fixed]) if num_fixed != 1 or parts[0] else os.sep
+        if root not in indexes:
+            indexes[root] = DirIndex(root)
+        expanded.append(indexes[root].match("/".join(parts[num_fixed:])))
+    return expanded
+
+def link_data(subj, destdir, links=LINKS):
+    """
+    Link pipeline outputs into a directory
+
+    Each source directory is listed once and all of its link patterns are
+    resolved against the listing. Missing and ambiguous sources are reported
+    in a single warning - where there are several matches the first is used
+
+    :param links: Sequence of (Subject attribute, source pattern, output name) - see LINKS
+    :return: Tuple of (list of missing output names, list of ambiguous output names)
+    """
+    indexes, missing, ambiguous = {}, [], []
+    for srcdir, srcfile, destfile in links:
+        if srcdir not in indexes:
+            indexes[srcdir] = DirIndex(os.path.abspath(getattr(subj, srcdir)))
+        pattern = srcfile.format(preproc_subjid=subj.preproc_subjid)
+        srcfiles = indexes[srcdir].match(f"{pattern}.nii.gz")
+        if not srcfiles:
+            missing.append((destfile, f"{srcdir}/{pattern}"))
+            continue
+        elif len(srcfiles) > 1:
+            ambiguous.append((destfile, f"{srcdir}/{pattern}", srcfiles))
+        os.symlink(srcfiles[0], os.path.join(destdir, f"{destfile}.nii.gz"))
+
+    if missing or ambiguous:
+        print(f"WARNING: Linked {len(links) - len(missing)} of {len(links)} data sets for subject {subj.subjid}: {len(missing)} not found, {len(ambiguous)} ambiguous")
+        for destfile, pattern in missing:
+            print(f" - {destfile}: source file {pattern} not found")
+        for destfile, pattern, srcfiles in ambiguous:
+            print(f" - {destfile}: {len(srcfiles)} source files {pattern} found, using {srcfiles[0]}")
+    return [m[0] for m in missing], [a[0] for a in ambiguous]
+
+def derive_masks(maskdir, derived_masks=DERIVED_MASKS):
+    """
+    Create masks from arithmetic on other masks
+
+    Masks are loaded once and evaluated as integers so subtraction cannot
+    wrap around, and results are written as uint8. All masks used in an
+    expression must be on the same grid.
+
+    :param derived_masks: Sequence of (output name, expression) - see DERIVED_MASKS
+    :return: True if all masks were created
+    """
+    loaded, success = {}, True
+
+    def _load(name):
+        if name not in loaded:
+            loaded[name] = roi_stats.load_nifti(os.path.join(maskdir, f"{name}.nii.gz"))
+        return loaded[name]
 
-    os.symlink(srcfiles[0], os.path.join(destdir, f"{destfile}.nii.gz"))
+    def _eval(expr, grid):
+        if isinstance(expr, (int, float)):
+            return expr
+        elif isinstance(expr, str):
+            nii = _load(expr)
+            if grid and (nii.shape != grid[0].shape or not np.allclose(nii.affine, grid[0].affine)):
+                raise ValueError(f"Mask {expr} is not on the same grid as {grid[0].get_filename()}")
+            grid.append(nii)
+            return np.asarray(nii.dataobj).astype(np.int16)
+        op, *operands = expr
+        return MASK_OPS[op](*[_eval(operand, grid) for operand in operands])
+
+    for name, expr in derived_masks:
+        try:
+            grid = []
+            mask = _eval(expr, grid)
+            if mask.min() < 0 or mask.max() > 255:
+                print(f"WARNING: Derived mask {name} has values outside 0-255 - clipping")
+                mask = np.clip(mask, 0, 255)
+            nii = nib.Nifti1Image(mask.astype(np.uint8), grid[0].affine, grid[0].header)
+            nii.header.set_data_dtype(np.uint8)
+            nii.header.set_slope_inter(1, 0)
+            nii.to_filename(os.path.join(maskdir, f"{name}.nii.gz"))
+        except (OSError, ValueError):
+            print(f"WARNING: Failed to create derived mask {name}")
+            traceback.print_exc()
+            success = False
+    return success
+
+def clean_segs(jobs, dilation=CLEAN_DILATION, regrid_cache=None):
+    """
+    Remove segmentation voxels which lie outside a dilated mask
+
+    Equivalent to running renal-preproc-clean --dil=<dilation> for each job, but
+    each mask is loaded once and resampled and dilated once for each segmentation
+    grid it is applied to
+
+    :param jobs: Sequence of (segmentation file, mask file, output file)
+    :return: True if all segmentations were cleaned
+    """
+    if regrid_cache is None:
+        regrid_cache = roi_stats.RegridCache.shared()
+    dilated_masks, success = {}, True
+    for seg_fname, mask_fname, output_fname in jobs:
+        try:
+            seg = roi_stats.load_nifti(seg_fname)
+            seg_shape = roi_stats._spatial_shape(seg.shape)
+            mask = roi_stats.load_nifti(mask_fname)
+            mask_shape = roi_stats._spatial_shape(mask.shape)
+            key = (mask_fname, regrid_cache.key(mask.affine, mask_shape, seg.affine, seg_shape))
+            if key not in dilated_masks:
+                mask_data = (np.asarray(mask.dataobj) > 0).reshape(mask_shape)
+                mask_on_grid = regrid_cache.resample(mask_data, mask.affine, seg.affine, seg_shape)
+                dilated_masks[key] = scipy.ndimage.binary_dilation(mask_on_grid, iterations=dilation)
+
+            seg_data = np.asarray(seg.dataobj)
+            cleaned = np.where(dilated_masks[key].reshape(seg_data.shape), seg_data, 0).astype(seg_data.dtype)
+            nib.Nifti1Image(cleaned, seg.affine, seg.header).to_filename(output_fname)
+        except (OSError, ValueError):
+            print(f"WARNING: Failed to clean segmentation {seg_fname} using {mask_fname}")
+            traceback.print_exc()
+            success = False
+    regrid_cache.save()
+    return success
+
+def render_overlays(subj, jobs, cache=None, regrid_cache=None):
+    """
+    Render lightbox overlays for a subject
+
+    Each overlay is fingerprinted separately so only those whose background or
+    segmentation has changed since they were last rendered are redone
+
+    :param jobs: Sequence of (background file, segmentation file, output file)
+    :return: True if all overlays were rendered or up to date
+    """
+    todo = []
+    for bg, seg, output in overlays.dedupe_jobs(jobs):
+        step = Step(subj, f"overlay:{os.path.relpath(output, subj.outdir)}", f"overlay of {seg} on {bg}",
+                    inputs=[bg, seg, overlays.__file__] + PYTHON_STEP_SOURCES, outputs=[output])
+        digest = cache.fingerprint(step) if cache is not None else None
+        if cache is not None and cache.is_current(step, digest):
+            continue
+        todo.append(((bg, seg, output), step, digest))
+
+    success = overlays.render_overlays([job for job, _step, _digest in todo], subj.subjid,
+                                       max_workers=OVERLAY_WORKERS, regrid_cache=regrid_cache)
+    for (_bg, _seg, output), step, digest in todo:
+        if not success[output]:
+            print(f"WARNING: Failed to render overlay {output} for subject {subj.subjid}")
+        elif cache is not None:
+            cache.record(step, digest)
+    return all(success.values())
+
+def _mask_expr_names(derived_masks):
+    """
+    :return: Names of masks used by derived mask expressions which are not themselves derived
+    """
+    names, derived = [], [name for name, _expr in derived_masks]
+    def _names(expr):
+        if isinstance(expr, str):
+            if expr not in names and expr not in derived:
+                names.append(expr)
+        elif isinstance(expr, tuple):
+            for operand in expr[1:]:
+                _names(operand)
+    for _name, expr in derived_masks:
+        _names(expr)
+    return names
 
 def get_preproc_subjid(preproc_basedir):
     """
@@ -50,116 +383,626 @@ def get_preproc_subjid(preproc_basedir):
     else:
         return preproc_files[0], os.path.join(preproc_basedir, preproc_files[0])
 
-def r2star_to_t2star(indir):
+def convert_slabwise(src_fname, dest_fname, func, descrip=None):
+    """
+    Apply a voxelwise function to an image one slab at a time, writing float32 output
+
+    Slabs are taken along the last axis, which is the slowest varying on disk, so
+    output can be written in sequence without holding the whole volume in memory.
+    Input slabs are read in their stored data type. Output is written to a temporary
+    file and then moved into place, so src_fname and dest_fname can be the same.
+
+    :param func: Function taking and returning a float32 array
+    :param descrip: If specified, new value for the NIfTI description field
     """
-    Calculate T2* for any R2* maps found in indir
+    nii = nib.load(src_fname, keep_file_open=True)
+    hdr = nii.header.copy()
+    hdr.set_data_dtype(np.float32)
+    hdr.set_slope_inter(1, 0)
+    if descrip is not None:
+        hdr["descrip"] = descrip
+    out_dtype = hdr.get_data_dtype()
+    shape = nii.shape
+    slab_len = max(1, SLAB_VOXELS // max(1, int(np.prod(shape[:-1]))))
+
+    tmp_fname = os.path.join(os.path.dirname(dest_fname), f".tmp_{os.path.basename(dest_fname)}")
+    try:
+        with Opener(tmp_fname, "wb") as f:
+            hdr.write_to(f)
+            seek_tell(f, hdr.get_data_offset(), write0=True)
+            for start in range(0, shape[-1], slab_len):
+                slab = np.asarray(nii.dataobj[..., start:start+slab_len], dtype=np.float32)
+                f.write(np.asarray(func(slab), dtype=out_dtype).tobytes(order="F"))
+        os.replace(tmp_fname, dest_fname)
+    finally:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+
+def _r2star_to_t2star(slab):
+    """
+    T2* (ms) from R2* (s^-1). Voxels with zero R2* are given zero T2*
     """
-    for f in glob.glob(os.path.join(indir, "*r2star*")):
+    return np.divide(1000.0, slab, out=np.zeros_like(slab), where=slab != 0)
+
+def _is_nifti(fname):
+    return fname.endswith(".nii") or fname.endswith(".nii.gz")
+
+def _convert_files(desc, jobs, max_workers=CONVERT_WORKERS):
+    """
+    Run slabwise conversions in parallel
+
+    :param jobs: Sequence of (source, destination, function, description) tuples
+    """
+    def _convert(job):
         try:
-            f_r2star = os.path.join(indir, f)
-            f_t2star = f_r2star.replace("r2star", "t2star")
-            nii_r2star = nib.load(f_r2star)
-            nii_t2star = nib.Nifti1Image(1000.0/nii_r2star.get_fdata(), None, nii_r2star.header)
-            nii_t2star.to_filename(f_t2star)
+            convert_slabwise(*job)
         except:
-            print(f"WARNING: Failed to calculate T2* for R2* file: {f_r2star}")
+            print(f"WARNING: Failed to {desc} for file: {job[0]}")
             traceback.print_exc()
 
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(_convert, jobs))
+
+def r2star_to_t2star(indir):
+    """
+    Calculate T2* for any R2* maps found in indir, replacing any existing T2* maps
+    """
+    jobs = []
+    for f_r2star in glob.glob(os.path.join(indir, "*r2star*")):
+        f_t2star = f_r2star.replace("r2star", "t2star")
+        if not _is_nifti(f_r2star):
+            continue
+        jobs.append((f_r2star, f_t2star, _r2star_to_t2star, None))
+    _convert_files("calculate T2*", jobs)
+
 def correct_r2star_units(indir):
     """
     Convert R2* output from ms^-1 to s^-1
+
+    Converted files are marked in the NIfTI description field so the conversion
+    is never applied twice
     """
+    jobs = []
     for root, dirs, files in os.walk(indir):
         for f in files:
-            if "r2star" in f:
+            if "r2star" in f and _is_nifti(f) and not f.startswith(".tmp_"):
                 fname = os.path.join(root, f)
-                nii_r2star = nib.load(fname)
-                nii_r2star = nib.Nifti1Image(1000.0 * nii_r2star.get_fdata(), None, nii_r2star.header)
-                nii_r2star.to_filename(fname)
+                if nib.load(fname).header["descrip"].item().decode(errors="replace") == R2STAR_UNITS_MARKER:
+                    continue
+                jobs.append((fname, fname, lambda slab: 1000.0 * slab, R2STAR_UNITS_MARKER))
+    _convert_files("correct R2* units", jobs)
+
+# Resource usage of commands run by the step running in the current thread - see Step.run
+_step_usage = threading.local()
+
+def kill_group(pgid, timed_out=None, reap=False):
+    """
+    Terminate a process group, killing it if it has not exited after KILL_GRACE_S
+
+    :param timed_out: Event set when the group is signalled
+    :param reap: If True, the group leader is a child of this process which nothing
+                 else is waiting for, so it is reaped here once it exits
+    """
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(pgid, sig)
+        except ProcessLookupError:
+            return
+        if timed_out is not None:
+            timed_out.set()
+        if sig == signal.SIGTERM:
+            deadline = time.monotonic() + KILL_GRACE_S
+            while time.monotonic() < deadline:
+                if reap:
+                    try:
+                        os.waitpid(pgid, os.WNOHANG)
+                    except ChildProcessError:
+                        pass
+                try:
+                    os.killpg(pgid, 0)
+                except ProcessLookupError:
+                    return
+                time.sleep(KILL_POLL_S)
 
 def run(cmd):
     """
-    Run a command and raise exception if it fails
+    Run a command, warning if it fails
+
+    The wall time, CPU time, peak memory and exit status of the command are
+    added to the usage of the step running in the current thread, if any.
+    CPU time and peak memory come from wait4 so include child processes of the
+    command. Peak memory is never less than the memory of this process when
+    the command was started
+
+    The command runs in its own process group. If the step running in the
+    current thread has a deadline and the command is still running at the
+    deadline, the whole group is terminated so no orphaned tool processes are
+    left behind. The group is also terminated if the pipeline is interrupted
+
+    :return: Exit status of the command - 0 if successful
     """
     print(cmd)
-    retval = os.system(cmd)
-    if retval != 0:
+    start = time.monotonic()
+    proc = subprocess.Popen(cmd, shell=True, start_new_session=True)
+    timed_out, timer = threading.Event(), None
+    deadline = getattr(_step_usage, "deadline", None)
+    if deadline is not None:
+        timer = threading.Timer(max(0, deadline - start), kill_group, (proc.pid, timed_out))
+        timer.daemon = True
+        timer.start()
+    try:
+        _pid, status, rusage = os.wait4(proc.pid, 0)
+    except BaseException:
+        kill_group(proc.pid, reap=True)
+        raise
+    finally:
+        if timer is not None:
+            timer.cancel()
+    proc.returncode = retval = os.waitstatus_to_exitcode(status)
+    commands = getattr(_step_usage, "commands", None)
+    if commands is not None:
+        commands.append({
+            "wall_s" : time.monotonic() - start,
+            "cpu_user_s" : rusage.ru_utime,
+            "cpu_sys_s" : rusage.ru_stime,
+            "max_rss_mb" : rusage.ru_maxrss / 1024,
+            "exit_status" : retval,
+            "timed_out" : timed_out.is_set(),
+        })
+    if timed_out.is_set():
+        print(f"WARNING: command\n{cmd}\ntimed out after {time.monotonic() - start:.0f}s and was terminated")
+    elif retval != 0:
         print(f"WARNING: command\n{cmd}\nreturned non-zero exit state {retval}")
+    return retval
 
-def main():
-    options = ArgumentParser().parse_args()
-    with open(options.subjids, "r") as f:
-        subjids = [l.strip() for l in f.readlines()]
-    if options.subjid_idx:
-        subjids = [subjids[options.subjid_idx-1]]
+@contextlib.contextmanager
+def collect_usage(usage, timeout=None):
+    """
+    Collect the run time and resource usage of commands run in the current thread
 
-    for subjid in subjids:
-        subj_basedir = os.path.join(options.input, subjid)
-        subj_indir = os.path.join(subj_basedir, "Abdominal_MRI")
-
-        print(f"Running subject {subjid}")
-        subj_outdir = os.path.join(options.output, subjid)
-        #if os.path.isfile(os.path.join(subj_outdir, "stats", "seg_volumes.tsv")):
-        #    print(" - Stats output found - skipping")
-        #    continue
-        
-        preproc_basedir = os.path.join(subj_outdir, "preproc")
-        if not options.skip_rcoh:
-            print(f"Doing r-coh preprocessing for subject {subjid}")
-            os.makedirs(preproc_basedir, exist_ok=True)
-            run(f'r-coh.py process \
-                "{subj_indir}" \
-                "{preproc_basedir}" \
-                --biobank-project=None \
-                >"{subj_outdir}/rcoh_logfile.txt" 2>&1')
-            subjid_preproc, preproc_outdir = get_preproc_subjid(preproc_basedir)
-            os.rename(f"{subj_outdir}/rcoh_logfile.txt", f"{preproc_outdir}/rcoh_logfile.txt")
-            r2star_to_t2star(os.path.join(preproc_outdir, "analysis"))
-            print(f"DONE r-coh preprocessing for subject {subjid}")
+    :param usage: Dict which usage is added to when the context exits
+    :param timeout: Time in seconds after which commands run in the context are terminated
+    """
+    _step_usage.commands = []
+    started, start, start_cpu = time.time(), time.monotonic(), time.thread_time()
+    _step_usage.deadline = start + timeout if timeout else None
+    try:
+        yield usage
+    finally:
+        commands, _step_usage.commands, _step_usage.deadline = _step_usage.commands, None, None
+        usage.update({
+            "started" : time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(started)),
+            "wall_s" : time.monotonic() - start,
+            "python_cpu_s" : time.thread_time() - start_cpu,
+            "cpu_user_s" : sum(c["cpu_user_s"] for c in commands),
+            "cpu_sys_s" : sum(c["cpu_sys_s"] for c in commands),
+            "max_rss_mb" : max([c["max_rss_mb"] for c in commands], default=None),
+            "exit_status" : [c["exit_status"] for c in commands],
+            "timed_out" : any(c["timed_out"] for c in commands),
+        })
+
+def path_bytes(patterns):
+    """
+    :return: Total size of files matching wildcard patterns, including files in matching directories
+    """
+    total = 0
+    for paths in expand_patterns(patterns):
+        for path in paths:
+            if os.path.isdir(path):
+                for root, _dirs, files in os.walk(path):
+                    total += sum(os.path.getsize(os.path.join(root, f)) for f in files if os.path.isfile(os.path.join(root, f)))
+            elif os.path.isfile(path):
+                total += os.path.getsize(path)
+    return total
+
+class Subject:
+    """
+    Input and output locations for a subject
+
+    Locations inside the r-coh output are only available once
+    preprocessing has been run - see set_preproc()
+    """
+    def __init__(self, options, subjid):
+        self.subjid = subjid
+        self.basedir = os.path.join(options.input, subjid)
+        self.indir = os.path.join(self.basedir, "Abdominal_MRI")
+        self.outdir = os.path.join(options.output, subjid)
+        self.preproc_basedir = os.path.join(self.outdir, "preproc")
+        self.seg_outdir = os.path.join(self.outdir, "seg")
+        self.qp_data_dir = os.path.join(self.outdir, "qpdata")
+        self.vat_asat_outdir = os.path.join(self.outdir, "vat")
+
+    def set_preproc(self):
+        """
+        Identify the r-coh output directory and set locations within it
+        """
+        self.preproc_subjid, self.preproc_outdir = get_preproc_subjid(self.preproc_basedir)
+        self.renal_outdir = os.path.join(self.preproc_outdir, "renal")
+        self.nifti_dir = os.path.join(self.preproc_outdir, "nifti")
+        self.tmp_nifti_dir = os.path.join(self.preproc_outdir, "tmp", "nifti_series")
+        self.analysis_dir = os.path.join(self.preproc_outdir, "analysis")
+
+class Step:
+    """
+    A single pipeline step for a subject
+
+    Steps run either a shell command or a Python function. Dependencies
+    are given as the names of other steps for the same subject. Inputs
+    and outputs are file or directory paths (inputs may contain wildcards)
+    and describe the data the step reads and writes. Functions must return
+    True if they succeed - anything else is recorded as a failure.
+    """
+    def __init__(self, subj, name, desc, cmd=None, func=None, deps=(), inputs=(), outputs=()):
+        self.subj = subj
+        self.name = name
+        self.desc = desc
+        self.cmd = cmd
+        self.func = func
+        self.deps = list(deps)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+
+    def run(self, cache=None, timings=None, budget=None, profiles=None):
+        """
+        Run the step unless the cache shows it is up to date
+
+        :param timings: StepTimings to record the run time and resource usage in
+        :param budget: ResourceBudget the step must be admitted to before it runs
+        :param profiles: Step resource profiles - see step_profile()
+        :return: True if the step succeeded or was skipped
+        """
+        if cache is not None:
+            digest = cache.fingerprint(self)
+            if cache.is_current(self, digest):
+                print(f"Skipping {self.desc} for subject {self.subj.subjid} - inputs unchanged")
+                return True
+
+        mem_gb, cpus, timeout = step_profile(self.name, profiles)
+        waited = budget.acquire(mem_gb, cpus) if budget is not None else 0
+        print(f"Doing {self.desc} for subject {self.subj.subjid}")
+        usage, success = {"wait_s" : waited, "profile" : [mem_gb, cpus, timeout]}, False
+        try:
+            with collect_usage(usage, timeout):
+                if self.cmd is not None:
+                    success = run(self.cmd) == 0
+                else:
+                    success = self.func() is True
+        finally:
+            if budget is not None:
+                budget.release(mem_gb, cpus)
+            if timings is not None:
+                status = "timeout" if usage.get("timed_out") else "ok" if success else "failed"
+                usage.update(status=status, input_bytes=path_bytes(self.inputs), output_bytes=path_bytes(self.outputs))
+                timings.record(self, usage)
+        print(f"DONE {self.desc} for subject {self.subj.subjid}")
+
+        if cache is not None and success:
+            cache.record(self, digest)
+        return success
+
+class StepCache:
+    """
+    Per-subject manifest of step fingerprints
+
+    The fingerprint of a step is a hash of its command line and the contents of
+    its inputs (including model files). A step is up to date if it has
+    previously succeeded with the same fingerprint and its outputs still exist.
+    File content hashes are remembered against size and modification time
+    so unchanged files are not re-read on every run.
+
+    Paths are rewritten using the aliases before they are fingerprinted, so
+    a subject run in a scratch copy has the same fingerprints as when it is
+    run in place
+    """
+    def __init__(self, fname, use_cached=True, aliases=()):
+        self.fname = fname
+        self.use_cached = use_cached
+        self.aliases = list(aliases)
+        self._lock = threading.Lock()
+        self._manifest = {"steps" : {}, "files" : {}}
+        if os.path.exists(fname):
+            try:
+                with open(fname, "r") as f:
+                    self._manifest.update(json.load(f))
+            except ValueError:
+                print(f"WARNING: Ignoring invalid step manifest: {fname}")
+
+    def file_digest(self, path):
+        """
+        :return: Content hash of a file, or None if it could not be read
+        """
+        key = rewrite_paths(path, self.aliases)
+        try:
+            stat = os.stat(path)
+            with self._lock:
+                known = self._manifest["files"].get(key)
+            if known and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+                return known[2]
+            sha = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024*1024), b""):
+                    sha.update(chunk)
+        except OSError:
+            return None
+        with self._lock:
+            self._manifest["files"][key] = [stat.st_size, stat.st_mtime_ns, sha.hexdigest()]
+        return sha.hexdigest()
+
+    def fingerprint(self, step):
+        """
+        :return: Hash of the step's command line and the contents of its inputs
+        """
+        sha = hashlib.sha256()
+        sha.update(f"{step.name}\n{rewrite_paths(step.cmd or '', self.aliases)}\n".encode())
+        for pattern, paths in zip(step.inputs, expand_patterns(step.inputs)):
+            sha.update(f"{rewrite_paths(pattern, self.aliases)}\n".encode())
+            for path in paths:
+                if os.path.isdir(path):
+                    fnames = []
+                    for root, _dirs, files in os.walk(path):
+                        fnames.extend(os.path.join(root, f) for f in files)
+                else:
+                    fnames = [path]
+                for fname in sorted(fnames):
+                    sha.update(f"{rewrite_paths(fname, self.aliases)}:{self.file_digest(fname)}\n".encode())
+        return sha.hexdigest()
+
+    def is_current(self, step, digest):
+        """
+        :return: True if the step can be skipped
+        """
+        with self._lock:
+            known = self._manifest["steps"].get(step.name)
+        return self.use_cached and known == digest and all(os.path.exists(f) for f in step.outputs)
+
+    def record(self, step, digest):
+        """
+        Record that a step has succeeded and save the manifest
+        """
+        with self._lock:
+            self._manifest["steps"][step.name] = digest
+            tmp_fname = self.fname + ".tmp"
+            with open(tmp_fname, "w") as f:
+                json.dump(self._manifest, f, indent=1)
+            os.replace(tmp_fname, self.fname)
+
+class StepTimings:
+    """
+    Per-subject record of the run time and resource usage of each step
+
+    Saved as JSON after each step so that usage is recorded for subjects which
+    do not finish. Steps which are skipped because they are up to date keep
+    the record from when they last ran. See summarise_timings.py for
+    summarising records across a cohort
+    """
+    def __init__(self, fname, subjid):
+        self.fname = fname
+        self._lock = threading.Lock()
+        self._timings = {"subjid" : subjid, "steps" : {}}
+        if os.path.exists(fname):
+            try:
+                with open(fname, "r") as f:
+                    self._timings["steps"].update(json.load(f).get("steps", {}))
+            except ValueError:
+                print(f"WARNING: Ignoring invalid step timings: {fname}")
+
+    def record(self, step, usage):
+        """
+        Record the usage of a step and save the timings
+        """
+        with self._lock:
+            self._timings["steps"][step.name] = usage
+            tmp_fname = self.fname + ".tmp"
+            with open(tmp_fname, "w") as f:
+                json.dump(self._timings, f, indent=1)
+            os.replace(tmp_fname, self.fname)
+
+class ResourceBudget:
+    """
+    Memory and CPUs available to steps running at the same time
+
+    A step is admitted once its profile fits in what is left of the budget, so
+    steps from different subjects can share a node without running out of
+    memory. A step whose profile is larger than the whole budget is admitted
+    when nothing else is running. To share the budget between subject worker
+    processes it is hosted in a BudgetManager
+    """
+    def __init__(self, mem_gb, cpus):
+        self.mem_gb = mem_gb
+        self.cpus = cpus
+        self._cond = threading.Condition()
+        self._used_mem_gb, self._used_cpus, self._running = 0.0, 0, 0
+
+    def acquire(self, mem_gb, cpus):
+        """
+        Wait until a step fits in the budget and reserve its resources
+
+        :return: Time spent waiting in seconds
+        """
+        start = time.monotonic()
+        with self._cond:
+            while self._running and (self._used_mem_gb + mem_gb > self.mem_gb or self._used_cpus + cpus > self.cpus):
+                self._cond.wait()
+            self._used_mem_gb += mem_gb
+            self._used_cpus += cpus
+            self._running += 1
+        return time.monotonic() - start
+
+    def release(self, mem_gb, cpus):
+        """
+        Return the resources of a finished step to the budget
+        """
+        with self._cond:
+            self._used_mem_gb -= mem_gb
+            self._used_cpus -= cpus
+            self._running -= 1
+            self._cond.notify_all()
+
+class BudgetManager(BaseManager):
+    """
+    Server process hosting a ResourceBudget shared by subject worker processes
+    """
+
+BudgetManager.register("ResourceBudget", ResourceBudget)
+
+# Budget shared by all steps run by this process - see set_budget()
+_budget = None
+
+def set_budget(budget):
+    """
+    Set the budget used by steps run in this process, e.g. a proxy from a BudgetManager
+    """
+    global _budget
+    _budget = budget
+
+def node_budget(options):
+    """
+    :return: Tuple of (memory in Gb, CPUs) available for steps, from the options, the Slurm allocation or the node
+    """
+    mem_gb, cpus = options.mem_budget, options.cpu_budget
+    if mem_gb is None:
+        if os.environ.get("SLURM_MEM_PER_NODE"):
+            mem_gb = int(os.environ["SLURM_MEM_PER_NODE"]) / 1024
+        else:
+            mem_gb = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024**3
+    if cpus is None:
+        if os.environ.get("SLURM_CPUS_ON_NODE"):
+            cpus = int(os.environ["SLURM_CPUS_ON_NODE"])
         else:
-            subjid_preproc, preproc_outdir = get_preproc_subjid(preproc_basedir)
-        
-        renal_outdir = os.path.join(preproc_basedir, subjid_preproc, "renal")
-        with open(os.path.join(subj_outdir, "subjid.txt"), "w") as f:
-            f.write(f"{subjid_preproc}\n")
-
-        if not options.skip_renal_preproc:
-            print(f"Doing renal preprocessing for subject {subjid}")
-            os.makedirs(renal_outdir, exist_ok=True)
-            run(f'renal-preproc \
-                --indir "{preproc_outdir}/tmp/dicom_series/" \
-                --outdir "{renal_outdir}" \
+            cpus = len(os.sched_getaffinity(0))
+    return mem_gb, cpus
+
+def load_profiles(fname=None):
+    """
+    Load step resource profiles
+
+    :param fname: JSON file mapping step name to a dict with any of mem_gb, cpus and timeout_s,
+                  overriding RESOURCE_PROFILES. A timeout of null means no timeout
+    :return: Mapping from step name to (memory in Gb, CPUs, timeout in seconds)
+    """
+    profiles = dict(RESOURCE_PROFILES)
+    if fname:
+        with open(fname, "r") as f:
+            for name, profile in json.load(f).items():
+                mem_gb, cpus, timeout = profiles.get(name, DEFAULT_PROFILE)
+                profiles[name] = (profile.get("mem_gb", mem_gb), profile.get("cpus", cpus), profile.get("timeout_s", timeout))
+    return profiles
+
+def step_profile(name, profiles=None):
+    """
+    :return: Resource profile of a step as (memory in Gb, CPUs, timeout in seconds)
+    """
+    if profiles is None:
+        profiles = RESOURCE_PROFILES
+    return profiles.get(name, DEFAULT_PROFILE)
+
+def run_steps(steps, max_parallel=1, cache=None, timings=None, budget=None, profiles=None):
+    """
+    Run steps in dependency order with up to max_parallel steps running at once
+
+    Dependencies on steps which are not in the list (e.g. because they have been
+    skipped) are treated as already satisfied. As with individual commands a
+    failed step generates a warning but does not stop dependent steps from
+    running. With max_parallel=1 steps run in the order given. If a StepCache
+    is given, steps whose inputs are unchanged since they last succeeded are
+    skipped. If StepTimings are given, the usage of each step run is recorded.
+    If a ResourceBudget is given, each step waits until its resource profile
+    fits in the budget.
+    """
+    names = [step.name for step in steps]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicate step names: {names}")
+    waiting_on = {step.name : set(dep for dep in step.deps if dep in names) for step in steps}
+    max_parallel = max(1, max_parallel)
+
+    pending, running, done = list(steps), {}, set()
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        while pending or running:
+            for step in [step for step in pending if waiting_on[step.name] <= done]:
+                if len(running) >= max_parallel:
+                    break
+                pending.remove(step)
+                running[executor.submit(step.run, cache, timings, budget, profiles)] = step
+            if not running:
+                raise RuntimeError(f"Circular dependencies between steps: {[step.name for step in pending]}")
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                step = running.pop(future)
+                try:
+                    future.result()
+                except:
+                    print(f"WARNING: Step {step.name} failed for subject {step.subj.subjid}")
+                    traceback.print_exc()
+                done.add(step.name)
+
+def rcoh_steps(options, subj):
+    """
+    r-coh preprocessing, which must be run before other steps can be defined
+    """
+    def _rcoh():
+        os.makedirs(subj.preproc_basedir, exist_ok=True)
+        retval = run(f'r-coh.py process \
+            "{subj.indir}" \
+            "{subj.preproc_basedir}" \
+            --biobank-project=None \
+            >"{subj.outdir}/rcoh_logfile.txt" 2>&1')
+        if retval != 0:
+            return False
+        subj.set_preproc()
+        os.rename(f"{subj.outdir}/rcoh_logfile.txt", f"{subj.preproc_outdir}/rcoh_logfile.txt")
+        r2star_to_t2star(subj.analysis_dir)
+        return True
+
+    return [
+        Step(subj, "rcoh", "r-coh preprocessing", func=_rcoh,
+             inputs=[subj.indir], outputs=[subj.preproc_basedir]),
+    ]
+
+def renal_preproc_steps(options, subj):
+    """
+    Renal preprocessing of r-coh DICOM output
+    """
+    return [
+        Step(subj, "renal_preproc", "renal preprocessing",
+             cmd=f'renal-preproc \
+                --indir "{subj.preproc_outdir}/tmp/dicom_series/" \
+                --outdir "{subj.renal_outdir}" \
                 --t2star-matcher=_gre_ --t2star-method=all \
                 --b0-matcher=_gre_ \
                 --t1-matcher=MOLLI \
                 --overwrite \
-                >"{preproc_outdir}/renal_logfile.txt" 2>&1')
-            print(f"DONE renal preprocessing for subject {subjid}")
-
-        nifti_dir = os.path.join(preproc_outdir, "nifti")
-        tmp_nifti_dir = os.path.join(preproc_outdir, "tmp", "nifti_series")
-        analysis_dir = os.path.join(preproc_outdir, "analysis")
-
-        seg_outdir = os.path.join(subj_outdir, "seg")
-        if not options.skip_seg:
-            os.makedirs(seg_outdir, exist_ok=True)
-            
-            print(f"Doing kidney T1 segmentation for subject {subjid}")
-            kidney_t1_model = os.path.join(options.seg_models_dir, "kidney_t1_molli_zero_center.pt")
-            run(f'kidney_t1_seg \
+                >"{subj.preproc_outdir}/renal_logfile.txt" 2>&1',
+             deps=["rcoh"],
+             inputs=[os.path.join(subj.preproc_outdir, "tmp", "dicom_series")],
+             outputs=[subj.renal_outdir]),
+    ]
+
+def seg_steps(options, subj):
+    """
+    Segmentation steps, which are independent of each other and depend only on r-coh output
+    """
+    seg_outdir, nifti_dir, preproc_basedir = subj.seg_outdir, subj.nifti_dir, subj.preproc_basedir
+
+    kidney_t1_model = os.path.join(options.seg_models_dir, "kidney_t1_molli_zero_center.pt")
+    knee_to_neck_model = os.path.join(options.seg_models_dir, "knee_to_neck_dixon/20200401-mpgp118-best_xe/model.ckpt-20000")
+    dixon_inputs = [os.path.join(nifti_dir, f"{f}.nii.gz") for f in ("fat", "water", "ip", "op", "mask")]
+    return [
+        Step(subj, "seg_kidney_t1", "kidney T1 segmentation",
+             cmd=f'kidney_t1_seg \
                 --input {options.output} \
-                --t1=preproc/{subjid_preproc}/tmp/nifti_series/*ShMOLLI*kidney_T1MAP.nii.gz \
-                --subjid={subjid} \
+                --t1=preproc/{subj.preproc_subjid}/tmp/nifti_series/*ShMOLLI*kidney_T1MAP.nii.gz \
+                --subjid={subj.subjid} \
                 --model {kidney_t1_model} \
                 --preprocess zero_center \
                 --output={options.output} \
                 --outprefix=seg/kidney_t1_seg/seg_kidney \
-                >"{seg_outdir}/kidney_t1_logfile.txt" 2>&1')
-            print(f"DONE kidney T1 segmentation for subject {subjid}")
-
-            print(f"Doing DIXON segmentation for subject {subjid}")
-            knee_to_neck_model = os.path.join(options.seg_models_dir, "knee_to_neck_dixon/20200401-mpgp118-best_xe/model.ckpt-20000")
-            run(f'infer_knee_to_neck_dixon \
+                >"{seg_outdir}/kidney_t1_logfile.txt" 2>&1',
+             deps=["rcoh"],
+             inputs=[os.path.join(subj.tmp_nifti_dir, "*ShMOLLI*kidney_T1MAP.nii.gz"), kidney_t1_model],
+             outputs=[os.path.join(seg_outdir, "kidney_t1_seg")]),
+        Step(subj, "seg_dixon", "DIXON segmentation",
+             cmd=f'infer_knee_to_neck_dixon \
                 --output_folder="{seg_outdir}" \
                 --reference_header_nifti="{nifti_dir}/mask.nii.gz" \
                 --save_what=prob \
@@ -170,213 +1013,680 @@ def main():
                 --outphase={nifti_dir}/op.nii.gz \
                 --mask={nifti_dir}/mask.nii.gz \
                 --restore_string="{knee_to_neck_model}" \
-                >"{seg_outdir}/dixon_logfile.txt" 2>&1')
-            print(f"DONE DIXON segmentation for subject {subjid}")
-
-            print(f"Doing pancreas T1w segmentation for subject {subjid}")
-            pancreas_model = os.path.join(options.seg_models_dir, "pancreas_t1w/20200104_shape-rep-a-dice2-ep50.h5")
-            run(f'infer_pancreas_t1w --action=infer \
-                --output_folder={seg_outdir} \
-                --IDS_FILE={subj_outdir}/subjid.txt \
-                --model_h5_path={pancreas_model} \
-                --input_nifti_subject_dir={preproc_basedir} \
-                >"{seg_outdir}/pancreas_t1_logfile.txt" 2>&1')
-            print(f"DONE pancreas T1w segmentation for subject {subjid}")
-
-            print(f"Doing liver IDEAL segmentation for subject {subjid}")
-            liver_ideal_model = os.path.join(options.seg_models_dir, "liver_ideal/20191002_withphase_low_liver_2d_ideal.h5")
-            run(f'infer_liver_ideal_multiecho --action=infer \
-                --output_folder={seg_outdir} \
-                --data_modality=ideal_liver \
-                --IDS_FILE={subj_outdir}/subjid.txt \
-                --model_h5_path={liver_ideal_model} \
-                --input_nifti_subject_dir={preproc_basedir} \
-                >"{seg_outdir}/liver_ideal_logfile.txt" 2>&1')
-            print(f"DONE liver IDEAL segmentation for subject {subjid}")
-
-        if not options.skip_stats:
-            print(f"Linking segmentation and data sets for subject {subjid}")
-            qp_data_dir = os.path.join(subj_outdir, "qpdata")
-            if os.path.exists(qp_data_dir):
-                shutil.rmtree(qp_data_dir)
-            os.makedirs(qp_data_dir)
-
-            # Segmentations
-            link(seg_outdir, f"pancreas_t1w_sseg/{subjid_preproc}", qp_data_dir, "seg_pancreas_t1w")
-            link(seg_outdir, f"ideal_liver_seg/{subjid_preproc}", qp_data_dir, "seg_liver_ideal")
-            link(seg_outdir, f"kidney_t1_seg/seg_kidney_medulla_l_t1", qp_data_dir, "seg_kidney_medulla_l_t1")
-            link(seg_outdir, f"kidney_t1_seg/seg_kidney_cortex_l_t1", qp_data_dir, "seg_kidney_cortex_l_t1")
-            link(seg_outdir, f"kidney_t1_seg/seg_kidney_medulla_r_t1", qp_data_dir, "seg_kidney_medulla_r_t1")
-            link(seg_outdir, f"kidney_t1_seg/seg_kidney_cortex_r_t1", qp_data_dir, "seg_kidney_cortex_r_t1")
-            link(seg_outdir, f"kidney_t1_seg/seg_kidney_all_t1", qp_data_dir, "seg_kidney_all_t1")
-            link(seg_outdir, f"knee_to_neck_dixon_seg/otsu_prob_argmax_liver", qp_data_dir, "seg_liver_dixon")
-            link(seg_outdir, f"knee_to_neck_dixon_seg/otsu_prob_argmax_kidney_right", qp_data_dir, "seg_kidney_right_dixon")
-            link(seg_outdir, f"knee_to_neck_dixon_seg/otsu_prob_argmax_kidney_left", qp_data_dir, "seg_kidney_left_dixon")
-            link(seg_outdir, f"knee_to_neck_dixon_seg/otsu_prob_argmax_spleen", qp_data_dir, "seg_spleen_dixon")
-            link(seg_outdir, f"knee_to_neck_dixon_seg/otsu_prob_argmax_lungs", qp_data_dir, "seg_lungs_dixon")
-            link(seg_outdir, f"knee_to_neck_dixon_seg/otsu_prob_argmax_body_cavity", qp_data_dir, "seg_body_cavity_dixon")
-            link(seg_outdir, f"knee_to_neck_dixon_seg/otsu_prob_argmax_abdominal_cavity", qp_data_dir, "seg_abdominal_cavity_dixon")
-
-            run(f'fslmaths {qp_data_dir}/seg_kidney_right_dixon -add {qp_data_dir}/seg_kidney_left_dixon {qp_data_dir}/seg_kidney_all_dixon')
-            
-            # Preproc outputs
-            link(analysis_dir, "multiecho.pancreas_presco_t2star", qp_data_dir, "t2star_pancreas_gre_presco")
-            link(analysis_dir, "multiecho.pancreas_presco_b0", qp_data_dir, "b0_pancreas_gre_presco")
-            link(analysis_dir, "multiecho.kidney_presco_t2star", qp_data_dir, "t2star_kidney_gre_presco")
-            link(analysis_dir, "ideal.liver_presco_t2star", qp_data_dir, "t2star_liver_ideal_presco")
-            link(analysis_dir, "ideal.liver_presco_b0", qp_data_dir, "b0_liver_ideal_presco")
-            link(analysis_dir, "multiecho.pancreas_presco_r2star", qp_data_dir, "r2star_pancreas_gre_presco")
-            link(analysis_dir, "multiecho.kidney_presco_r2star", qp_data_dir, "r2star_kidney_gre_presco")
-            link(analysis_dir, "ideal.liver_presco_r2star", qp_data_dir, "r2star_liver_ideal_presco")
-            link(analysis_dir, "multiecho.pancreas_presco_iron", qp_data_dir, "iron_pancreas_gre_presco")
-            link(analysis_dir, "multiecho.kidney_presco_iron", qp_data_dir, "iron_kidney_gre_presco")
-            link(analysis_dir, "ideal.liver_presco_iron", qp_data_dir, "iron_liver_ideal_presco")
-            link(analysis_dir, "multiecho.pancreas_presco_pdff", qp_data_dir, "pdff_pancreas_gre_presco")
-            link(analysis_dir, "multiecho.kidney_presco_pdff", qp_data_dir, "pdff_kidney_gre_presco")
-            link(analysis_dir, "ideal.liver_presco_pdff", qp_data_dir, "pdff_liver_ideal_presco")
-            link(analysis_dir, "fat.percent", qp_data_dir, "fat_fraction")
-            link(tmp_nifti_dir, "*_ShMOLLI_*LIVER_T1MAP", qp_data_dir, "t1_liver_molli")
-            link(tmp_nifti_dir, "*_ShMOLLI_*pancreas_T1MAP", qp_data_dir, "t1_pancreas_molli")
-            link(tmp_nifti_dir, "*_ShMOLLI_*kidney_T1MAP", qp_data_dir, "t1_kidney_molli")
-
-            
-            # Parameter maps
-            #link(nifti_dir, "multiecho_pancreas_magnitude", qp_data_dir, "multiecho_pancreas")
-            #link(nifti_dir, "ideal_liver_magnitude", qp_data_dir, "multiecho_liver")
-
-            # Renal preproc outputs
-            link(renal_outdir, "*_gre_*_pancreas*/t2star_out/map_t2star_*_loglin", qp_data_dir, "t2star_pancreas_gre_loglin")
-            link(renal_outdir, "*_gre_*_pancreas*/t2star_out/map_r2star_*_loglin", qp_data_dir, "r2star_pancreas_gre_loglin")
-            link(renal_outdir, "*_gre_*_pancreas*/t2star_out/map_t2star_*_exp", qp_data_dir, "t2star_pancreas_gre_exp")
-            link(renal_outdir, "*_gre_*_pancreas*/t2star_out/map_r2star_*_exp", qp_data_dir, "r2star_pancreas_gre_exp")
-            link(renal_outdir, "*_gre_*_kidney*/t2star_out/map_t2star_*_loglin", qp_data_dir, "t2star_kidney_gre_loglin")
-            link(renal_outdir, "*_gre_*_kidney*/t2star_out/map_r2star_*_loglin", qp_data_dir, "r2star_kidney_gre_loglin")
-            link(renal_outdir, "*_gre_*_kidney*/t2star_out/map_t2star_*_exp", qp_data_dir, "t2star_kidney_gre_exp")
-            link(renal_outdir, "*_gre_*_kidney*/t2star_out/map_r2star_*_exp", qp_data_dir, "r2star_kidney_gre_exp")
-            link(renal_outdir, "*_gre_*_liver*/t2star_out/map_t2star_*_loglin", qp_data_dir, "t2star_liver_gre_loglin")
-            link(renal_outdir, "*_gre_*_liver*/t2star_out/map_r2star_*_loglin", qp_data_dir, "r2star_liver_gre_loglin")
-            link(renal_outdir, "*_gre_*_liver*/t2star_out/map_t2star_*_exp", qp_data_dir, "t2star_liver_gre_exp")
-            link(renal_outdir, "*_gre_*_liver*/t2star_out/map_r2star_*_exp", qp_data_dir, "r2star_liver_gre_exp")
-
-            # VAT/ASAT outputs
-            vat_asat_outdir = os.path.join(subj_outdir, "vat")
-            link(vat_asat_outdir, "vat/vat", qp_data_dir, "vat")
-            link(vat_asat_outdir, "asat/asat", qp_data_dir, "asat")
-
-            print(f"DONE Linking segmentation and data sets for subject {subjid}")
-
-            print(f"Doing overlays of segmentations on MOLLI data for subject {subjid}")
-            run(f'renal-preproc-overlay \
-                --bg={qp_data_dir}/t1_liver_molli.nii.gz \
-                --seg={qp_data_dir}/seg_liver_dixon.nii.gz \
-                --output={seg_outdir}/seg_liver_dixon_lightbox.png \
-                --subjid={subjid} --overwrite \
-                >"{seg_outdir}/seg_liver_dixon_lightbox.txt" 2>&1')
-            run(f'renal-preproc-overlay \
-                --bg={qp_data_dir}/t1_liver_molli.nii.gz \
-                --seg={qp_data_dir}/seg_spleen_dixon.nii.gz \
-                --output={seg_outdir}/seg_spleen_dixon_lightbox.png \
-                --subjid={subjid} --overwrite  \
-                >"{seg_outdir}/seg_spleen_dixon_lightbox.txt" 2>&1')
-            run(f'renal-preproc-overlay \
-                --bg={qp_data_dir}/t1_pancreas_molli.nii.gz \
-                --seg={qp_data_dir}/seg_pancreas_t1w.nii.gz \
-                --output={seg_outdir}/seg_pancreas_t1w_lightbox.png \
-                --subjid={subjid} --overwrite  \
-                >"{seg_outdir}/seg_pancreas_t1w_lightbox.txt" 2>&1')
-            run(f'renal-preproc-overlay \
-                --bg={qp_data_dir}/t1_kidney_molli.nii.gz \
-                --seg={qp_data_dir}/seg_spleen_dixon.nii.gz \
-                --output={seg_outdir}/seg_spleen_dixon_lightbox.png \
-                --subjid={subjid} --overwrite  \
-                >"{seg_outdir}/seg_spleen_dixon_lightbox.txt" 2>&1')
-            print(f"DONE overlays of segmentations on MOLLI data for subject {subjid}")
-
-            print(f"Cleaning T1 segmentation using DIXON kidney segs for subject {subjid}")
-            run(f'renal-preproc-clean \
-                --seg={seg_outdir}/kidney_t1_seg/seg_kidney_medulla_l_orig_t1.nii.gz \
-                --mask={qp_data_dir}/seg_kidney_left_dixon.nii.gz \
-                --dil=2 \
-                --output={qp_data_dir}/seg_kidney_medulla_l_t1_clean.nii.gz \
-                --overwrite \
-                >"{seg_outdir}/kidney_t1_seg/seg_kidney_medulla_l_t1_clean.txt" 2>&1')
-            run(f'renal-preproc-overlay \
-                --bg={qp_data_dir}/t1_kidney_molli.nii.gz \
-                --seg={qp_data_dir}/seg_kidney_medulla_l_t1_clean.nii.gz \
-                --output={seg_outdir}/kidney_t1_seg/seg_kidney_medulla_l_t1_clean_lightbox.png \
-                --subjid={subjid} --overwrite \
-                >"{seg_outdir}/kidney_t1_seg/seg_kidney_medulla_l_t1_clean_lightbox.txt" 2>&1')
-            run(f'renal-preproc-clean \
-                --seg={seg_outdir}/kidney_t1_seg/seg_kidney_medulla_r_orig_t1.nii.gz \
-                --mask={qp_data_dir}/seg_kidney_right_dixon.nii.gz \
-                --dil=2 \
-                --output={qp_data_dir}/seg_kidney_medulla_r_t1_clean.nii.gz \
-                --overwrite \
-                >"{seg_outdir}/kidney_t1_seg/seg_kidney_medulla_r_t1_clean.txt" 2>&1')
-            run(f'renal-preproc-overlay \
-                --bg={qp_data_dir}/t1_kidney_molli.nii.gz \
-                --seg={qp_data_dir}/seg_kidney_medulla_r_t1_clean.nii.gz \
-                --output={seg_outdir}/kidney_t1_seg/seg_kidney_medulla_r_t1_clean_lightbox.png \
-                --subjid={subjid} --overwrite \
-                >"{seg_outdir}/kidney_t1_seg/seg_kidney_medulla_r_t1_clean_lightbox.txt" 2>&1')
-            run(f'renal-preproc-clean \
-                --seg={seg_outdir}/kidney_t1_seg/seg_kidney_cortex_l_orig_t1.nii.gz \
-                --mask={qp_data_dir}/seg_kidney_left_dixon.nii.gz \
-                --dil=2 \
-                --output={qp_data_dir}/seg_kidney_cortex_l_t1_clean.nii.gz \
-                --overwrite \
-                >"{seg_outdir}/kidney_t1_seg/seg_kidney_cortex_l_t1_clean.txt" 2>&1')
-            run(f'renal-preproc-overlay \
-                --bg={qp_data_dir}/t1_kidney_molli.nii.gz \
-                --seg={qp_data_dir}/seg_kidney_cortex_l_t1_clean.nii.gz \
-                --output={seg_outdir}/kidney_t1_seg/seg_kidney_cortex_l_t1_clean_lightbox.png \
-                --subjid={subjid} --overwrite \
-                >"{seg_outdir}/kidney_t1_seg/seg_kidney_cortex_l_t1_clean_lightbox.txt" 2>&1')
-            run(f'renal-preproc-clean \
-                --seg={seg_outdir}/kidney_t1_seg/seg_kidney_cortex_r_orig_t1.nii.gz \
-                --mask={qp_data_dir}/seg_kidney_right_dixon.nii.gz \
-                --dil=2 \
-                --output={qp_data_dir}/seg_kidney_cortex_r_t1_clean.nii.gz \
-                --overwrite \
-                >"{seg_outdir}/kidney_t1_seg/seg_kidney_cortex_r_t1_clean.txt" 2>&1')
-            run(f'renal-preproc-overlay \
-                --bg={qp_data_dir}/t1_kidney_molli.nii.gz \
-                --seg={qp_data_dir}/seg_kidney_cortex_r_t1_clean.nii.gz \
-                --output={seg_outdir}/kidney_t1_seg/seg_kidney_cortex_r_t1_clean_lightbox.png \
-                --subjid={subjid} --overwrite \
-                >"{seg_outdir}/kidney_t1_seg/seg_kidney_cortex_r_t1_clean_lightbox.txt" 2>&1')
-            
-            run(f'renal-preproc-clean \
-                --seg={seg_outdir}/kidney_t1_seg/seg_kidney_all_t1.nii.gz \
-                --mask={qp_data_dir}/seg_kidney_all_dixon.nii.gz \
-                --dil=2 \
-                --output={qp_data_dir}/seg_kidney_all_t1_clean.nii.gz \
-                --overwrite \
-                >"{seg_outdir}/kidney_t1_seg/seg_kidney_all_t1_clean.txt" 2>&1')
-            run(f'renal-preproc-overlay \
-                --bg={qp_data_dir}/t1_kidney_molli.nii.gz \
-                --seg={qp_data_dir}/seg_kidney_all_t1_clean.nii.gz \
-                --output={seg_outdir}/kidney_t1_seg/seg_kidney_all_t1_clean_lightbox.png \
-                --subjid={subjid} --overwrite \
-                >"{seg_outdir}/kidney_t1_seg/seg_kidney_all_t1_clean_lightbox.txt" 2>&1')
-            
-            print(f"DONE Cleaning T1 segmentation using DIXON kidney segs for subject {subjid}")
-
-            print(f"Extracting ROI stats for subject {subjid}")
-            qp_script = os.path.join(os.path.dirname(sys.argv[0]), "resample_and_stats.qp")
-            subj_qp_script = os.path.join(qp_data_dir, "resample_and_stats.qp")
-            if os.path.exists(subj_qp_script):
-                os.remove(subj_qp_script, exist_ok=True)
-            with open(qp_script, "r") as f:
-                with open(subj_qp_script, "w") as of:
-                    for line in f.readlines():
-                        of.write(line.replace("SUBJID", subjid).replace("OUTDIR", options.output))
-            run(f'quantiphyse \
-                --batch={qp_data_dir}/resample_and_stats.qp  \
-                >"{qp_data_dir}/qp_logfile.txt" 2>&1')
-            print(f"DONE Extracting ROI stats for subject {subjid}")
-
-        print(f"DONE running subject {subjid}")
+                >"{seg_outdir}/dixon_logfile.txt" 2>&1',
+             deps=["rcoh"],
+             inputs=dixon_inputs + [f"{knee_to_neck_model}*"],
+             outputs=[os.path.join(seg_outdir, "knee_to_neck_dixon_seg")]),
+        Step(subj, "seg_pancreas_t1w", "pancreas T1w segmentation",
+             cmd=ids_file_seg_cmd(options, "seg_pancreas_t1w", seg_outdir, f"{subj.outdir}/subjid.txt", preproc_basedir),
+             deps=["rcoh"],
+             inputs=[nifti_dir, ids_file_seg_model(options, "seg_pancreas_t1w")],
+             outputs=[os.path.join(seg_outdir, IDS_FILE_SEGS["seg_pancreas_t1w"][2])]),
+        Step(subj, "seg_liver_ideal", "liver IDEAL segmentation",
+             cmd=ids_file_seg_cmd(options, "seg_liver_ideal", seg_outdir, f"{subj.outdir}/subjid.txt", preproc_basedir),
+             deps=["rcoh"],
+             inputs=[nifti_dir, ids_file_seg_model(options, "seg_liver_ideal")],
+             outputs=[os.path.join(seg_outdir, IDS_FILE_SEGS["seg_liver_ideal"][2])]),
+    ]
+
+def ids_file_seg_model(options, name):
+    """
+    :return: Path to the model used by a segmentation tool that takes a subject IDs file
+    """
+    return os.path.join(options.seg_models_dir, IDS_FILE_SEGS[name][1])
+
+def ids_file_seg_cmd(options, name, output_folder, ids_file, input_dir):
+    """
+    :return: Command line for a segmentation tool that takes a subject IDs file
+    """
+    cmd, _model, _subdir, logfile = IDS_FILE_SEGS[name]
+    return f'{cmd} \
+        --output_folder={output_folder} \
+        --IDS_FILE={ids_file} \
+        --model_h5_path={ids_file_seg_model(options, name)} \
+        --input_nifti_subject_dir={input_dir} \
+        >"{output_folder}/{logfile}" 2>&1'
+
+def batch_output_subject(relpath, preproc_subjids):
+    """
+    :param relpath: Path of a file output by a batch segmentation relative to the batch output dir
+    :param preproc_subjids: Preprocessing subject IDs in the batch
+    :return: Preprocessing subject ID the file belongs to, or None. Subject IDs may contain
+             dots so a file belongs to the subject with the longest ID which is a directory
+             in its path or is a whole prefix of its file name
+    """
+    parts = relpath.split(os.sep)
+    for part in parts[:-1]:
+        if part in preproc_subjids:
+            return part
+    matches = [preproc_subjid for preproc_subjid in preproc_subjids if re.match(re.escape(preproc_subjid) + r"($|[._-])", parts[-1])]
+    return max(matches, key=len) if matches else None
+
+def run_batch_seg(options, subjids, checks=None):
+    """
+    Run segmentation tools which take a subject IDs file once for a batch of subjects
+
+    Subjects whose segmentation is up to date according to their step manifest,
+    or which the pre-flight check shows cannot be segmented, are left out of the
+    batch. The subjects' preprocessing output directories are linked into a
+    single input directory, and the tool output and log are then moved into each
+    subject's seg dir in the same layout as a per-subject run. A subject's previous
+    output is only replaced when the batch produced new output for it. Each batch uses its
+    own temporary directory so array tasks sharing an output directory can run
+    batches at the same time
+
+    :param checks: Mapping from subject ID to pre-flight check for subjects already checked
+    """
+    subjs, infeasible, checks = [], {}, checks or {}
+    for subjid in subjids:
+        subj = Subject(options, subjid)
+        try:
+            subj.set_preproc()
+            subjs.append(subj)
+        except (OSError, RuntimeError) as exc:
+            print(f"WARNING: Subject {subjid} not included in batch segmentation: {exc}")
+            continue
+        if options.preflight:
+            check = checks.get(subjid) or preflight.check_subject(subj.indir, qpdata_names())
+            infeasible[subjid] = check["infeasible_steps"]
+
+    for name in IDS_FILE_SEGS:
+        batch = []
+        for subj in subjs:
+            if name in infeasible.get(subj.subjid, ()):
+                continue
+            step = [step for step in seg_steps(options, subj) if step.name == name][0]
+            cache = StepCache(os.path.join(subj.outdir, "step_manifest.json"), use_cached=not options.no_cache)
+            digest = cache.fingerprint(step)
+            if cache.is_current(step, digest):
+                print(f"Skipping {step.desc} for subject {subj.subjid} - inputs unchanged")
+            else:
+                batch.append((subj, step, cache, digest))
+        if not batch:
+            continue
+
+        batch_dir = tempfile.mkdtemp(dir=options.output, prefix=f"seg_batch_{name}_")
+        try:
+            input_dir, output_dir = os.path.join(batch_dir, "preproc"), os.path.join(batch_dir, "output")
+            os.makedirs(input_dir)
+            os.makedirs(output_dir)
+            with open(os.path.join(batch_dir, "subjids.txt"), "w") as f:
+                for subj, _step, _cache, _digest in batch:
+                    os.symlink(os.path.abspath(subj.preproc_outdir), os.path.join(input_dir, subj.preproc_subjid))
+                    f.write(f"{subj.preproc_subjid}\n")
+
+            desc = batch[0][1].desc
+            print(f"Doing {desc} for {len(batch)} subjects")
+            with collect_usage({"batch_size" : len(batch)}) as usage:
+                retval = run(ids_file_seg_cmd(options, name, output_dir, os.path.join(batch_dir, "subjids.txt"), input_dir))
+            print(f"DONE {desc} for {len(batch)} subjects")
+
+            new_outputs = collections.defaultdict(list)
+            for root, _dirs, files in os.walk(output_dir):
+                for f in files:
+                    relpath = os.path.relpath(os.path.join(root, f), output_dir)
+                    preproc_subjid = batch_output_subject(relpath, [subj.preproc_subjid for subj, _step, _cache, _digest in batch])
+                    if preproc_subjid is not None:
+                        new_outputs[preproc_subjid].append(relpath)
+
+            for subj, step, cache, digest in batch:
+                logfile = os.path.join(output_dir, IDS_FILE_SEGS[name][3])
+                if os.path.exists(logfile):
+                    shutil.copyfile(logfile, os.path.join(subj.seg_outdir, IDS_FILE_SEGS[name][3]))
+                relpaths = new_outputs.get(subj.preproc_subjid, [])
+                success = retval == 0 and bool(relpaths)
+                if success:
+                    for path in glob.glob(os.path.join(subj.seg_outdir, IDS_FILE_SEGS[name][2], f"{subj.preproc_subjid}*")):
+                        _remove(path)
+                    for relpath in relpaths:
+                        os.makedirs(os.path.dirname(os.path.join(subj.seg_outdir, relpath)), exist_ok=True)
+                        os.replace(os.path.join(output_dir, relpath), os.path.join(subj.seg_outdir, relpath))
+                    cache.record(step, digest)
+                elif retval == 0:
+                    print(f"WARNING: No output from {desc} for subject {subj.subjid} - previous output kept")
+                StepTimings(os.path.join(subj.outdir, "step_timings.json"), subj.subjid).record(step, dict(usage,
+                    status="ok" if success else "failed", input_bytes=path_bytes(step.inputs), output_bytes=path_bytes(step.outputs)))
+        finally:
+            shutil.rmtree(batch_dir)
+
+def stats_steps(options, subj, cache=None):
+    """
+    Linking of data into qpdata, overlays, mask cleaning and ROI statistics
+
+    :param cache: StepCache used to skip individual overlays which are up to date
+    """
+    seg_outdir, qp_data_dir = subj.seg_outdir, subj.qp_data_dir
+    kidney_t1_outdir = os.path.join(seg_outdir, "kidney_t1_seg")
+
+    def _link():
+        if os.path.exists(qp_data_dir):
+            shutil.rmtree(qp_data_dir)
+        os.makedirs(qp_data_dir)
+        link_data(subj, qp_data_dir)
+        return True
+
+    qp_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resample_and_stats.qp")
+
+    def _native_stats():
+        return roi_stats.run_batch(qp_script, qp_data_dir, os.path.join(subj.outdir, "stats"), roi_stats.RegridCache.shared(options.regrid_cache))
+
+    def _qp_stats():
+        subj_qp_script = os.path.join(qp_data_dir, "resample_and_stats.qp")
+        if os.path.exists(subj_qp_script):
+            os.remove(subj_qp_script)
+        with open(qp_script, "r") as f:
+            with open(subj_qp_script, "w") as of:
+                for line in f.readlines():
+                    of.write(line.replace("SUBJID", subj.subjid).replace("OUTDIR", options.output))
+        return run(f'quantiphyse \
+            --batch={qp_data_dir}/resample_and_stats.qp  \
+            >"{qp_data_dir}/qp_logfile.txt" 2>&1') == 0
+
+    link_inputs = [
+        os.path.join(getattr(subj, srcdir), srcfile.format(preproc_subjid=subj.preproc_subjid) + ".nii.gz")
+        for srcdir, srcfile, _destfile in LINKS
+    ]
+    steps = [
+        Step(subj, "link", "linking segmentation and data sets", func=_link,
+             deps=["rcoh", "renal_preproc", "seg_kidney_t1", "seg_dixon", "seg_pancreas_t1w", "seg_liver_ideal"],
+             inputs=link_inputs + PYTHON_STEP_SOURCES, outputs=[qp_data_dir]),
+        Step(subj, "derived_masks", "derived DIXON masks", func=lambda: derive_masks(qp_data_dir),
+             deps=["link"],
+             inputs=[os.path.join(qp_data_dir, f"{name}.nii.gz") for name in _mask_expr_names(DERIVED_MASKS)] + PYTHON_STEP_SOURCES,
+             outputs=[os.path.join(qp_data_dir, f"{name}.nii.gz") for name, _expr in DERIVED_MASKS]),
+    ]
+
+    overlay_jobs = [
+        (os.path.join(qp_data_dir, f"{bg}.nii.gz"), os.path.join(qp_data_dir, f"{seg}.nii.gz"), os.path.join(seg_outdir, f"{output}.png"))
+        for bg, seg, output in OVERLAYS
+    ]
+    steps.append(Step(subj, "overlays", "lightbox overlays of segmentations",
+         func=lambda: render_overlays(subj, overlay_jobs, cache, roi_stats.RegridCache.shared(options.regrid_cache)),
+         deps=["link"],
+         inputs=[f for job in overlay_jobs for f in job[:2]] + [overlays.__file__] + PYTHON_STEP_SOURCES,
+         outputs=[output for _bg, _seg, output in overlay_jobs]))
+
+    clean_jobs = [
+        (os.path.join(kidney_t1_outdir, f"{seg}.nii.gz"), os.path.join(qp_data_dir, f"{mask}.nii.gz"), os.path.join(qp_data_dir, f"{output}.nii.gz"))
+        for seg, mask, output in KIDNEY_T1_CLEAN
+    ]
+    steps.append(Step(subj, "clean_kidney_t1", "cleaning T1 segmentation using DIXON kidney segs",
+         func=lambda: clean_segs(clean_jobs, regrid_cache=roi_stats.RegridCache.shared(options.regrid_cache)),
+         deps=["link", "derived_masks"],
+         inputs=[f for seg, mask, _output in clean_jobs for f in (seg, mask)] + PYTHON_STEP_SOURCES,
+         outputs=[output for _seg, _mask, output in clean_jobs]))
+
+    clean_overlay_jobs = [
+        (os.path.join(qp_data_dir, "t1_kidney_molli.nii.gz"), os.path.join(qp_data_dir, f"{clean_seg}.nii.gz"), os.path.join(kidney_t1_outdir, f"{clean_seg}_lightbox.png"))
+        for _seg, _mask, clean_seg in KIDNEY_T1_CLEAN
+    ]
+    steps.append(Step(subj, "overlays_kidney_t1_clean", "lightbox overlays of cleaned T1 segmentations",
+         func=lambda: render_overlays(subj, clean_overlay_jobs, cache, roi_stats.RegridCache.shared(options.regrid_cache)),
+         deps=["clean_kidney_t1"],
+         inputs=[f for job in clean_overlay_jobs for f in job[:2]] + [overlays.__file__] + PYTHON_STEP_SOURCES,
+         outputs=[output for _bg, _seg, output in clean_overlay_jobs]))
+
+    if options.stats_engine == "native":
+        stats_func, stats_inputs = _native_stats, PYTHON_STEP_SOURCES
+    else:
+        stats_func, stats_inputs = _qp_stats, []
+    steps.append(Step(subj, "stats", "extraction of ROI stats", func=stats_func,
+         deps=["link", "derived_masks", "clean_kidney_t1"],
+         inputs=[os.path.join(qp_data_dir, "*.nii.gz"), qp_script] + stats_inputs,
+         outputs=[os.path.join(subj.outdir, "stats", "seg_volumes.tsv")]))
+    return steps
+
+def get_stages(options):
+    """
+    :return: Pipeline stages selected by the command line options
+    """
+    stages = []
+    if not options.skip_rcoh:
+        stages.append("rcoh")
+    if not options.skip_renal_preproc:
+        stages.append("renal_preproc")
+    if not options.skip_seg:
+        stages.append("seg")
+    if not options.skip_stats:
+        stages.append("stats")
+    return stages
+
+def rewrite_paths(text, rewrites):
+    """
+    Old paths are only replaced where they are followed by a path separator, a
+    quote, whitespace or the end of the text, so /out/HC does not match /out/HC2.
+    Where old paths overlap the longest is replaced
+
+    :param rewrites: Sequence of (old path, new path)
+    :return: Text with the old paths replaced by the new paths
+    """
+    rewrites = dict(rewrites)
+    if not rewrites:
+        return text
+    olds = sorted(rewrites, key=len, reverse=True)
+    pattern = "(" + "|".join(re.escape(old) for old in olds) + ")" + r"(?=" + re.escape(os.sep) + r"|[\"'\s]|$)"
+    return re.sub(pattern, lambda match: rewrites[match.group(1)], text)
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+def sync_tree(src, dest, rewrites=()):
+    """
+    Make dest a copy of src, copying only files whose size or modification time differ
+
+    Files in dest which are not in src are removed. Symlinks are copied as
+    symlinks with their targets rewritten, so links within a subject's data
+    point to the copy
+
+    :param rewrites: Sequence of (old path, new path) applied to symlink targets
+    :return: Number of bytes copied
+    """
+    copied = 0
+    for root, dirs, files in os.walk(src):
+        dest_root = os.path.normpath(os.path.join(dest, os.path.relpath(root, src)))
+        if os.path.lexists(dest_root) and (os.path.islink(dest_root) or not os.path.isdir(dest_root)):
+            _remove(dest_root)
+        os.makedirs(dest_root, exist_ok=True)
+        for name in set(os.listdir(dest_root)) - set(dirs) - set(files):
+            _remove(os.path.join(dest_root, name))
+
+        for name in dirs + files:
+            src_path, dest_path = os.path.join(root, name), os.path.join(dest_root, name)
+            if os.path.islink(src_path):
+                target = rewrite_paths(os.readlink(src_path), rewrites)
+                if os.path.islink(dest_path) and os.readlink(dest_path) == target:
+                    continue
+                if os.path.lexists(dest_path):
+                    _remove(dest_path)
+                os.symlink(target, dest_path)
+            elif name in files:
+                src_stat = os.stat(src_path)
+                if os.path.islink(dest_path) or os.path.isdir(dest_path):
+                    _remove(dest_path)
+                elif os.path.exists(dest_path):
+                    dest_stat = os.stat(dest_path)
+                    if (src_stat.st_size, src_stat.st_mtime_ns) == (dest_stat.st_size, dest_stat.st_mtime_ns):
+                        continue
+                shutil.copy2(src_path, dest_path)
+                copied += src_stat.st_size
+    return copied
+
+def scratch_options(options, subjid):
+    """
+    :return: Copy of the options with input and output in the subject's scratch directory
+    """
+    scratch_dir = os.path.abspath(os.path.join(options.scratch, subjid))
+    return argparse.Namespace(**dict(
+        vars(options),
+        input=os.path.join(scratch_dir, "input"),
+        output=os.path.join(scratch_dir, "output"),
+        scratch=None,
+        preflight=False,
+        staged_from=options,
+    ))
+
+def scratch_rewrites(options, subjid):
+    """
+    The scratch input and output directories only contain the one subject, so
+    the whole directories are mapped, as some commands are given the output
+    directory rather than the subject's output directory
+
+    Original paths are made absolute, as symlink targets and fingerprints must
+    not depend on the directory the pipeline was started in
+
+    :param options: Options for a subject staged to scratch
+    :return: Sequence of (scratch path, original path) for the input and output directories
+    """
+    staged_from = getattr(options, "staged_from", None)
+    if staged_from is None:
+        return []
+    return [(options.output, os.path.abspath(staged_from.output)), (options.input, os.path.abspath(staged_from.input))]
+
+def stage_in(options, subjid, stages):
+    """
+    Copy a subject's input data (if r-coh is to be run) and existing output to scratch
+
+    :return: Options for running the subject in scratch
+    """
+    subj_options = scratch_options(options, subjid)
+    rewrites = [(orig, subj) for subj, orig in scratch_rewrites(subj_options, subjid)]
+    subj, orig = Subject(subj_options, subjid), Subject(options, subjid)
+    start, copied = time.monotonic(), 0
+    if "rcoh" in stages and os.path.isdir(orig.indir):
+        copied += sync_tree(orig.indir, subj.indir, rewrites)
+    if os.path.isdir(orig.outdir):
+        copied += sync_tree(orig.outdir, subj.outdir, rewrites)
+    print(f"Staged subject {subjid} to scratch: {copied / 1024**2:.1f}Mb in {time.monotonic() - start:.1f}s")
+    return subj_options
+
+def stage_out(subj_options, subjid, stages):
+    """
+    Copy the outputs of the stages run for a subject back from scratch
+    """
+    rewrites = scratch_rewrites(subj_options, subjid)
+    subj, orig = Subject(subj_options, subjid), Subject(subj_options.staged_from, subjid)
+    start, copied = time.monotonic(), 0
+    for subdir in sorted(set(d for stage in stages for d in SCRATCH_OUTPUTS.get(stage, []))):
+        if os.path.isdir(os.path.join(subj.outdir, subdir)):
+            copied += sync_tree(os.path.join(subj.outdir, subdir), os.path.join(orig.outdir, subdir), rewrites)
+    os.makedirs(orig.outdir, exist_ok=True)
+    for fname in SCRATCH_FILES:
+        if os.path.exists(os.path.join(subj.outdir, fname)):
+            shutil.copy2(os.path.join(subj.outdir, fname), os.path.join(orig.outdir, fname))
+    print(f"Copied subject {subjid} output back from scratch: {copied / 1024**2:.1f}Mb in {time.monotonic() - start:.1f}s")
+
+def cleanup_scratch(options, subjid, staged=None):
+    """
+    Remove a subject's scratch copy
+
+    :param staged: Future staging the subject to scratch, which is waited for so
+                   a copy still being made is not left behind
+    """
+    if staged is not None:
+        wait([staged])
+    shutil.rmtree(os.path.abspath(os.path.join(options.scratch, subjid)), ignore_errors=True)
+
+def nifti_cache_dir(options, subjid):
+    """
+    :return: Directory for a subject's NiftiCache - in scratch if the subject is staged, otherwise the temporary directory
+    """
+    if getattr(options, "staged_from", None) is not None:
+        return os.path.join(os.path.dirname(options.output), "nifti_cache")
+    return os.path.join(tempfile.gettempdir(), f"demistifi_nifti_cache_{subjid}_{os.getpid()}")
+
+def preflight_checks(options, subjids):
+    """
+    Check the input DICOM headers of subjects
+
+    :return: Mapping from subject ID to preflight.check_subject() result
+    """
+    names = qpdata_names()
+    with ThreadPoolExecutor(max_workers=PREFLIGHT_WORKERS) as executor:
+        return dict(zip(subjids, executor.map(lambda subjid: preflight.check_subject(Subject(options, subjid).indir, names), subjids)))
+
+def preflight_subject(options, subjid, stages, check=None):
+    """
+    Check a subject's input DICOM headers before any steps are run
+
+    :param check: Result of preflight.check_subject() if the subject has already been checked
+    :return: Names of steps which cannot run because the acquisitions they use are missing
+    """
+    indir = Subject(options, subjid).indir
+    names = qpdata_names()
+    if check is None:
+        check = preflight.check_subject(indir, names)
+    if check["status"] == "no_input":
+        if "rcoh" in stages:
+            raise RuntimeError(f"Pre-flight check failed - no DICOM data found in {indir}")
+        print(f"WARNING: Pre-flight check found no DICOM data for subject {subjid} - using existing preprocessing output")
+    elif check["status"] == "unknown" and check["unidentified"]:
+        print(f"WARNING: Pre-flight check could not identify the series of {check['unidentified']} input files for subject {subjid} - is pydicom installed?")
+    elif check["status"] == "unknown" and check["unmatched"]:
+        print(f"WARNING: Pre-flight check found {len(check['unmatched'])} series for subject {subjid} matching no known acquisition - running all steps")
+        print(f"WARNING: Unmatched series (check preflight.ACQUISITIONS): {', '.join(check['unmatched'])}")
+    elif check["status"] == "unknown":
+        print(f"WARNING: Pre-flight check found none of the expected acquisitions for subject {subjid} - running all steps")
+    else:
+        print(f"Pre-flight check for subject {subjid}: found {', '.join(check['acquisitions'])}, {len(check['feasible_data'])} of {len(names)} data sets can be produced")
+    for step in check["infeasible_steps"]:
+        print(f"WARNING: Not running step {step} for subject {subjid} - acquisitions it uses are missing from the input")
+    return check["infeasible_steps"]
+
+def preflight_cohort(options, subjids):
+    """
+    Check the input of all subjects and write the cohort feasibility table
+    """
+    names = qpdata_names()
+    checks = preflight_checks(options, subjids)
+    fname = options.preflight_output or os.path.join(options.output, "preflight.csv")
+    os.makedirs(os.path.dirname(os.path.abspath(fname)), exist_ok=True)
+    preflight.write_table(fname, checks, len(names))
+
+    statuses = [check["status"] for check in checks.values()]
+    print(f"Pre-flight check of {len(subjids)} subjects: " + ", ".join(f"{status}: {statuses.count(status)}" for status in sorted(set(statuses))))
+    for step in sorted(preflight.STEP_ACQUISITIONS):
+        num_infeasible = sum(1 for check in checks.values() if step in check["infeasible_steps"])
+        if num_infeasible:
+            print(f" - {step} cannot run for {num_infeasible} subjects")
+    unmatched = collections.Counter(desc for check in checks.values() for desc in check["unmatched"])
+    if unmatched:
+        print(f" - {len(unmatched)} series descriptions match no known acquisition, most common: " +
+              ", ".join(f"{desc} ({count})" for desc, count in unmatched.most_common(10)))
+    print(f"Feasibility table written to {fname}")
+
+def process_subject(options, subjid, stages=None, exclude=(), staged=None, subj_options=None, check=None):
+    """
+    Run pipeline steps for a subject
+
+    With --preflight the input is checked first and steps which cannot succeed
+    are not run. With --scratch the subject is copied to scratch, run there and
+    the outputs of the stages run are copied back, even if the subject fails.
+    The scratch copy is always removed, even if the subject fails before it runs
+
+    :param stages: Stages to run - defaults to those selected by the options
+    :param exclude: Names of steps not to run, e.g. because they are run in a batch
+    :param staged: Future returning options for the subject already staged to scratch
+    :param subj_options: Options for the subject already staged to scratch
+    :param check: Pre-flight check of the subject if it has already been checked
+    """
+    if stages is None:
+        stages = get_stages(options)
+    try:
+        if options.preflight:
+            exclude = set(exclude) | set(preflight_subject(options, subjid, stages, check))
+        if options.scratch:
+            if subj_options is None:
+                subj_options = staged.result() if staged is not None else stage_in(options, subjid, stages)
+            try:
+                process_subject(subj_options, subjid, stages, exclude)
+            finally:
+                stage_out(subj_options, subjid, stages)
+            return
+    finally:
+        if options.scratch:
+            cleanup_scratch(options, subjid, staged)
+
+    print(f"Running subject {subjid}")
+    subj = Subject(options, subjid)
+    os.makedirs(subj.outdir, exist_ok=True)
+    cache = StepCache(os.path.join(subj.outdir, "step_manifest.json"), use_cached=not options.no_cache,
+                      aliases=scratch_rewrites(options, subjid))
+    timings = StepTimings(os.path.join(subj.outdir, "step_timings.json"), subjid)
+    budget = _budget if _budget is not None else ResourceBudget(*node_budget(options))
+    profiles = load_profiles(options.profiles)
+
+    if "rcoh" in stages:
+        run_steps(rcoh_steps(options, subj), cache=cache, timings=timings, budget=budget, profiles=profiles)
+    subj.set_preproc()
+    with open(os.path.join(subj.outdir, "subjid.txt"), "w") as f:
+        f.write(f"{subj.preproc_subjid}\n")
+
+    steps = []
+    if "renal_preproc" in stages:
+        os.makedirs(subj.renal_outdir, exist_ok=True)
+        steps += renal_preproc_steps(options, subj)
+    if "seg" in stages:
+        os.makedirs(subj.seg_outdir, exist_ok=True)
+        steps += seg_steps(options, subj)
+    if "stats" in stages:
+        steps += stats_steps(options, subj, cache)
+    steps = [step for step in steps if step.name not in exclude]
+    if options.no_nifti_cache:
+        run_steps(steps, options.max_parallel, cache, timings, budget, profiles)
+    else:
+        with roi_stats.NiftiCache.activate(nifti_cache_dir(options, subjid)) as nifti_cache:
+            run_steps(steps, options.max_parallel, cache, timings, budget, profiles)
+        print(f"NIfTI cache: {nifti_cache.decompressed} files decompressed, {nifti_cache.hits} reads from uncompressed copies")
+
+    print(f"DONE running subject {subjid}")
+
+def process_subject_logged(options, subjid, **kwargs):
+    """
+    Run all pipeline steps for a subject with output sent to a subject log file
+
+    Used in worker processes so output from different subjects is kept separate.
+    Output is redirected at the file descriptor level so it includes output from
+    commands run by the steps
+
+    :return: None if the subject completed, otherwise the error message
+    """
+    subj_outdir = os.path.join(options.output, subjid)
+    os.makedirs(subj_outdir, exist_ok=True)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = os.dup(1), os.dup(2)
+    with open(os.path.join(subj_outdir, "pipeline_logfile.txt"), "a") as logfile:
+        os.dup2(logfile.fileno(), 1)
+        os.dup2(logfile.fileno(), 2)
+        try:
+            process_subject(options, subjid, **kwargs)
+            return None
+        except Exception as exc:
+            traceback.print_exc()
+            return str(exc)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            for fd, saved_fd in zip((1, 2), saved_fds):
+                os.dup2(saved_fd, fd)
+                os.close(saved_fd)
+
+def get_subjids(options):
+    """
+    Get the subject IDs selected for processing
+
+    :return: List of subject IDs
+    """
+    with open(options.subjids, "r") as f:
+        subjids = [l.strip() for l in f.readlines()]
+    if options.subjid_idx and options.subjid_range:
+        raise ValueError("Can't specify both --subjid-idx and --subjid-range")
+    elif options.subjid_idx:
+        subjids = [subjids[options.subjid_idx-1]]
+    elif options.subjid_range:
+        try:
+            start, end = [int(v) for v in options.subjid_range.split("-")]
+        except ValueError:
+            raise ValueError(f"Invalid subject ID range: {options.subjid_range} - should be <start>-<end>")
+        subjids = subjids[start-1:end]
+    return subjids
+
+def process_subjects(options, subjids, checks=None, **kwargs):
+    """
+    Run pipeline steps for multiple subjects, using a worker pool if requested
+
+    Steps from all subjects share a single resource budget, so more jobs than
+    the node can run at full load can be used to pack subjects whose steps
+    need different resources. With --scratch, subjects are copied to scratch
+    while earlier subjects are running - the next subject with a single job,
+    or up to one subject per job waiting to run with multiple jobs
+
+    :param checks: Mapping from subject ID to pre-flight check for subjects already checked
+    :return: Mapping from subject ID to error message for subjects which failed
+    """
+    failed, checks = {}, checks or {}
+    mem_gb, cpus = node_budget(options)
+    print(f"Resource budget for steps: {mem_gb:.1f}Gb memory, {cpus} CPUs")
+    if options.jobs > 1:
+        print(f"Processing {len(subjids)} subjects using {options.jobs} jobs")
+        stages = kwargs.get("stages") or get_stages(options)
+        with BudgetManager() as manager, \
+             ProcessPoolExecutor(max_workers=options.jobs, initializer=set_budget, initargs=(manager.ResourceBudget(mem_gb, cpus),)) as executor, \
+             ThreadPoolExecutor(max_workers=1) as stager:
+            futures, staging, todo = {}, collections.deque(), collections.deque(subjids)
+
+            def _collect(future):
+                subjid = futures.pop(future)
+                try:
+                    error = future.result()
+                except Exception as exc:
+                    error = str(exc)
+                if error:
+                    print(f"WARNING: Subject {subjid} failed: {error}")
+                    failed[subjid] = error
+                else:
+                    print(f"DONE running subject {subjid}")
+
+            try:
+                while todo or staging or futures:
+                    # Stage subjects in order, keeping at most one staged subject waiting for each job
+                    while options.scratch and todo and len(futures) + len(staging) < 2 * options.jobs:
+                        subjid = todo.popleft()
+                        staging.append((subjid, stager.submit(stage_in, options, subjid, stages)))
+                    while staging and staging[0][1].done():
+                        subjid, staged = staging.popleft()
+                        try:
+                            subj_options = staged.result()
+                        except Exception as exc:
+                            print(f"WARNING: Subject {subjid} failed: {exc}")
+                            failed[subjid] = str(exc)
+                            cleanup_scratch(options, subjid)
+                            continue
+                        futures[executor.submit(process_subject_logged, options, subjid, subj_options=subj_options, check=checks.get(subjid), **kwargs)] = subjid
+                    while not options.scratch and todo:
+                        subjid = todo.popleft()
+                        futures[executor.submit(process_subject_logged, options, subjid, check=checks.get(subjid), **kwargs)] = subjid
+
+                    finished, _ = wait(list(futures) + ([staging[0][1]] if staging else []), return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        if future in futures:
+                            _collect(future)
+            finally:
+                # Subjects staged but not run, e.g. on interrupt
+                for subjid, staged in staging:
+                    cleanup_scratch(options, subjid, staged)
+    else:
+        set_budget(ResourceBudget(mem_gb, cpus))
+        stages = kwargs.get("stages") or get_stages(options)
+        with ThreadPoolExecutor(max_workers=1) as stager:
+            prefetched = None
+            try:
+                for idx, subjid in enumerate(subjids):
+                    staged = prefetched
+                    prefetched = None
+                    if options.scratch and idx + 1 < len(subjids):
+                        prefetched = stager.submit(stage_in, options, subjids[idx + 1], stages)
+                    try:
+                        process_subject(options, subjid, staged=staged, check=checks.get(subjid), **kwargs)
+                    except Exception as exc:
+                        print(f"WARNING: Subject {subjid} failed: {exc}")
+                        traceback.print_exc()
+                        failed[subjid] = str(exc)
+            finally:
+                # A subject staged but not run, e.g. on interrupt
+                if prefetched is not None:
+                    cleanup_scratch(options, subjids[idx + 1], prefetched)
+    return failed
+
+def main():
+    options = ArgumentParser().parse_args()
+    # Symlinks into the output and step fingerprints must not depend on the working directory
+    options.input, options.output = os.path.abspath(options.input), os.path.abspath(options.output)
+    subjids = get_subjids(options)
+    if options.preflight_only:
+        preflight_cohort(options, subjids)
+        return
+
+    stages = get_stages(options)
+    if options.batch_seg and "seg" in stages:
+        # Run the batch segmentation between per-subject preprocessing and stats. The input
+        # is checked once up front as the subjects are processed in three passes
+        checks = preflight_checks(options, subjids) if options.preflight else None
+        failed = process_subjects(options, subjids, checks, stages=[s for s in stages if s != "stats"], exclude=IDS_FILE_SEGS)
+        run_batch_seg(options, [subjid for subjid in subjids if subjid not in failed], checks)
+        if "stats" in stages:
+            failed.update(process_subjects(options, [subjid for subjid in subjids if subjid not in failed], checks, stages=["stats"]))
+    else:
+        failed = process_subjects(options, subjids)
+
+    print(f"Processed {len(subjids)} subjects, {len(failed)} failed")
+    for subjid, error in failed.items():
+        print(f" - {subjid}: {error}")
+    if failed:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -2,13 +2,24 @@
 Generate subject IDPs in TSV format from output of DEMISTIFI pipeline
 """
 import argparse
+import collections
+from concurrent.futures import ProcessPoolExecutor
 import csv
+import hashlib
+import json
 import logging
 import os
 import sys
 
+import numpy as np
 import pandas as pd
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet
+except ImportError:
+    pa = None
+
 LOG = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
 
@@ -17,12 +28,23 @@ MEAN_PARAM="Interquartile mean"
 STD_PARAM="Interquartile STD"
 #MEAN_PARAM="Std"
 
+# Number of subjects queued for each worker process when extracting IDPs in parallel
+IN_FLIGHT_PER_JOB = 4
+
+# Number of subjects written at a time to columnar output
+COLUMNAR_BATCH_ROWS = 1024
+
 class ArgumentParser(argparse.ArgumentParser):
     def __init__(self, **kwargs):
         argparse.ArgumentParser.__init__(self, prog="demistifi-ukb-pipeline", add_help=True, **kwargs)
         self.add_argument("--input", required=True, help="Input directory containing subject dirs")
         self.add_argument("--statspath", help="Subject dir subfolder containing stats", default="stats")
         self.add_argument("--output", help="Output filename", default="demistifi_idps.csv")
+        self.add_argument("--jobs", help="Number of subjects to process in parallel", type=int, default=len(os.sched_getaffinity(0)))
+        self.add_argument("--incremental", action="store_true", default=False,
+                          help="Only re-extract IDPs for subjects whose stats files have changed since the last incremental run "
+                               "and merge them into the existing output. Changes to the IDP definition trigger a full rebuild")
+        self.add_argument("--columnar", help="Also write IDPs to a columnar file (.parquet or .feather). Requires pyarrow")
 
 
 # IDP definition. Mapping from:
@@ -254,30 +276,171 @@ IDPDEF = {
 #    },
 }
 
-def get_seg_vols(options, subjid):
-    vols_tsv = os.path.join(options.input, subjid, options.statspath, "seg_volumes.tsv")
-    LOG.debug(f"Looking for segmentation volumes for subject {subjid} in {vols_tsv}")
-    if os.path.exists(vols_tsv):
-        return pd.read_csv(vols_tsv, sep="\t", index_col=0)
-    else:
-        LOG.warning(f"No volumes file: {vols_tsv}")
-        return pd.DataFrame()
+# Statistics output for each parameter: (stats row, measure name, organs or None for all organs)
+PARAM_MEASURES = [
+    (MEAN_PARAM, "iqmean", None),
+    (STD_PARAM, "iqstd", None),
+    ("Median", "median", None),
+    ("Mode estimate", "mode", ("liver",)),
+    ("FWHM estimate", "fwhm", ("liver",)),
+]
 
-def get_seg_vol(df, organ, seg, grid):
-    col_name = f"seg_{organ}_{seg}"
-    if grid:
-        col_name += f"_regrid_{grid}"
-    if col_name in list(df.columns):
-        n, vol = df[col_name]
-        if n == 0:
-            return "", ""
-        else:
-            if organ in ("vat", "asat"):
-                vol /= 1000.0
-            return int(n), vol
-    else:
-        LOG.warning(f"No volume found for segmentation: {col_name}")
-        return "", ""
+class IdpPlan:
+    """
+    Extraction plan compiled from an IDP definition
+
+    Gives the ordered output columns with their organ, segmentation, grid,
+    parameter and measure, and for each stats file the cells which need to be
+    read from it, so subjects can be processed without walking the definition
+    """
+    def __init__(self, idpdef=IDPDEF):
+        self.columns = ["subjid",]
+        self.organ_values, self.seg_values, self.grid_values, self.param_values, self.measure_values = [""], [""], [""], [""], ["subjid"]
+        # Segmentation volume columns in seg_volumes.tsv, the scale applied to the volume
+        # and the output index of the voxel count (the volume follows it)
+        self.vol_cols, self.vol_scales, self.vol_indices = [], [], []
+        # Stats file -> list of (column, alternate column, stats rows, output indices, volume index)
+        self.stats = {}
+
+        for organ, organdef in idpdef.items():
+            for seg, segdef in organdef.items():
+                for grid, params in segdef.items():
+                    vol_col = f"seg_{organ}_{seg}"
+                    if grid:
+                        vol_col += f"_regrid_{grid}"
+                    vol_idx = len(self.vol_cols)
+                    self.vol_cols.append(vol_col)
+                    self.vol_scales.append(1000.0 if organ in ("vat", "asat") else 1.0)
+                    self.vol_indices.append(len(self.columns))
+                    output_col_name = f"{organ}_{seg}_{grid}"
+                    self._add_column(output_col_name + "_n", organ, seg, grid, "mask", "n")
+                    self._add_column(output_col_name + "_vol", organ, seg, grid, "mask", "vol")
+
+                    for param, method in params:
+                        col_name = param
+                        param_name = param
+                        col_name_alt = col_name
+                        if grid:
+                            col_name += f"_{grid}"
+                        else:
+                            col_name += f"_{organ}_{seg}"
+                        if method:
+                            col_name += f"_{method}"
+                            col_name_alt += f"_{method}"
+                            param_name += f"_{method}"
+
+                        output_col_name = f"{organ}_{seg}_{col_name}"
+                        rows, indices = [], []
+                        for row, measure, organs in PARAM_MEASURES:
+                            if organs is None or organ in organs:
+                                rows.append(row)
+                                indices.append(len(self.columns))
+                                self._add_column(f"{output_col_name}_{measure}", organ, seg, grid, param_name, measure)
+                        stats_dataset = f"{organ}_{seg}_stats.tsv"
+                        self.stats.setdefault(stats_dataset, []).append((col_name, col_name_alt, rows, indices, vol_idx))
+
+    def _add_column(self, name, organ, seg, grid, param, measure):
+        self.columns.append(name)
+        self.organ_values.append(organ)
+        self.seg_values.append(seg)
+        self.grid_values.append(grid)
+        self.param_values.append(param)
+        self.measure_values.append(measure)
+
+    def header_rows(self):
+        """
+        :return: Rows written at the top of the output CSV file
+        """
+        return [
+            self.columns,
+            strip_repeats(self.organ_values),
+            strip_repeats(self.seg_values),
+            strip_repeats(self.grid_values),
+            strip_repeats(self.param_values),
+            self.measure_values,
+        ]
+
+    def stats_files(self):
+        """
+        :return: Names of all the files IDPs are extracted from
+        """
+        return ["seg_volumes.tsv"] + list(self.stats)
+
+    def fingerprint(self):
+        """
+        :return: Hash of the plan, which changes if the IDP definition changes the output
+        """
+        plan = [self.columns, self.vol_cols, self.vol_scales, sorted(self.stats.items())]
+        return hashlib.sha256(json.dumps(plan).encode()).hexdigest()
+
+    def extract(self, subjid, statsdir):
+        """
+        Extract IDPs for a subject
+
+        :param statsdir: Directory containing the subject's stats files
+        :return: IDP values in column order. Missing values are empty strings
+        """
+        values = np.full(len(self.columns), "", dtype=object)
+        values[0] = subjid
+
+        seg_vols_df = read_stats(os.path.join(statsdir, "seg_volumes.tsv"))
+        missing_vols = [col for col in self.vol_cols if col not in seg_vols_df.columns]
+        if missing_vols:
+            LOG.warning(f"No volume found for segmentations: {missing_vols}")
+        vols = numeric(seg_vols_df.reindex(columns=self.vol_cols).iloc[:2])
+        if vols.shape[0] < 2:
+            vols = np.full((2, len(self.vol_cols)), np.nan)
+        n, vol = vols[0], vols[1] / np.array(self.vol_scales)
+        has_voxels = np.nan_to_num(n) > 0
+        vol_indices = np.array(self.vol_indices)
+        values[vol_indices[has_voxels]] = n[has_voxels].astype(int)
+        values[vol_indices[has_voxels]+1] = vol[has_voxels]
+
+        for stats_dataset, entries in self.stats.items():
+            df = read_stats(os.path.join(statsdir, stats_dataset))
+            col_idx, row_names, out_idx = [], [], []
+            for col_name, col_name_alt, rows, indices, vol_idx in entries:
+                if not has_voxels[vol_idx]:
+                    continue
+                if col_name in df.columns:
+                    col = col_name
+                elif col_name_alt in df.columns:
+                    LOG.debug(f"Using alt: {col_name_alt}")
+                    col = col_name_alt
+                else:
+                    LOG.debug(f"Not found: {col_name}")
+                    continue
+                col_idx.extend([df.columns.get_loc(col)] * len(rows))
+                row_names.extend(rows)
+                out_idx.extend(indices)
+            if out_idx:
+                row_idx = df.index.get_indexer(row_names)
+                found = row_idx >= 0
+                data = numeric(df)
+                values[np.array(out_idx)[found]] = data[row_idx[found], np.array(col_idx)[found]]
+
+        return values.tolist()
+
+def numeric(df):
+    """
+    :return: Values of a DataFrame as a float array, with values which are not numbers as NaN
+    """
+    return df.apply(pd.to_numeric, errors="coerce").to_numpy(dtype=np.float64)
+
+def read_stats(stats_tsv):
+    """
+    Read a stats or volumes file, which have stats/measures in rows and data sets in columns
+
+    :return: DataFrame, empty if the file does not exist
+    """
+    if not os.path.exists(stats_tsv):
+        LOG.warning(f"No stats file: {stats_tsv}")
+        return pd.DataFrame()
+    LOG.debug(f"Loading stats from: {stats_tsv}")
+    df = pd.read_csv(stats_tsv, sep="\t", skipinitialspace=True, index_col=0)
+    df.columns = df.columns.str.strip()
+    df.index = df.index.astype(str).str.strip()
+    return df
 
 def strip_repeats(col_names):
     new_col_names = []
@@ -288,128 +451,215 @@ def strip_repeats(col_names):
             new_col_names.append(col_name)
     return new_col_names
 
+def file_digests(statsdir, fnames, known=None):
+    """
+    Get size, modification time and content hash of stats files
+
+    :param known: Digests from a previous call. Files whose size and modification time
+                  are unchanged are not re-read
+    :return: Mapping from file name to [size, mtime_ns, sha256], or None if the file does not exist
+    """
+    known = known or {}
+    digests = {}
+    for fname in fnames:
+        path = os.path.join(statsdir, fname)
+        try:
+            stat = os.stat(path)
+            if known.get(fname) and known[fname][:2] == [stat.st_size, stat.st_mtime_ns]:
+                digests[fname] = known[fname]
+                continue
+            with open(path, "rb") as f:
+                digests[fname] = [stat.st_size, stat.st_mtime_ns, hashlib.sha256(f.read()).hexdigest()]
+        except OSError:
+            digests[fname] = None
+    return digests
+
+def _content_hashes(digests):
+    return {fname : digest[2] if digest else None for fname, digest in digests.items()}
+
+def get_subject_idps(options, subjid, plan, incremental=False, known=None):
+    """
+    Extract the IDPs for a single subject
+
+    :param incremental: If True, get the digests of the subject's stats files
+    :param known: Stats file digests from a previous run. If given, IDPs are not extracted
+                  if the contents of the stats files are unchanged
+    :return: Tuple of (stats file digests or None if not incremental, IDP values in the
+             order of the plan columns or None if unchanged)
+    """
+    statsdir = os.path.join(options.input, subjid, options.statspath)
+    digests = None
+    if incremental:
+        digests = file_digests(statsdir, plan.stats_files(), known)
+        if known is not None and _content_hashes(digests) == _content_hashes(known):
+            LOG.debug(f"Stats unchanged for subject {subjid}")
+            return digests, None
+    LOG.info(f"Processing subject {subjid}")
+    return digests, plan.extract(subjid, statsdir)
+
+def iter_subject_idps(options, subjids, plan, incremental=False, known=None):
+    """
+    Extract IDPs for subjects using a pool of worker processes
+
+    Results are yielded in the order of the subject IDs. At most a fixed number
+    of subjects are in progress or waiting to be yielded at any time so memory
+    use does not depend on the number of subjects
+
+    :param known: Mapping from subject ID to stats file digests from a previous run
+    :return: Generator of get_subject_idps results
+    """
+    known = known or {}
+    if options.jobs <= 1:
+        for subjid in subjids:
+            yield get_subject_idps(options, subjid, plan, incremental, known.get(subjid))
+        return
+
+    max_in_flight = options.jobs * IN_FLIGHT_PER_JOB
+    with ProcessPoolExecutor(max_workers=options.jobs) as executor:
+        in_flight = collections.deque()
+        for subjid in subjids:
+            in_flight.append(executor.submit(get_subject_idps, options, subjid, plan, incremental, known.get(subjid)))
+            if len(in_flight) >= max_in_flight:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+class ColumnarWriter:
+    """
+    Writes IDPs to a Parquet or Feather file as they are extracted
+
+    Values are float32 with missing values as nulls, indexed by subject ID. Each
+    column has the organ, segmentation, grid, parameter and measure it describes
+    as field metadata
+    """
+    def __init__(self, fname, plan):
+        self.fname = fname
+        self.tmp_fname = os.path.join(os.path.dirname(fname), f".tmp_{os.path.basename(fname)}")
+        self.rows = []
+        fields = [pa.field("subjid", pa.string())]
+        for idx, name in enumerate(plan.columns[1:], start=1):
+            metadata = {
+                "organ" : plan.organ_values[idx],
+                "seg" : plan.seg_values[idx],
+                "grid" : plan.grid_values[idx],
+                "param" : plan.param_values[idx],
+                "measure" : plan.measure_values[idx],
+            }
+            fields.append(pa.field(name, pa.float32(), metadata=metadata))
+        # pandas metadata is taken from an empty frame with the same column types as the fields
+        typed = pd.DataFrame({name : pd.Series(dtype=np.float32) for name in plan.columns[1:]},
+                             index=pd.Index([], dtype=str, name="subjid"))
+        pandas_metadata = pa.Schema.from_pandas(typed).metadata
+        self.schema = pa.schema(fields, metadata=pandas_metadata)
+
+        if fname.endswith(".parquet"):
+            self.writer = pyarrow.parquet.ParquetWriter(self.tmp_fname, self.schema)
+        elif fname.endswith(".feather") or fname.endswith(".arrow"):
+            self.writer = pa.ipc.new_file(self.tmp_fname, self.schema)
+        else:
+            raise ValueError(f"Unsupported columnar output format: {fname} - must be .parquet or .feather")
+
+    def write_row(self, values):
+        self.rows.append(values)
+        if len(self.rows) >= COLUMNAR_BATCH_ROWS:
+            self._flush()
+
+    def _flush(self):
+        if not self.rows:
+            return
+        data = pd.DataFrame(self.rows)
+        arrays = [pa.array(data[0].astype(str), pa.string())]
+        for idx in range(1, len(self.schema)):
+            values = pd.to_numeric(data[idx], errors="coerce").to_numpy(dtype=np.float32)
+            arrays.append(pa.array(values, pa.float32(), mask=np.isnan(values)))
+        self.writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+        self.rows = []
+
+    def close(self):
+        self._flush()
+        self.writer.close()
+        os.replace(self.tmp_fname, self.fname)
+
+def read_idp_rows(fname, nheader):
+    """
+    :return: Generator of subject rows from an existing output file
+    """
+    with open(fname, "r", newline="") as csvfile:
+        for idx, row in enumerate(csv.reader(csvfile)):
+            if idx >= nheader and row:
+                yield row
+
+def load_manifest(options, plan):
+    """
+    Load stats file digests from the last incremental run
+
+    Digests are only returned for subjects in the existing output, and only if the
+    output was generated with the same IDP plan and stats path
+
+    :return: Mapping from subject ID to stats file digests
+    """
+    manifest_fname = options.output + ".manifest.json"
+    if not os.path.exists(manifest_fname) or not os.path.exists(options.output):
+        LOG.info("No previous output or manifest - extracting IDPs for all subjects")
+        return {}
+    try:
+        with open(manifest_fname, "r") as f:
+            manifest = json.load(f)
+    except ValueError:
+        LOG.warning(f"Ignoring invalid manifest: {manifest_fname}")
+        return {}
+    if manifest.get("plan") != plan.fingerprint() or manifest.get("statspath") != options.statspath:
+        LOG.info("IDP definition or stats path has changed - extracting IDPs for all subjects")
+        return {}
+    existing = set(row[0] for row in read_idp_rows(options.output, len(plan.header_rows())))
+    return {subjid : digests for subjid, digests in manifest.get("subjects", {}).items() if subjid in existing}
+
+def save_manifest(options, plan, subject_digests):
+    """
+    Save stats file digests for use by the next incremental run
+    """
+    manifest_fname = options.output + ".manifest.json"
+    manifest = {"plan" : plan.fingerprint(), "statspath" : options.statspath, "subjects" : subject_digests}
+    with open(manifest_fname + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(manifest_fname + ".tmp", manifest_fname)
+
 def main():
     options = ArgumentParser().parse_args()
     subjids = [f for f in os.listdir(options.input) if os.path.isdir(os.path.join(options.input, f))]
     subjids = sorted(subjids)
     #subjids = ["1091670"]
 
-    out_idpcols, out_idplist = ["subjid",], []
-    organ_values, seg_values, grid_values, param_values, measure_values = [""], [""], [""], [""], ["subjid"]
-    for subj_idx, subjid in enumerate(subjids):
-        subj_idpvals = [subjid,]
-        loaded_stats = {}
-        seg_vols_df = get_seg_vols(options, subjid)
-        LOG.info(f"Processing subject {subjid}")
-        LOG.debug(f"Found segmentation volumes for {seg_vols_df.columns}")
-        for organ, organdef in IDPDEF.items():
-            LOG.debug(f"Organ: {organ}")
-            for seg, segdef in organdef.items():
-                LOG.debug(f"Segmentation: {seg} {segdef}")
-                for grid, params in segdef.items():
-                    LOG.debug(f"Grid: {grid}")
-                    n, vol = get_seg_vol(seg_vols_df, organ, seg, grid)
-                    if subj_idx == 0:
-                        output_col_name = f"{organ}_{seg}_{grid}"
-                        out_idpcols.append(output_col_name + "_n")
-                        out_idpcols.append(output_col_name + "_vol")
-                        measure_values.append("n")
-                        measure_values.append("vol")
-                        for i in range(2):
-                            organ_values.append(organ)
-                            seg_values.append(seg)
-                            grid_values.append(grid)
-                            param_values.append("mask")
-                    subj_idpvals.append(n)
-                    subj_idpvals.append(vol)
-                    LOG.debug(f"N, volume: {n} {vol}")
-                    for paramdef in params:
-                        param, method = paramdef
-                        LOG.debug(f"Parameter: {paramdef}")
-                        stats_dataset = f"{organ}_{seg}_stats.tsv"
-                        if stats_dataset not in loaded_stats:
-                            stats_tsv = os.path.join(options.input, subjid, options.statspath, stats_dataset)
-                            if os.path.exists(stats_tsv):
-                                LOG.debug(f"Loading stats from: {stats_tsv}")
-                                loaded_stats[stats_dataset] = pd.read_csv(stats_tsv, sep="\s*\t\s*", engine="python", index_col=0)
-                            else:
-                                LOG.warning(f"No stats file: {stats_tsv}")
-                                loaded_stats[stats_dataset] = pd.DataFrame()
-                        col_name = param
-                        param_name = param
-                        col_name_alt = col_name
-                        if grid:
-                            col_name += f"_{grid}"
-                        else:
-                            col_name += f"_{organ}_{seg}"
-                        if method:
-                            col_name += f"_{method}"
-                            col_name_alt += f"_{method}"
-                            param_name += f"_{method}"
-                        LOG.debug(f"Looking for column: {col_name}")
-                        if n and col_name in list(loaded_stats[stats_dataset].columns):
-                            mean = loaded_stats[stats_dataset][col_name][MEAN_PARAM]
-                            std = loaded_stats[stats_dataset][col_name][STD_PARAM]
-                            median = loaded_stats[stats_dataset][col_name]["Median"]
-                            mode = loaded_stats[stats_dataset][col_name]["Mode estimate"]
-                            fwhm = loaded_stats[stats_dataset][col_name]["FWHM estimate"]
-                        elif n and col_name_alt in list(loaded_stats[stats_dataset].columns):
-                            LOG.debug(f"Using alt: {col_name_alt}")
-                            mean = loaded_stats[stats_dataset][col_name_alt][MEAN_PARAM]
-                            std = loaded_stats[stats_dataset][col_name_alt][STD_PARAM]
-                            median = loaded_stats[stats_dataset][col_name_alt]["Median"]
-                            mode = loaded_stats[stats_dataset][col_name_alt]["Mode estimate"]
-                            fwhm = loaded_stats[stats_dataset][col_name_alt]["FWHM estimate"]
-                        else:
-                            LOG.debug(f"Not found: {col_name}")
-                            mean, std, median, mode, fwhm = "", "", "", "", ""
-
-                        if subj_idx == 0:
-                            output_col_name = f"{organ}_{seg}_{col_name}"
-                            out_idpcols.append(output_col_name + "_iqmean")
-                            out_idpcols.append(output_col_name + "_iqstd")
-                            out_idpcols.append(output_col_name + "_median")
-                            measure_values.append("iqmean")
-                            measure_values.append("iqstd")
-                            measure_values.append("median")
-                            if organ == "liver":
-                                out_idpcols.append(output_col_name + "_mode")
-                                out_idpcols.append(output_col_name + "_fwhm")
-                                measure_values.append("mode")
-                                measure_values.append("fwhm")
-
-                            for i in range(3):
-                                organ_values.append(organ)
-                                seg_values.append(seg)
-                                grid_values.append(grid)
-                                param_values.append(param_name)
-                        subj_idpvals.append(mean)
-                        subj_idpvals.append(std)
-                        subj_idpvals.append(median)
-                        if organ == "liver":
-                            subj_idpvals.append(mode)
-                            subj_idpvals.append(fwhm)
-
-        out_idplist.append(subj_idpvals)
-
-    #df_out = pd.DataFrame(out_idplist, columns=out_idpcols)
-    #df_out.set_index("subjid", inplace=True)
-    #print(df_out)
-    #df_out.to_csv(options.output)
-    organ_values = strip_repeats(organ_values)
-    seg_values = strip_repeats(seg_values)
-    grid_values = strip_repeats(grid_values)
-    param_values = strip_repeats(param_values)
-    with open(options.output, 'w', newline='') as csvfile:
+    plan = IdpPlan(IDPDEF)
+    columnar = None
+    if options.columnar:
+        if pa is None:
+            sys.exit("pyarrow is required for columnar output")
+        columnar = ColumnarWriter(options.columnar, plan)
+    known = load_manifest(options, plan) if options.incremental else {}
+    # Rows from the previous output are in subject ID order so are read alongside the new ones
+    old_rows = read_idp_rows(options.output, len(plan.header_rows())) if known else iter(())
+
+    subject_digests = {}
+    with open(options.output + ".tmp", 'w', newline='') as csvfile:
         writer = csv.writer(csvfile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        writer.writerow(out_idpcols)
-        writer.writerow(organ_values)
-        writer.writerow(seg_values)
-        writer.writerow(grid_values)
-        writer.writerow(param_values)
-        writer.writerow(measure_values)
-        for subj_values in out_idplist:
-            writer.writerow(subj_values)
-            
+        writer.writerows(plan.header_rows())
+        for subjid, (digests, subj_idpvals) in zip(subjids, iter_subject_idps(options, subjids, plan, options.incremental, known)):
+            if subj_idpvals is None:
+                subj_idpvals = next((row for row in old_rows if row[0] == subjid), None)
+                if subj_idpvals is None:
+                    LOG.warning(f"Subject {subjid} not found in previous output")
+                    _digests, subj_idpvals = get_subject_idps(options, subjid, plan)
+            writer.writerow(subj_idpvals)
+            if columnar is not None:
+                columnar.write_row(subj_idpvals)
+            if options.incremental:
+                subject_digests[subjid] = digests
+    os.replace(options.output + ".tmp", options.output)
+    if columnar is not None:
+        columnar.close()
+    if options.incremental:
+        save_manifest(options, plan, subject_digests)
+
 if __name__ == "__main__":
     main()
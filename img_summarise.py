@@ -1,48 +1,171 @@
 # Script to combine PNG output of renal preproc into a more convenient format for review
 #
-# Usage: img_summarise <indir> <outdir>
-import glob
+# Usage: img_summarise <indir> <outdir> [<renalpath>] [--link] [--montage] [--jobs N]
+#
+# PNGs are copied (or with --link, hard linked or reflinked where possible) to
+# <outdir>/<subjid>_<fname>. Targets which are already up to date are skipped.
+# With --montage a contact sheet of each subject's PNGs is also written to
+# <outdir>/montage/<subjid>_montage.png (requires Pillow)
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import errno
+import fcntl
+import math
 import os
 import shutil
-import sys
 
-def collate_pngs(subjid, subjdir, outdir):
-    for root, dirs, files in os.walk(subjdir):
-        for f in files:
-            if f.endswith(".png"):
-                fpath = os.path.join(root, f)
-                to_fname = subjid + "_" + f
-                print(outdir, fpath, to_fname)
-                shutil.copyfile(fpath, os.path.join(outdir, to_fname))
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    Image = None
+
+# ioctl request to clone a file's extents (Linux FICLONE), supported by e.g. btrfs and XFS
+FICLONE = 0x40049409
+
+# Size of each image in montages, in pixels
+MONTAGE_TILE = 400
+
+class ArgumentParser(argparse.ArgumentParser):
+    def __init__(self, **kwargs):
+        argparse.ArgumentParser.__init__(self, prog="img_summarise", add_help=True, **kwargs)
+        self.add_argument("indir", help="Input directory containing subject dirs")
+        self.add_argument("outdir", help="Output directory for collated PNGs")
+        self.add_argument("renalpath", nargs="?", default="", help="Subject dir subfolder containing renal preproc output")
+        self.add_argument("--link", action="store_true", default=False,
+                          help="Hard link or reflink PNGs instead of copying when on the same filesystem")
+        self.add_argument("--montage", action="store_true", default=False, help="Write a contact sheet of PNGs for each subject")
+        self.add_argument("--jobs", help="Number of subjects to process at the same time", type=int, default=8)
+
+def up_to_date(src, dest):
+    """
+    :return: True if dest is a link to src or a copy of the current version of src
+    """
+    try:
+        src_stat, dest_stat = os.stat(src), os.stat(dest)
+    except OSError:
+        return False
+    if (src_stat.st_dev, src_stat.st_ino) == (dest_stat.st_dev, dest_stat.st_ino):
+        return True
+    return src_stat.st_size == dest_stat.st_size and src_stat.st_mtime_ns == dest_stat.st_mtime_ns
+
+def reflink(src, dest):
+    """
+    Create a copy-on-write clone of src
+    """
+    with open(src, "rb") as src_f, open(dest, "wb") as dest_f:
+        fcntl.ioctl(dest_f.fileno(), FICLONE, src_f.fileno())
+    shutil.copystat(src, dest)
 
-    #for fname in glob.glob(os.path.join(subjdir, "*/*.png")):
-    #    basename = os.path.basename(fname)
-    #    outname = os.path.join(outdir, f"{subjid}_{basename}")
-    #    shutil.copyfile(fname, outname)
+def transfer(src, dest, link=False):
+    """
+    Copy, hard link or reflink src to dest, replacing any existing file
 
-indir = sys.argv[1]
-outdir = sys.argv[2]
-if len(sys.argv) == 4:
-    renalpath = sys.argv[3]
-else:
-    renalpath = ""
+    :return: Method used
+    """
+    tmp_dest = os.path.join(os.path.dirname(dest), f".tmp_{os.path.basename(dest)}")
+    if os.path.lexists(tmp_dest):
+        os.remove(tmp_dest)
+    method = "copy"
+    if link:
+        try:
+            os.link(src, tmp_dest)
+            method = "hardlink"
+        except OSError:
+            try:
+                reflink(src, tmp_dest)
+                method = "reflink"
+            except OSError as exc:
+                if os.path.lexists(tmp_dest):
+                    os.remove(tmp_dest)
+                if exc.errno not in (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EPERM):
+                    raise
+    if method == "copy":
+        shutil.copy2(src, tmp_dest)
+    os.replace(tmp_dest, dest)
+    return method
 
-os.makedirs(outdir, exist_ok=True)
+def make_montage(fnames, labels, output, title):
+    """
+    Write a contact sheet of PNG images with their labels
+    """
+    ncols = math.ceil(math.sqrt(len(fnames)))
+    nrows = math.ceil(len(fnames) / ncols)
+    label_height, title_height = 16, 24
+    montage = Image.new("RGB", (ncols * MONTAGE_TILE, title_height + nrows * (MONTAGE_TILE + label_height)), "white")
+    draw = ImageDraw.Draw(montage)
+    draw.text((4, 4), title, fill="black")
+    for idx, (fname, label) in enumerate(zip(fnames, labels)):
+        x, y = (idx % ncols) * MONTAGE_TILE, title_height + (idx // ncols) * (MONTAGE_TILE + label_height)
+        with Image.open(fname) as img:
+            img.thumbnail((MONTAGE_TILE, MONTAGE_TILE))
+            montage.paste(img.convert("RGB"), (x + (MONTAGE_TILE - img.width) // 2, y + label_height + (MONTAGE_TILE - img.height) // 2))
+        draw.text((x + 4, y + 2), label, fill="black")
+    tmp_output = os.path.join(os.path.dirname(output), f".tmp_{os.path.basename(output)}")
+    montage.save(tmp_output, format="PNG")
+    os.replace(tmp_output, output)
 
-subjids = os.listdir(indir)
-print(f"Found {len(subjids)} in {indir}")
+def collate_pngs(subjid, subjdir, outdir, link=False, montage_dir=None):
+    """
+    Collate PNGs for a subject/session
 
-for subjid in subjids:
-    subjdir = os.path.join(indir, subjid, renalpath)
+    :return: Mapping from method used to number of files ('skipped' for files already up to date)
+    """
+    counts = {}
+    pngs = []
+    for root, dirs, files in os.walk(subjdir):
+        for f in sorted(files):
+            if f.endswith(".png"):
+                fpath = os.path.join(root, f)
+                to_fname = os.path.join(outdir, subjid + "_" + f)
+                pngs.append((fpath, f))
+                method = "skipped" if up_to_date(fpath, to_fname) else transfer(fpath, to_fname, link)
+                counts[method] = counts.get(method, 0) + 1
+
+    if montage_dir and pngs:
+        output = os.path.join(montage_dir, f"{subjid}_montage.png")
+        newest = max(os.stat(fpath).st_mtime_ns for fpath, _f in pngs)
+        if not os.path.exists(output) or os.stat(output).st_mtime_ns < newest or counts.get("skipped", 0) < len(pngs):
+            make_montage([fpath for fpath, _f in pngs], [f for _fpath, f in pngs], output, subjid)
+            counts["montage"] = 1
+    return counts
+
+def collate_subject(options, subjid, montage_dir):
+    """
+    Collate PNGs for a subject, which may have multiple sessions
+    """
+    subjdir = os.path.join(options.indir, subjid, options.renalpath)
     if not os.path.isdir(subjdir):
-        continue
-    print(f" - Subject {subjid}")
+        return {}
     if not os.path.exists(os.path.join(subjdir, "nifti")):
-        print(" - Looks like this one has multiple sessions")
-        sessions = os.listdir(subjdir)
-        for session in sessions:
-            print(f"   - Session {session}")
+        print(f" - Subject {subjid} looks like it has multiple sessions")
+        counts = {}
+        for session in os.listdir(subjdir):
             sessdir = os.path.join(subjdir, session)
-            collate_pngs(f"{subjid}_{session}", sessdir, outdir)
+            for method, count in collate_pngs(f"{subjid}_{session}", sessdir, options.outdir, options.link, montage_dir).items():
+                counts[method] = counts.get(method, 0) + count
+        return counts
     else:
-        collate_pngs(subjid, subjdir, outdir)
+        return collate_pngs(subjid, subjdir, options.outdir, options.link, montage_dir)
+
+def main():
+    options = ArgumentParser().parse_args()
+    os.makedirs(options.outdir, exist_ok=True)
+    montage_dir = None
+    if options.montage:
+        if Image is None:
+            raise RuntimeError("Pillow is required to create montages")
+        montage_dir = os.path.join(options.outdir, "montage")
+        os.makedirs(montage_dir, exist_ok=True)
+
+    subjids = sorted(os.listdir(options.indir))
+    print(f"Found {len(subjids)} in {options.indir}")
+
+    totals = {}
+    with ThreadPoolExecutor(max_workers=options.jobs) as executor:
+        for counts in executor.map(lambda subjid: collate_subject(options, subjid, montage_dir), subjids):
+            for method, count in counts.items():
+                totals[method] = totals.get(method, 0) + count
+    print(" - ".join(f"{method}: {count}" for method, count in sorted(totals.items())) or "No PNGs found")
+
+if __name__ == "__main__":
+    main()
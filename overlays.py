@@ -0,0 +1,150 @@
+"""
+Lightbox overlays of segmentations for DEMISTIFI QC
+
+Renders lightbox PNG images of segmentations on background data in-process,
+as an alternative to running renal-preproc-overlay once for each image. Each
+background is loaded once however many segmentations are overlaid on it and
+images are rendered in a thread pool
+
+Usage: overlays.py --bg t1_kidney_molli.nii.gz --seg seg_kidney_all_t1_clean.nii.gz --output lightbox.png
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import math
+import os
+import traceback
+
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import roi_stats
+
+LOG = logging.getLogger(__name__)
+
+# Size of each lightbox tile in inches, and output resolution
+TILE_SIZE = 3
+DPI = 100
+
+# Percentile of the background data used as the top of the grey scale
+BG_PERCENTILE = 99
+
+# Colour and opacity of the segmentation overlay
+SEG_COLOUR = (1.0, 0.0, 0.0)
+SEG_ALPHA = 0.4
+
+class ArgumentParser(argparse.ArgumentParser):
+    def __init__(self, **kwargs):
+        argparse.ArgumentParser.__init__(self, prog="overlays", add_help=True, **kwargs)
+        self.add_argument("--bg", help="Background data", required=True)
+        self.add_argument("--seg", help="Segmentation", required=True)
+        self.add_argument("--output", help="Output PNG file", required=True)
+        self.add_argument("--subjid", help="Subject ID used as image title")
+
+def dedupe_jobs(jobs):
+    """
+    Remove jobs which write to the same output as a later job
+
+    Only the last image written to an output would be kept anyway, so this
+    avoids rendering images which would be overwritten
+
+    :param jobs: Sequence of (background file, segmentation file, output file)
+    :return: List of jobs with unique outputs, in the order given
+    """
+    last = {output : idx for idx, (_bg, _seg, output) in enumerate(jobs)}
+    return [job for idx, job in enumerate(jobs) if last[job[2]] == idx]
+
+def _load_bg(fname):
+    """
+    :return: 3D background data, affine and the upper limit of the grey scale
+    """
+    img = roi_stats.load_nifti(fname)
+    data = np.asarray(img.dataobj, dtype=np.float32)
+    while data.ndim > 3:
+        data = data[..., 0]
+    data = data.reshape(roi_stats._spatial_shape(data.shape))
+    finite = data[np.isfinite(data)]
+    vmax = np.percentile(finite, BG_PERCENTILE) if finite.size else 1
+    return data, img.affine, vmax
+
+def _render(bg, seg_fname, output, title, regrid_cache):
+    """
+    Render a lightbox of all slices of the background with a segmentation overlaid
+    """
+    bg_data, bg_affine, vmax = bg
+    seg = roi_stats.load_nifti(seg_fname)
+    seg_data = np.asarray(seg.dataobj) > 0
+    seg_data = seg_data.reshape(roi_stats._spatial_shape(seg_data.shape))
+    seg_data = regrid_cache.resample(seg_data, seg.affine, bg_affine, bg_data.shape)
+
+    nslices = bg_data.shape[2]
+    ncols = math.ceil(math.sqrt(nslices))
+    nrows = math.ceil(nslices / ncols)
+    fig = Figure(figsize=(ncols * TILE_SIZE, nrows * TILE_SIZE), dpi=DPI)
+    FigureCanvasAgg(fig)
+    overlay = np.zeros(bg_data.shape[:2] + (4,), dtype=np.float32)
+    for idx in range(nslices):
+        axes = fig.add_subplot(nrows, ncols, idx+1)
+        axes.imshow(np.rot90(bg_data[..., idx]), cmap="gray", vmin=0, vmax=vmax)
+        overlay[...] = 0
+        overlay[seg_data[..., idx]] = SEG_COLOUR + (SEG_ALPHA,)
+        axes.imshow(np.rot90(overlay))
+        axes.set_axis_off()
+    if title:
+        fig.suptitle(title)
+    tmp_output = os.path.join(os.path.dirname(output), f".tmp_{os.path.basename(output)}")
+    fig.savefig(tmp_output, format="png")
+    os.replace(tmp_output, output)
+
+def render_overlays(jobs, title=None, max_workers=4, regrid_cache=None):
+    """
+    Render lightbox overlays of segmentations on background data
+
+    Jobs writing to the same output are deduplicated so only the last is rendered
+
+    :param jobs: Sequence of (background file, segmentation file, output file)
+    :param title: Title for the images, e.g. the subject ID
+    :return: Mapping from output file to True if it was rendered successfully
+    """
+    if regrid_cache is None:
+        regrid_cache = roi_stats.RegridCache.shared()
+    jobs = dedupe_jobs(jobs)
+    bg_fnames = sorted(set(bg for bg, _seg, _output in jobs))
+
+    def _load(fname):
+        try:
+            return _load_bg(fname)
+        except Exception:
+            LOG.warning(f"Failed to load overlay background {fname}")
+            traceback.print_exc()
+            return None
+
+    def _render_job(bg, seg, output):
+        if bgs[bg] is None:
+            return False
+        try:
+            _render(bgs[bg], seg, output, title, regrid_cache)
+            return True
+        except Exception:
+            LOG.warning(f"Failed to render overlay {output}")
+            traceback.print_exc()
+            return False
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            bgs = dict(zip(bg_fnames, executor.map(_load, bg_fnames)))
+            futures = {output : executor.submit(_render_job, bg, seg, output) for bg, seg, output in jobs}
+            success = {output : future.result() for output, future in futures.items()}
+    finally:
+        # Keep regridded segmentations from the jobs which did complete
+        regrid_cache.save()
+    return success
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    options = ArgumentParser().parse_args()
+    render_overlays([(options.bg, options.seg, options.output)], options.subjid)
+
+if __name__ == "__main__":
+    main()
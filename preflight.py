@@ -0,0 +1,244 @@
+"""
+Pre-flight checks of DEMISTIFI pipeline input
+
+Indexes the DICOM series in a subject's Abdominal_MRI folder, including
+DICOM files inside UKB zip archives, by reading headers only, and works out
+which pipeline steps and data sets can be produced from the series found.
+Headers are read with pydicom if it is installed. Otherwise only the
+manifest files in UKB zip archives can be used. The checks fail open: a step is
+only ruled out for a subject whose series were all identified and matched, and
+which has none of the acquisitions the step uses. Other subjects are reported
+as unknown and no steps are ruled out for them
+"""
+import csv
+import fnmatch
+import io
+import logging
+import os
+import zipfile
+
+try:
+    import pydicom
+    from pydicom.errors import InvalidDicomError
+except ImportError:
+    pydicom = None
+
+LOG = logging.getLogger(__name__)
+
+# Acquisitions used by the pipeline: name -> wildcard patterns matched against
+# DICOM series descriptions, ignoring case. Series which match none of these are
+# reported so the patterns can be checked against new data
+ACQUISITIONS = {
+    "dixon" : ["*dixon*"],
+    "liver_ideal" : ["*ideal*"],
+    "pancreas_t1w" : ["*vibe*pancreas*"],
+    "liver_molli" : ["*shmolli*liver*"],
+    "pancreas_molli" : ["*shmolli*pancreas*"],
+    "kidney_molli" : ["*shmolli*kidney*"],
+    "liver_gre" : ["*gre*liver*"],
+    "pancreas_gre" : ["*gre*pancreas*"],
+    "kidney_gre" : ["*gre*kidney*"],
+}
+
+# Series known not to be used by the pipeline, matched like ACQUISITIONS. They are
+# not reported as unmatched series
+UNUSED_SERIES = ["*localiser*", "*localizer*", "*scout*"]
+
+# Acquisitions used by pipeline steps. A step can run if any of its acquisitions are present
+STEP_ACQUISITIONS = {
+    "renal_preproc" : ["liver_gre", "pancreas_gre", "kidney_gre", "liver_molli", "pancreas_molli", "kidney_molli"],
+    "seg_kidney_t1" : ["kidney_molli"],
+    "seg_dixon" : ["dixon"],
+    "seg_pancreas_t1w" : ["pancreas_t1w"],
+    "seg_liver_ideal" : ["liver_ideal"],
+}
+
+# Acquisitions needed for data sets in qpdata: (data set name pattern, acquisitions which
+# must all be present). The first matching pattern is used
+DATA_ACQUISITIONS = [
+    ("seg_kidney_*_t1_clean", ["kidney_molli", "dixon"]),
+    ("seg_kidney_*_t1", ["kidney_molli"]),
+    ("*_dixon", ["dixon"]),
+    ("fat_fraction", ["dixon"]),
+    ("vat", ["dixon"]),
+    ("asat", ["dixon"]),
+    ("*_t1w", ["pancreas_t1w"]),
+    ("*_ideal_*", ["liver_ideal"]),
+    ("seg_liver_ideal", ["liver_ideal"]),
+    ("*_liver_gre_*", ["liver_gre"]),
+    ("*_pancreas_gre_*", ["pancreas_gre"]),
+    ("*_kidney_gre_*", ["kidney_gre"]),
+    ("t1_liver_molli", ["liver_molli"]),
+    ("t1_pancreas_molli", ["pancreas_molli"]),
+    ("t1_kidney_molli", ["kidney_molli"]),
+]
+
+# Names of the manifest file in UKB zip archives (older archives use the misspelt extension)
+ZIP_MANIFESTS = ("manifest.csv", "manifest.cvs")
+
+def _series_description(fileobj):
+    """
+    :return: Series description from a DICOM header, or None if the file is not DICOM
+    """
+    try:
+        dcm = pydicom.dcmread(fileobj, stop_before_pixels=True, specific_tags=["SeriesDescription"])
+    except (InvalidDicomError, EOFError, OSError, ValueError):
+        return None
+    return str(dcm.get("SeriesDescription", ""))
+
+def _index_manifest(zf, name, series):
+    """
+    Count series from a UKB zip manifest, whose series description column may be misspelt
+
+    :return: True if the manifest has a series description column
+    """
+    with zf.open(name) as f:
+        reader = csv.DictReader(io.TextIOWrapper(f, encoding="utf-8", errors="replace"))
+        column = next((c for c in reader.fieldnames or [] if "series" in c.lower() and ("desc" in c.lower() or "discr" in c.lower())), None)
+        if column is None:
+            return False
+        for row in reader:
+            desc = (row.get(column) or "").strip()
+            series[desc] = series.get(desc, 0) + 1
+    return True
+
+def _index_zip(fname, series):
+    """
+    Count series of the DICOM files in a zip archive
+
+    :return: Number of files whose series could not be identified
+    """
+    with zipfile.ZipFile(fname) as zf:
+        names = [name for name in zf.namelist() if not name.endswith("/")]
+        manifests = [name for name in names if os.path.basename(name).lower() in ZIP_MANIFESTS]
+        if pydicom is None:
+            if manifests and _index_manifest(zf, manifests[0], series):
+                return 0
+            return len(names) - len(manifests)
+        for name in names:
+            if name in manifests:
+                continue
+            with zf.open(name) as f:
+                desc = _series_description(f)
+            if desc is not None:
+                series[desc] = series.get(desc, 0) + 1
+    return 0
+
+def index_input(indir):
+    """
+    Index the DICOM series in a subject's input folder, reading headers only
+
+    :return: Tuple of (mapping from series description to number of files, number of files
+             whose series could not be identified), or None if the folder does not exist
+    """
+    if not os.path.isdir(indir):
+        return None
+    series, unidentified = {}, 0
+    for root, _dirs, files in os.walk(indir):
+        for f in sorted(files):
+            fname = os.path.join(root, f)
+            try:
+                if f.lower().endswith(".zip"):
+                    unidentified += _index_zip(fname, series)
+                elif pydicom is None:
+                    unidentified += 1
+                else:
+                    desc = _series_description(fname)
+                    if desc is not None:
+                        series[desc] = series.get(desc, 0) + 1
+            except (OSError, zipfile.BadZipFile):
+                LOG.warning(f"Could not read input file {fname}")
+    return series, unidentified
+
+def series_acquisitions(desc):
+    """
+    :return: Names of acquisitions whose patterns match a series description
+    """
+    return [
+        name for name, patterns in ACQUISITIONS.items()
+        if any(fnmatch.fnmatchcase(desc.lower(), pattern) for pattern in patterns)
+    ]
+
+def unmatched_series(series):
+    """
+    :return: Sorted series descriptions matching no known acquisition and not known to be unused
+    """
+    return sorted(
+        desc for desc in series
+        if not series_acquisitions(desc) and not any(fnmatch.fnmatchcase(desc.lower(), pattern) for pattern in UNUSED_SERIES)
+    )
+
+def acquisitions_found(series):
+    """
+    :return: Set of names of acquisitions present in the series
+    """
+    return set(name for desc in series for name in series_acquisitions(desc))
+
+def data_acquisitions(name):
+    """
+    :return: Acquisitions needed for a data set, or None if it is not known
+    """
+    for pattern, acquisitions in DATA_ACQUISITIONS:
+        if fnmatch.fnmatchcase(name, pattern):
+            return acquisitions
+    return None
+
+def check_subject(indir, data_names):
+    """
+    Work out which steps and data sets are feasible for a subject
+
+    Steps are only ruled out when the descriptions of all series were read and
+    matched, so a step whose acquisition has been renamed is not silently dropped -
+    the series it would use is reported as unmatched instead
+
+    :param data_names: Names of data sets the pipeline puts in qpdata
+    :return: Dict of status ('ok', 'no_input' if there is no DICOM data, or 'unknown' if any series
+             could not be identified or matched no known acquisition), series found, series
+             matching no acquisition, acquisitions found, steps which cannot run and data sets which
+             can be produced. If the status is not 'ok' no steps are ruled out, since a subject
+             without input may still have output from a previous run
+    """
+    index = index_input(indir)
+    series, unidentified = index if index is not None else ({}, 0)
+    found, unmatched = acquisitions_found(series), unmatched_series(series)
+    if unidentified or unmatched or (series and not found):
+        status = "unknown"
+    elif not series:
+        status = "no_input"
+    else:
+        status = "ok"
+
+    infeasible_steps, feasible_data = [], list(data_names)
+    if status == "ok":
+        infeasible_steps = sorted(step for step, needed in STEP_ACQUISITIONS.items() if not found.intersection(needed))
+        feasible_data = [name for name in data_names if found.issuperset(data_acquisitions(name) or [])]
+    elif status == "no_input":
+        feasible_data = []
+    return {
+        "status" : status,
+        "series" : series,
+        "unidentified" : unidentified,
+        "unmatched" : unmatched,
+        "acquisitions" : sorted(found),
+        "infeasible_steps" : infeasible_steps,
+        "feasible_data" : feasible_data,
+    }
+
+def write_table(fname, checks, num_data):
+    """
+    Write a cohort feasibility table with one row per subject
+
+    :param checks: Mapping from subject ID to check_subject() result
+    :param num_data: Number of data sets the pipeline puts in qpdata
+    """
+    steps = sorted(STEP_ACQUISITIONS)
+    with open(fname, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["subjid", "status", "num_series", "num_unmatched"] + list(ACQUISITIONS) + steps + ["num_data", "%"])
+        for subjid, check in checks.items():
+            writer.writerow(
+                [subjid, check["status"], len(check["series"]), len(check["unmatched"])] +
+                [int(name in check["acquisitions"]) for name in ACQUISITIONS] +
+                [int(step not in check["infeasible_steps"]) for step in steps] +
+                [len(check["feasible_data"]), round(100 * float(len(check["feasible_data"])) / max(1, num_data), 1)]
+            )
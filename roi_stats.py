@@ -0,0 +1,506 @@
+"""
+Native ROI statistics for DEMISTIFI
+
+Runs the processing steps of a Quantiphyse batch script (resample_and_stats.qp)
+in-process using NumPy, writing seg_volumes.tsv and <organ>_<seg>_stats.tsv in
+the same layout as Quantiphyse without starting it. Only the processes used
+by the DEMISTIFI scripts are supported: Load, Exec, Resample, CalcVolumes,
+DataStatistics, Save and SaveExtras. The statistics have not yet been
+validated against Quantiphyse output, so the pipeline only uses them with
+--stats-engine=native
+
+Usage: roi_stats.py --qp resample_and_stats.qp --indir <subj>/qpdata --outdir <subj>/stats
+"""
+import argparse
+import contextlib
+import fcntl
+import gzip
+import hashlib
+import logging
+import os
+import re
+import shutil
+import sys
+import threading
+import traceback
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+import yaml
+
+LOG = logging.getLogger(__name__)
+
+# Statistics output by DataStatistics, in output order
+STATS = ["Mean", "Median", "STD", "Min", "Max", "Interquartile mean", "Interquartile STD", "Mode estimate", "FWHM estimate", "N"]
+
+# Maximum number of histogram bins used for the mode and FWHM estimates
+MAX_HIST_BINS = 1000
+
+# Size of chunks used when decompressing NIfTI files into the NIfTI cache
+DECOMPRESS_CHUNK = 4 * 1024 * 1024
+
+class ArgumentParser(argparse.ArgumentParser):
+    def __init__(self, **kwargs):
+        argparse.ArgumentParser.__init__(self, prog="demistifi-roi-stats", add_help=True, **kwargs)
+        self.add_argument("--qp", required=True, help="Quantiphyse batch script defining the processing")
+        self.add_argument("--indir", required=True, help="Directory containing input data and ROIs")
+        self.add_argument("--outdir", required=True, help="Output directory")
+        self.add_argument("--regrid-cache", help="File to load and save resampling index maps so they can be reused for other subjects")
+
+class Dataset:
+    """
+    Image data on a grid, loaded from file when first used
+    """
+    def __init__(self, name, fname=None, data=None, affine=None, roi=False):
+        self.name = name
+        self.fname = fname
+        self.roi = roi
+        self._data = data
+        self._affine = affine
+        self._nii = None
+
+    def _load_header(self):
+        if self._nii is None:
+            self._nii = load_nifti(self.fname)
+            self._affine = self._nii.affine
+
+    @property
+    def affine(self):
+        if self._affine is None:
+            self._load_header()
+        return self._affine
+
+    @property
+    def shape(self):
+        if self._data is not None:
+            return self._data.shape
+        self._load_header()
+        return _spatial_shape(self._nii.shape)
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._load_header()
+            if self.roi:
+                data = np.asanyarray(self._nii.dataobj)
+            else:
+                data = self._nii.get_fdata(dtype=np.float32)
+            self._data = data.reshape(_spatial_shape(data.shape))
+        return self._data
+
+def _spatial_shape(shape):
+    """
+    :return: 3D shape, dropping trailing singleton dimensions and padding 2D data
+    """
+    shape = tuple(shape)
+    while len(shape) > 3 and shape[-1] == 1:
+        shape = shape[:-1]
+    while len(shape) < 3:
+        shape = shape + (1,)
+    return shape
+
+class RegridCache:
+    """
+    Nearest neighbour index maps between pairs of grids
+
+    An index map gives, for each voxel of the target grid, the flattened index
+    of the source voxel nearest to it (or -1 if it lies outside the source grid).
+    It depends only on the affines and shapes of the two grids, so it is
+    computed once and then applied to every dataset resampled between the
+    same grids. Maps can be saved to a file and loaded for other subjects, since
+    acquisition protocols keep most grids constant across a cohort.
+    """
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, fname=None):
+        self.fname = fname
+        self._maps = {}
+        self._new_keys = set()
+        self._lock = threading.Lock()
+        if fname and os.path.exists(fname):
+            self._maps.update(self._read(fname))
+
+    @classmethod
+    def shared(cls, fname=None):
+        """
+        :return: Process-wide cache instance for the given file
+        """
+        with cls._shared_lock:
+            if fname not in cls._shared:
+                cls._shared[fname] = cls(fname)
+            return cls._shared[fname]
+
+    @staticmethod
+    def _read(fname):
+        try:
+            with np.load(fname) as maps:
+                return {key : maps[key] for key in maps.files}
+        except (OSError, ValueError):
+            LOG.warning(f"Could not read resampling index maps from {fname}")
+            return {}
+
+    @staticmethod
+    def key(src_affine, src_shape, tgt_affine, tgt_shape):
+        """
+        :return: Key identifying a pair of grids. Affines are rounded to avoid spurious
+                 differences from floating point noise in the headers
+        """
+        sha = hashlib.sha1()
+        for affine, shape in ((src_affine, src_shape), (tgt_affine, tgt_shape)):
+            sha.update(np.round(np.asarray(affine, dtype=np.float64), 4).tobytes())
+            sha.update(np.asarray(shape[:3], dtype=np.int64).tobytes())
+        return "map_" + sha.hexdigest()
+
+    def index_map(self, src_affine, src_shape, tgt_affine, tgt_shape):
+        """
+        :return: Flattened source voxel index for each target voxel, -1 if outside the source grid
+        """
+        key = self.key(src_affine, src_shape, tgt_affine, tgt_shape)
+        with self._lock:
+            if key in self._maps:
+                return self._maps[key]
+
+        src_shape, tgt_shape = tuple(src_shape[:3]), tuple(tgt_shape[:3])
+        src_vox = nib.affines.apply_affine(np.linalg.inv(src_affine) @ tgt_affine, np.indices(tgt_shape).reshape(3, -1).T)
+        src_vox = np.rint(src_vox).astype(np.int64)
+        valid = np.all((src_vox >= 0) & (src_vox < np.array(src_shape)), axis=1)
+        dtype = np.int32 if np.prod(src_shape) < np.iinfo(np.int32).max else np.int64
+        idx = np.full(len(src_vox), -1, dtype=dtype)
+        idx[valid] = np.ravel_multi_index(tuple(src_vox[valid].T), src_shape)
+        with self._lock:
+            self._maps[key] = idx
+            self._new_keys.add(key)
+        return idx
+
+    def resample(self, data, src_affine, tgt_affine, tgt_shape):
+        """
+        Nearest neighbour resampling of 3D data onto a target grid
+
+        Target voxels which lie outside the source grid are set to zero
+        """
+        tgt_shape = tuple(tgt_shape[:3])
+        idx = self.index_map(src_affine, data.shape, tgt_affine, tgt_shape)
+        resampled = np.zeros(idx.shape, dtype=data.dtype)
+        valid = idx >= 0
+        resampled[valid] = data.reshape(-1)[idx[valid]]
+        return resampled.reshape(tgt_shape)
+
+    def save(self):
+        """
+        Save any new index maps, merging with maps saved to the same file by other processes
+
+        The file is locked while it is read, merged and replaced so maps saved by
+        another process at the same time are not lost
+        """
+        if not self.fname:
+            return
+        with self._lock:
+            if not self._new_keys:
+                return
+            with open(f"{self.fname}.lock", "a") as lock_f:
+                fcntl.flock(lock_f, fcntl.LOCK_EX)
+                maps = self._read(self.fname) if os.path.exists(self.fname) else {}
+                maps.update(self._maps)
+                tmp_fname = f"{self.fname}.{os.getpid()}.tmp.npz"
+                np.savez(tmp_fname, **maps)
+                os.replace(tmp_fname, self.fname)
+            self._new_keys.clear()
+
+def resample_nn(data, src_affine, tgt_affine, tgt_shape):
+    """
+    Nearest neighbour resampling of 3D data onto a target grid using the shared in-memory cache
+    """
+    return RegridCache.shared().resample(data, src_affine, tgt_affine, tgt_shape)
+
+class NiftiCache:
+    """
+    Uncompressed copies of compressed NIfTI files
+
+    Files read by several steps (e.g. the background maps used for overlays,
+    mask cleaning and statistics) are decompressed once into the cache
+    directory and then memory mapped by every reader. Copies are keyed by the
+    real path, size and modification time of the compressed file, so a file
+    which is rewritten gets a new copy. The pipeline activates a cache for each
+    subject and removes it when the subject finishes
+    """
+    _active = None
+
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+        self.decompressed, self.hits = 0, 0
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        os.makedirs(cachedir, exist_ok=True)
+
+    def path(self, fname):
+        """
+        :return: Path to an uncompressed copy of a compressed NIfTI file, decompressing it if required
+        """
+        real_fname = os.path.realpath(fname)
+        stat = os.stat(real_fname)
+        key = hashlib.sha1(f"{real_fname}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()
+        cached = os.path.join(self.cachedir, f"{key}.nii")
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if os.path.exists(cached):
+                with self._lock:
+                    self.hits += 1
+                return cached
+            tmp_cached = f"{cached}.tmp"
+            with gzip.open(real_fname, "rb") as src, open(tmp_cached, "wb") as dest:
+                shutil.copyfileobj(src, dest, DECOMPRESS_CHUNK)
+            os.replace(tmp_cached, cached)
+            with self._lock:
+                self.decompressed += 1
+        return cached
+
+    def load(self, fname):
+        """
+        :return: NIfTI image, memory mapped from the uncompressed copy if the file is compressed
+        """
+        if not fname.endswith(".nii.gz"):
+            return nib.load(fname)
+        try:
+            return nib.load(self.path(fname), mmap=True)
+        except (OSError, EOFError):
+            LOG.warning(f"Could not cache uncompressed copy of {fname}")
+            return nib.load(fname)
+
+    def clear(self):
+        """
+        Remove all cached copies
+        """
+        shutil.rmtree(self.cachedir, ignore_errors=True)
+
+    @classmethod
+    @contextlib.contextmanager
+    def activate(cls, cachedir):
+        """
+        Use a cache for all NIfTI files loaded with load_nifti() in this process, removing it on exit
+
+        :return: The cache
+        """
+        cache = cls(cachedir)
+        previous, cls._active = cls._active, cache
+        try:
+            yield cache
+        finally:
+            cls._active = previous
+            cache.clear()
+
+def load_nifti(fname):
+    """
+    Load a NIfTI file using the active NiftiCache, if any
+    """
+    cache = NiftiCache._active
+    return cache.load(fname) if cache is not None else nib.load(fname)
+
+def mode_fwhm(values):
+    """
+    Estimate the mode and full width at half maximum of a distribution from its histogram
+
+    :return: tuple of mode, FWHM
+    """
+    vmin, vmax = values.min(), values.max()
+    if vmin == vmax:
+        return float(vmin), 0.0
+    edges = np.histogram_bin_edges(values, bins="fd")
+    if len(edges) > MAX_HIST_BINS + 1:
+        edges = np.linspace(vmin, vmax, MAX_HIST_BINS + 1)
+    hist, edges = np.histogram(values, bins=edges)
+    peak = int(np.argmax(hist))
+    half_max = hist[peak] / 2.0
+    left, right = peak, peak
+    while left > 0 and hist[left-1] >= half_max:
+        left -= 1
+    while right < len(hist) - 1 and hist[right+1] >= half_max:
+        right += 1
+    return float((edges[peak] + edges[peak+1]) / 2), float(edges[right+1] - edges[left])
+
+def summary_stats(values):
+    """
+    :return: dict of statistic name -> value for an array of voxel values
+    """
+    if values.size == 0:
+        stats = {name : np.nan for name in STATS}
+        stats["N"] = 0
+        return stats
+
+    values = values.astype(np.float64)
+    q1, q3 = np.percentile(values, [25, 75])
+    iq_values = values[(values >= q1) & (values <= q3)]
+    mode, fwhm = mode_fwhm(values)
+    return {
+        "Mean" : np.mean(values),
+        "Median" : np.median(values),
+        "STD" : np.std(values),
+        "Min" : np.min(values),
+        "Max" : np.max(values),
+        "Interquartile mean" : np.mean(iq_values),
+        "Interquartile STD" : np.std(iq_values),
+        "Mode estimate" : mode,
+        "FWHM estimate" : fwhm,
+        "N" : values.size,
+    }
+
+class NativeBatch:
+    """
+    Runs the processing steps of a Quantiphyse batch script for one case
+    """
+    def __init__(self, indir, outdir, regrid_cache=None):
+        self.indir = indir
+        self.outdir = outdir
+        self.regrid_cache = regrid_cache if regrid_cache is not None else RegridCache.shared()
+        self.datasets = {}
+        self.extras = {}
+
+    def run(self, processing):
+        """
+        Run a list of processing steps as parsed from the batch script
+
+        As in Quantiphyse, a failed process is logged and the remaining processes are still run
+
+        :return: True if all processes succeeded
+        """
+        success = True
+        for process in processing:
+            (process_name, params), = process.items()
+            method = getattr(self, f"_{process_name.lower()}", None)
+            if method is None:
+                LOG.warning(f"Unsupported process: {process_name} - ignoring")
+                continue
+            try:
+                method(params or {})
+            except Exception:
+                LOG.warning(f"Process {process_name} failed:\n{traceback.format_exc()}")
+                success = False
+        return success
+
+    def _on_grid(self, name, grid):
+        """
+        :return: Data for a dataset resampled if necessary onto the grid of another dataset
+        """
+        dataset = self.datasets[name]
+        if dataset.shape == grid.shape and np.allclose(dataset.affine, grid.affine):
+            return dataset.data
+        return self.regrid_cache.resample(dataset.data, dataset.affine, grid.affine, grid.shape)
+
+    def _load(self, params):
+        for section, roi in (("data", False), ("rois", True)):
+            for fname, name in (params.get(section) or {}).items():
+                if name is None:
+                    name = fname.split(".")[0]
+                path = os.path.join(self.indir, fname)
+                if os.path.exists(path):
+                    self.datasets[name] = Dataset(name, fname=path, roi=roi)
+                else:
+                    LOG.warning(f"Data file not found: {path}")
+
+    def _exec(self, params):
+        params = dict(params)
+        grid = self.datasets[params.pop("grid")]
+        output_is_roi = params.pop("output-is-roi", False)
+        for output_name, expr in params.items():
+            names = set(re.findall(r"[A-Za-z_]\w*", str(expr))) & set(self.datasets)
+            namespace = {name : self._on_grid(name, grid) for name in names}
+            result = np.asarray(eval(str(expr), {"np" : np}, namespace))
+            if result.shape != grid.shape:
+                LOG.warning(f"Exec result {output_name} has shape {result.shape} - expected {grid.shape}. Ignoring")
+                continue
+            self.datasets[output_name] = Dataset(output_name, data=result, affine=grid.affine, roi=output_is_roi)
+
+    def _resample(self, params):
+        if params.get("order", 0) != 0:
+            raise ValueError("Only nearest neighbour (order 0) resampling is supported")
+        data, grid = self.datasets[params["data"]], self.datasets[params["grid"]]
+        output_name = params.get("output-name", params["data"] + "_res")
+        resampled = self._on_grid(data.name, grid)
+        self.datasets[output_name] = Dataset(output_name, data=resampled, affine=grid.affine, roi=data.roi)
+
+    def _calcvolumes(self, params):
+        scale = 1000.0 if params.get("units", "") == "ml" else 1.0
+        units = "ml" if scale != 1.0 else "mm^3"
+        volumes = {}
+        for name in params.get("rois", []):
+            if name not in self.datasets:
+                LOG.warning(f"ROI not found for volume calculation: {name}")
+                continue
+            roi = self.datasets[name]
+            n = int(np.count_nonzero(roi.data))
+            voxel_vol = abs(np.linalg.det(roi.affine[:3, :3]))
+            volumes[name] = [n, n * voxel_vol / scale]
+        self.extras[params.get("output-name", "roi-vols")] = pd.DataFrame(volumes, index=["N", f"Volume ({units})"], dtype=object)
+
+    def _datastatistics(self, params):
+        """
+        Summary statistics of data within an ROI
+
+        Values outside the data-limits for a data set are excluded from its statistics
+        rather than clipped to the limits, as in Quantiphyse, so the output matches
+        statistics previously generated by Quantiphyse
+        """
+        roi = self.datasets[params["roi"]]
+        data_names = params.get("data", [])
+        if isinstance(data_names, str):
+            data_names = [data_names]
+        limits = params.get("data-limits") or {}
+        stats = {}
+        for name in data_names:
+            if name not in self.datasets:
+                LOG.warning(f"Data not found for statistics: {name}")
+                continue
+            data = self.datasets[name]
+            values = data.data[self._on_grid(roi.name, data) > 0]
+            values = values[np.isfinite(values)]
+            if name in limits:
+                vmin, vmax = limits[name]
+                values = values[(values >= vmin) & (values <= vmax)]
+            stats[name] = summary_stats(values)
+        # Series of objects keep N as an integer, as written by Quantiphyse
+        self.extras[params.get("output-name", "stats")] = pd.DataFrame(
+            {name : pd.Series(data_stats, dtype=object) for name, data_stats in stats.items()}, index=STATS)
+
+    def _save(self, params):
+        os.makedirs(self.outdir, exist_ok=True)
+        for name, fname in params.items():
+            if name not in self.datasets:
+                LOG.warning(f"Data not found for saving: {name}")
+                continue
+            dataset = self.datasets[name]
+            nib.Nifti1Image(dataset.data, dataset.affine).to_filename(os.path.join(self.outdir, fname or f"{name}.nii.gz"))
+
+    def _saveextras(self, params):
+        os.makedirs(self.outdir, exist_ok=True)
+        for name, fname in params.items():
+            if name not in self.extras:
+                LOG.warning(f"Output not found for saving: {name}")
+                continue
+            self.extras[name].to_csv(os.path.join(self.outdir, fname or f"{name}.tsv"), sep="\t", na_rep="nan")
+
+def run_batch(qp_script, indir, outdir, regrid_cache=None):
+    """
+    Run the processing in a Quantiphyse batch script for the data in indir
+
+    :param regrid_cache: RegridCache to use for resampling. If it has a file name, any
+                         new index maps are saved to it when processing is complete
+    :return: True if all processes succeeded
+    """
+    with open(qp_script, "r") as f:
+        config = yaml.safe_load(f)
+    if regrid_cache is None:
+        regrid_cache = RegridCache.shared()
+    success = NativeBatch(indir, outdir, regrid_cache).run(config.get("Processing", []))
+    regrid_cache.save()
+    return success
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    options = ArgumentParser().parse_args()
+    if not run_batch(options.qp, options.indir, options.outdir, RegridCache.shared(options.regrid_cache)):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Build a cohort-wide index of ROI statistics from output of DEMISTIFI pipeline
+
+All <organ>_<seg>_stats.tsv and seg_volumes.tsv files in subject stats folders
+are read into a single long-format SQLite table so that IDPs which are not
+in generate_subject_idps.py can be extracted with a query, e.g.
+
+    SELECT subjid, value FROM stats
+    WHERE roi='seg_liver_dixon' AND dataset='pdff_liver_ideal_presco' AND statistic='Median'
+
+Columns of the stats table are:
+
+ - subjid    : Subject ID
+ - source    : Stats file the value was read from
+ - roi       : Segmentation name (seg_<organ>_<seg> for <organ>_<seg>_stats.tsv,
+               the column name for seg_volumes.tsv)
+ - dataset   : Data set the statistic was calculated from (empty for seg_volumes.tsv)
+ - statistic : Statistic, e.g. Median or Volume (ml)
+ - value     : Value, or NULL if it was not a number
+
+Running again on an existing index only re-reads stats files whose size or
+modification time has changed and removes data for files which no longer exist
+"""
+import argparse
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import logging
+import math
+import os
+import sqlite3
+
+LOG = logging.getLogger(__name__)
+
+# Number of subjects queued for each worker process when reading stats in parallel
+IN_FLIGHT_PER_JOB = 4
+
+# Number of subjects written to the index in each transaction
+COMMIT_SUBJECTS = 500
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS stats (subjid TEXT, source TEXT, roi TEXT, dataset TEXT, statistic TEXT, value REAL)",
+    "CREATE TABLE IF NOT EXISTS files (subjid TEXT, source TEXT, size INTEGER, mtime_ns INTEGER, PRIMARY KEY (subjid, source))",
+]
+
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS stats_roi ON stats (roi, dataset, statistic)",
+    "CREATE INDEX IF NOT EXISTS stats_subjid ON stats (subjid, source)",
+]
+
+class ArgumentParser(argparse.ArgumentParser):
+    def __init__(self, **kwargs):
+        argparse.ArgumentParser.__init__(self, prog="stats_index", add_help=True, **kwargs)
+        self.add_argument("--input", required=True, help="Input directory containing subject dirs")
+        self.add_argument("--statspath", help="Subject dir subfolder containing stats", default="stats")
+        self.add_argument("--output", help="Output SQLite database", default="demistifi_stats.sqlite")
+        self.add_argument("--jobs", help="Number of processes used to read stats files", type=int, default=len(os.sched_getaffinity(0)))
+
+def _value(cell):
+    try:
+        value = float(cell)
+        return None if math.isnan(value) else value
+    except ValueError:
+        return None
+
+def read_stats_file(subjid, fname, source):
+    """
+    Read a stats file into long format rows
+
+    :return: List of (subjid, source, roi, dataset, statistic, value)
+    """
+    with open(fname, "r", newline="") as f:
+        lines = [[cell.strip() for cell in line] for line in csv.reader(f, delimiter="\t")]
+    if not lines:
+        return []
+    header, rows = lines[0][1:], lines[1:]
+    if source == "seg_volumes.tsv":
+        return [(subjid, source, roi, "", row[0], _value(cell)) for row in rows for roi, cell in zip(header, row[1:])]
+    roi = "seg_" + source[:-len("_stats.tsv")]
+    return [(subjid, source, roi, dataset, row[0], _value(cell)) for row in rows for dataset, cell in zip(header, row[1:])]
+
+def read_subject(statsdir, subjid, known):
+    """
+    Read the stats files for a subject which have changed since they were indexed
+
+    :param known: Mapping from stats file name to (size, mtime_ns) of the indexed version
+    :return: Tuple of (mapping from file name to (size, mtime_ns) for all stats files,
+             mapping from file name to rows for files which have changed)
+    """
+    found, changed = {}, {}
+    try:
+        entries = list(os.scandir(statsdir))
+    except OSError:
+        LOG.warning(f"No stats folder for subject {subjid}: {statsdir}")
+        return found, changed
+
+    for entry in entries:
+        if entry.name != "seg_volumes.tsv" and not entry.name.endswith("_stats.tsv"):
+            continue
+        try:
+            stat = entry.stat()
+            found[entry.name] = (stat.st_size, stat.st_mtime_ns)
+            if known.get(entry.name) != found[entry.name]:
+                changed[entry.name] = read_stats_file(subjid, entry.path, entry.name)
+        except (OSError, ValueError):
+            LOG.warning(f"Failed to read stats file: {entry.path}")
+            found.pop(entry.name, None)
+    return found, changed
+
+def iter_subjects(options, subjids, known):
+    """
+    Read stats for subjects using a pool of worker processes
+
+    :return: Generator of (subjid, read_subject result) in subject order
+    """
+    args = [(os.path.join(options.input, subjid, options.statspath), subjid, known.get(subjid, {})) for subjid in subjids]
+    if options.jobs <= 1:
+        for subj_args in args:
+            yield subj_args[1], read_subject(*subj_args)
+        return
+
+    max_in_flight = options.jobs * IN_FLIGHT_PER_JOB
+    with ProcessPoolExecutor(max_workers=options.jobs) as executor:
+        in_flight = collections.deque()
+        for subj_args in args:
+            in_flight.append((subj_args[1], executor.submit(read_subject, *subj_args)))
+            if len(in_flight) >= max_in_flight:
+                subjid, future = in_flight.popleft()
+                yield subjid, future.result()
+        while in_flight:
+            subjid, future = in_flight.popleft()
+            yield subjid, future.result()
+
+def build_index(options):
+    """
+    Create or update the stats index
+    """
+    subjids = sorted(f for f in os.listdir(options.input) if os.path.isdir(os.path.join(options.input, f)))
+    conn = sqlite3.connect(options.output)
+    try:
+        for statement in SCHEMA + INDEXES:
+            conn.execute(statement)
+        known = collections.defaultdict(dict)
+        for subjid, source, size, mtime_ns in conn.execute("SELECT subjid, source, size, mtime_ns FROM files"):
+            known[subjid][source] = (size, mtime_ns)
+
+        removed = set(known) - set(subjids)
+        for subjid in removed:
+            conn.execute("DELETE FROM stats WHERE subjid=?", (subjid,))
+            conn.execute("DELETE FROM files WHERE subjid=?", (subjid,))
+
+        num_updated = 0
+        for idx, (subjid, (found, changed)) in enumerate(iter_subjects(options, subjids, known)):
+            stale = [source for source in known.get(subjid, {}) if source not in found or source in changed]
+            for source in stale:
+                conn.execute("DELETE FROM stats WHERE subjid=? AND source=?", (subjid, source))
+                conn.execute("DELETE FROM files WHERE subjid=? AND source=?", (subjid, source))
+            for source, rows in changed.items():
+                conn.executemany("INSERT INTO stats VALUES (?, ?, ?, ?, ?, ?)", rows)
+                conn.execute("INSERT INTO files VALUES (?, ?, ?, ?)", (subjid, source) + found[source])
+            if stale or changed:
+                num_updated += 1
+                LOG.debug(f"Updated stats for subject {subjid}: {sorted(changed)}")
+            if (idx + 1) % COMMIT_SUBJECTS == 0:
+                conn.commit()
+        conn.commit()
+        LOG.info(f"Indexed {len(subjids)} subjects: {num_updated} updated, {len(removed)} removed")
+    finally:
+        conn.close()
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    options = ArgumentParser().parse_args()
+    build_index(options)
+
+if __name__ == "__main__":
+    main()
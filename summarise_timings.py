@@ -0,0 +1,128 @@
+"""
+Summarise step run times and resource usage from DEMISTIFI pipeline output
+
+Reads the step_timings.json file in each subject output directory and writes
+a table of percentiles of each measure for each step. Resource profiles for
+the pipeline's --profiles option can also be learned from the timings
+
+Usage: summarise_timings.py --input <pipeline output dir> [--output timings_summary.csv] [--profiles-output profiles.json]
+"""
+import argparse
+import json
+import logging
+import math
+import os
+
+import pandas as pd
+
+LOG = logging.getLogger(__name__)
+
+# Measures summarised for each step
+MEASURES = ["wall_s", "cpu_user_s", "cpu_sys_s", "python_cpu_s", "max_rss_mb", "input_bytes", "output_bytes"]
+
+# Percentiles reported for each measure
+PERCENTILES = [0.5, 0.9, 0.95, 0.99]
+
+# Percentile of memory and CPU use of successful runs used for learned resource profiles
+PROFILE_PERCENTILE = 0.95
+
+# Learned memory profiles are the percentile of peak memory multiplied by this
+PROFILE_MEM_HEADROOM = 1.25
+
+# Learned timeouts are the longest successful run time multiplied by this, with a minimum in seconds
+PROFILE_TIMEOUT_FACTOR = 3
+PROFILE_MIN_TIMEOUT_S = 600
+
+# Minimum number of successful runs of a step needed to learn its profile
+PROFILE_MIN_RUNS = 5
+
+class ArgumentParser(argparse.ArgumentParser):
+    def __init__(self, **kwargs):
+        argparse.ArgumentParser.__init__(self, prog="summarise_timings", add_help=True, **kwargs)
+        self.add_argument("--input", required=True, help="Pipeline output directory containing subject dirs")
+        self.add_argument("--output", help="Output CSV file for the summary table")
+        self.add_argument("--steps-output", help="Output CSV file for the timings of every step of every subject")
+        self.add_argument("--include-failed", action="store_true", default=False, help="Include steps which failed")
+        self.add_argument("--profiles-output", help="Output JSON file for step resource profiles learned from successful runs")
+
+def load_timings(outdir):
+    """
+    :return: DataFrame with one row for each step of each subject
+    """
+    rows = []
+    with os.scandir(outdir) as entries:
+        for entry in entries:
+            fname = os.path.join(entry.path, "step_timings.json")
+            if not entry.is_dir() or not os.path.exists(fname):
+                continue
+            try:
+                with open(fname, "r") as f:
+                    timings = json.load(f)
+            except ValueError:
+                LOG.warning(f"Invalid step timings file: {fname}")
+                continue
+            for step, usage in timings.get("steps", {}).items():
+                rows.append(dict(usage, subjid=timings.get("subjid", entry.name), step=step))
+    return pd.DataFrame(rows)
+
+def summarise(df):
+    """
+    :return: DataFrame of count, mean, percentiles and maximum of each measure for each step
+    """
+    measures = [m for m in MEASURES if m in df.columns]
+    summary = df.groupby("step")[measures].describe(percentiles=PERCENTILES)
+    keep = ["count", "mean"] + [f"{p*100:g}%" for p in PERCENTILES] + ["max"]
+    summary = summary.loc[:, [(m, stat) for m in measures for stat in keep]]
+    return summary.sort_values(("wall_s", "mean"), ascending=False) if "wall_s" in measures else summary
+
+def learn_profiles(df):
+    """
+    Learn step resource profiles from successful runs
+
+    :return: Mapping from step name to dict of mem_gb, cpus and timeout_s. Memory is only
+             given for steps which ran commands
+    """
+    profiles = {}
+    df = df[df["status"] == "ok"]
+    for step, runs in df.groupby("step"):
+        if len(runs) < PROFILE_MIN_RUNS:
+            LOG.info(f"Not learning profile for step {step} - only {len(runs)} successful runs")
+            continue
+        cpu_s = sum(runs[m].fillna(0) for m in ("cpu_user_s", "cpu_sys_s", "python_cpu_s") if m in runs)
+        cpus = (cpu_s / runs["wall_s"].clip(lower=1e-3)).quantile(PROFILE_PERCENTILE)
+        profile = {
+            "cpus" : max(1, math.ceil(cpus)),
+            "timeout_s" : max(PROFILE_MIN_TIMEOUT_S, math.ceil(runs["wall_s"].max() * PROFILE_TIMEOUT_FACTOR)),
+        }
+        if "max_rss_mb" in runs and runs["max_rss_mb"].notna().any():
+            profile["mem_gb"] = math.ceil(runs["max_rss_mb"].quantile(PROFILE_PERCENTILE) * PROFILE_MEM_HEADROOM / 1024 * 10) / 10
+        profiles[step] = profile
+    return profiles
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    options = ArgumentParser().parse_args()
+    df = load_timings(options.input)
+    if df.empty:
+        LOG.warning(f"No step timings found in {options.input}")
+        return
+    if not options.include_failed:
+        df = df[df["status"] == "ok"]
+    LOG.info(f"Loaded timings for {df['subjid'].nunique()} subjects")
+    if options.steps_output:
+        df.to_csv(options.steps_output, index=False)
+
+    if options.profiles_output:
+        with open(options.profiles_output, "w") as f:
+            json.dump(learn_profiles(df), f, indent=1)
+
+    summary = summarise(df)
+    if options.output:
+        summary.to_csv(options.output)
+    with pd.option_context("display.width", 200, "display.max_columns", None, "display.float_format", "{:.3f}".format):
+        for measure in sorted(set(summary.columns.get_level_values(0)), key=MEASURES.index):
+            print(f"\n{measure}")
+            print(summary[measure])
+
+if __name__ == "__main__":
+    main()
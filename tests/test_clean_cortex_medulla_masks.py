@@ -0,0 +1,39 @@
+"""
+Tests for the kidney mask blob filter
+"""
+import numpy as np
+
+import clean_cortex_medulla_masks
+
+def _blob(mask, rows, cols, value=1):
+    mask[rows[0]:rows[1], cols[0]:cols[1]] = value
+
+def test_clean_kidney_mask():
+    # For a 120x120 mask blobs smaller than 36 are removed, as are blobs centred
+    # in rows 50-70, left of column 30, right of column 90, above row 20 or below row 100
+    mask = np.zeros((120, 120), dtype=np.int64)
+    _blob(mask, (30, 40), (35, 45), 2)
+    _blob(mask, (80, 90), (75, 85))
+    _blob(mask, (30, 32), (60, 62))
+    _blob(mask, (55, 65), (55, 65))
+    _blob(mask, (80, 90), (5, 15))
+    _blob(mask, (105, 115), (55, 65))
+
+    expected = np.zeros_like(mask)
+    _blob(expected, (30, 40), (35, 45), 2)
+    _blob(expected, (80, 90), (75, 85))
+    np.testing.assert_array_equal(clean_cortex_medulla_masks.clean_kidney_mask(mask), expected)
+
+def test_clean_kidney_mask_size_uses_slice_counts():
+    # 5x5 blob has area 25 but covers 50 voxels over two slices, above the threshold of 36
+    mask = np.zeros((120, 120), dtype=np.int64)
+    _blob(mask, (30, 35), (40, 45), 2)
+    _blob(mask, (80, 85), (40, 45), 1)
+
+    expected = np.zeros_like(mask)
+    _blob(expected, (30, 35), (40, 45), 2)
+    np.testing.assert_array_equal(clean_cortex_medulla_masks.clean_kidney_mask(mask), expected)
+
+def test_clean_kidney_mask_empty():
+    mask = np.zeros((60, 60), dtype=np.int64)
+    np.testing.assert_array_equal(clean_cortex_medulla_masks.clean_kidney_mask(mask), mask)
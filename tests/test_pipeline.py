@@ -0,0 +1,84 @@
+"""
+Tests for the pipeline's mask arithmetic and scratch staging
+"""
+import argparse
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+import demistifi_pipeline as pipeline
+
+def test_mask_ops():
+    mask1, mask2 = np.array([0, 1, 1, 0], dtype=np.int16), np.array([0, 0, 1, 1], dtype=np.int16)
+    np.testing.assert_array_equal(pipeline.MASK_OPS["add"](mask1, mask2, mask2), [0, 1, 3, 2])
+    np.testing.assert_array_equal(pipeline.MASK_OPS["sub"](mask1, mask2), [0, 1, 0, -1])
+    np.testing.assert_array_equal(pipeline.MASK_OPS["union"](mask1, 2 * mask2), [0, 1, 1, 1])
+    np.testing.assert_array_equal(pipeline.MASK_OPS["clip"](np.array([-1, 0, 1, 2]), 0, 1), [0, 0, 1, 1])
+
+def _save_mask(maskdir, name, data):
+    nib.Nifti1Image(np.asarray(data, dtype=np.uint8), np.eye(4)).to_filename(os.path.join(maskdir, f"{name}.nii.gz"))
+
+def _load_mask(maskdir, name):
+    nii = nib.load(os.path.join(maskdir, f"{name}.nii.gz"))
+    assert nii.get_data_dtype() == np.uint8
+    return np.asarray(nii.dataobj)
+
+def test_derive_masks(tmp_path):
+    _save_mask(tmp_path, "a", [[[0, 1, 1, 0]]])
+    _save_mask(tmp_path, "b", [[[0, 0, 1, 1]]])
+    derived = [
+        ("sum", ("add", "a", "b")),
+        # uint8 subtraction would wrap around to 255 where b is set and a is not
+        ("diff", ("clip", ("sub", "a", "b"), 0, 1)),
+        ("either", ("union", "a", "b")),
+    ]
+    assert pipeline.derive_masks(str(tmp_path), derived) is True
+    np.testing.assert_array_equal(_load_mask(tmp_path, "sum"), [[[0, 1, 2, 1]]])
+    np.testing.assert_array_equal(_load_mask(tmp_path, "diff"), [[[0, 1, 0, 0]]])
+    np.testing.assert_array_equal(_load_mask(tmp_path, "either"), [[[0, 1, 1, 1]]])
+
+def test_derive_masks_grid_mismatch(tmp_path):
+    _save_mask(tmp_path, "a", [[[0, 1, 1, 0]]])
+    _save_mask(tmp_path, "b", [[[0, 1, 1]]])
+    assert pipeline.derive_masks(str(tmp_path), [("sum", ("add", "a", "b"))]) is False
+    assert not os.path.exists(os.path.join(tmp_path, "sum.nii.gz"))
+
+def test_rewrite_paths_whole_components():
+    rewrites = [("/out", "/scratch/HC/output"), ("/out/HC", "/elsewhere")]
+    assert pipeline.rewrite_paths("/out/HC/a.nii.gz", rewrites) == "/elsewhere/a.nii.gz"
+    assert pipeline.rewrite_paths("/out/HC2/a.nii.gz", rewrites) == "/scratch/HC/output/HC2/a.nii.gz"
+    assert pipeline.rewrite_paths("/output/a.nii.gz", rewrites) == "/output/a.nii.gz"
+    assert pipeline.rewrite_paths('--input "/out" --x', rewrites) == '--input "/scratch/HC/output" --x'
+
+@pytest.mark.parametrize("relative", [False, True])
+def test_stage_in_out_round_trip(tmp_path, monkeypatch, relative):
+    monkeypatch.chdir(tmp_path)
+    output = "out" if relative else str(tmp_path / "out")
+    options = argparse.Namespace(input=str(tmp_path / "in"), output=output, scratch=str(tmp_path / "scratch"))
+
+    # qpdata links are absolute, as made by link_data()
+    subjdir = os.path.abspath(os.path.join(output, "S1"))
+    os.makedirs(os.path.join(subjdir, "preproc"))
+    os.makedirs(os.path.join(subjdir, "qpdata"))
+    with open(os.path.join(subjdir, "preproc", "t1.nii.gz"), "w") as f:
+        f.write("t1")
+    os.symlink(os.path.join(subjdir, "preproc", "t1.nii.gz"), os.path.join(subjdir, "qpdata", "t1.nii.gz"))
+
+    subj_options = pipeline.stage_in(options, "S1", ["stats"])
+    scratch_subjdir = os.path.join(subj_options.output, "S1")
+    scratch_link = os.path.join(scratch_subjdir, "qpdata", "t1.nii.gz")
+    assert os.path.realpath(scratch_link) == os.path.realpath(os.path.join(scratch_subjdir, "preproc", "t1.nii.gz"))
+
+    # New link made while running in scratch
+    os.symlink(os.path.join(scratch_subjdir, "preproc", "t1.nii.gz"), os.path.join(scratch_subjdir, "qpdata", "t1_copy.nii.gz"))
+    pipeline.stage_out(subj_options, "S1", ["stats"])
+    pipeline.cleanup_scratch(options, "S1")
+
+    assert not os.path.exists(os.path.join(options.scratch, "S1"))
+    for name in ("t1.nii.gz", "t1_copy.nii.gz"):
+        link = os.path.join(subjdir, "qpdata", name)
+        assert os.readlink(link) == os.path.join(subjdir, "preproc", "t1.nii.gz")
+        with open(link) as f:
+            assert f.read() == "t1"
@@ -0,0 +1,44 @@
+"""
+Tests for the summary statistics used by the native stats engine
+"""
+import numpy as np
+import pytest
+
+import roi_stats
+
+def test_summary_stats_interquartile():
+    # Quartiles are 2.75 and 6.25 so the interquartile values are 3-6 and the outlier is excluded
+    stats = roi_stats.summary_stats(np.array([1, 2, 3, 4, 5, 6, 7, 100]))
+    assert stats["Mean"] == pytest.approx(16.0)
+    assert stats["Median"] == pytest.approx(4.5)
+    assert stats["Min"] == 1
+    assert stats["Max"] == 100
+    assert stats["Interquartile mean"] == pytest.approx(4.5)
+    assert stats["Interquartile STD"] == pytest.approx(np.sqrt(1.25))
+    assert stats["N"] == 8
+
+def test_summary_stats_empty():
+    stats = roi_stats.summary_stats(np.array([]))
+    assert list(stats) == roi_stats.STATS
+    assert stats["N"] == 0
+    assert all(np.isnan(stats[name]) for name in roi_stats.STATS if name != "N")
+
+def test_summary_stats_order_and_count_type():
+    stats = roi_stats.summary_stats(np.arange(10, dtype=np.int16))
+    assert list(stats) == roi_stats.STATS
+    assert isinstance(stats["N"], int)
+
+def test_mode_fwhm_constant():
+    assert roi_stats.mode_fwhm(np.full(5, 3.5)) == (3.5, 0.0)
+
+def test_mode_fwhm_histogram():
+    # Freedman-Diaconis bins are [1, 2.33), [2.33, 3.67), [3.67, 5] with counts 3, 4, 3
+    mode, fwhm = roi_stats.mode_fwhm(np.array([1, 2, 2, 3, 3, 3, 3, 4, 4, 5], dtype=np.float64))
+    assert mode == pytest.approx(3.0)
+    assert fwhm == pytest.approx(4.0)
+
+def test_mode_fwhm_gaussian():
+    values = np.random.default_rng(0).normal(10, 2, 200000)
+    mode, fwhm = roi_stats.mode_fwhm(values)
+    assert mode == pytest.approx(10, abs=0.3)
+    assert fwhm == pytest.approx(2 * np.sqrt(2 * np.log(2)) * 2, rel=0.05)